@@ -2,6 +2,7 @@ import { NextResponse } from 'next/server';
 import { GoogleGenerativeAI } from '@google/generative-ai';
 import { createClient } from '@supabase/supabase-js';
 import { YoutubeTranscript } from 'youtube-transcript';
+import { transcriptRow } from '@/lib/transcript-codec';
 
 const adminSupabase = createClient(
     process.env.NEXT_PUBLIC_SUPABASE_URL!,
@@ -35,9 +36,23 @@ export async function POST(request: Request) {
         const genAI = new GoogleGenerativeAI(process.env.GOOGLE_GEMINI_KEY!);
         const model = genAI.getGenerativeModel({ model: 'gemini-2.5-flash', generationConfig: { responseMimeType: "application/json" } });
 
+        // save_subtitles.py の文の復元 (scripts/sentence_restore.py) で AI 整形は不要と判定された動画は Gemini に送らない
+        // (しきい値は sentence_restore.py の LLM_THRESHOLD だけが持ち、判定結果が sentence_needs_llm に入っている)
+        const { data: restoredRows } = await adminSupabase
+            .from('optimized_transcripts')
+            .select('video_id, sentence_confidence')
+            .in('video_id', videoIds)
+            .eq('sentence_needs_llm', false);
+        const restored = new Map((restoredRows || []).map((row: any) => [row.video_id, row.sentence_confidence]));
+
         for (const videoId of videoIds) {
             let rawLines: any[] = [];
 
+            if (restored.has(videoId)) {
+                results.push({ videoId, status: 'Skipped', message: `Sentences already restored (confidence ${restored.get(videoId)}).` });
+                continue;
+            }
+
             // 1. YouTubeから字幕取得 (Plan A のみで試行)
             try {
                 const transcript = await YoutubeTranscript.fetchTranscript(videoId);
@@ -73,12 +88,12 @@ export async function POST(request: Request) {
                     }
 
                     // 3. 英語マスターとして保存
-                    await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: finalFormatted });
+                    await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, finalFormatted));
                     results.push({ videoId, status: 'Success', message: 'Master created and saved.' });
 
                 } catch (aiError) {
                     // AIエラー時は生データのみ保存
-                    await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: rawLines.map(l => ({ ...l, translation: "" })) });
+                    await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, rawLines.map(l => ({ ...l, translation: "" }))));
                     results.push({ videoId, status: 'AI Error', message: 'Saved raw data due to AI failure.' });
                 }
             } else {
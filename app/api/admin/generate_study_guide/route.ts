@@ -67,15 +67,19 @@ export async function POST(request: Request) {
         const data = JSON.parse(text);
 
         // Save to DB
+        // 1動画・1解説言語につき1件 (video_id, explanation_lang の一意インデックス)。このプロンプトの解説は日本語
         const { error } = await adminSupabase.from('video_study_guides').upsert([{
             video_id: videoId,
+            explanation_lang: 'Japanese',
+            // 渡された字幕から作ったので、保存済みの字幕のハッシュは分からない (前回のバッチの値を残さない)
+            source_hash: null,
             title: data.title,
             summary: data.summary,
             key_sentences: data.key_sentences,
             vocabulary: data.vocabulary,
             grammar: data.grammar,
             quiz: data.quiz
-        }], { onConflict: 'video_id' });
+        }], { onConflict: 'video_id, explanation_lang' });
 
         if (error) throw error;
 
@@ -4,6 +4,7 @@ import { createClient } from '@supabase/supabase-js';
 import { YoutubeTranscript } from 'youtube-transcript';
 // @ts-ignore
 import { Innertube, UniversalCache } from 'youtubei.js';
+import { transcriptRow } from '@/lib/transcript-codec';
 
 const adminSupabase = createClient(
     process.env.NEXT_PUBLIC_SUPABASE_URL!,
@@ -51,10 +52,7 @@ export async function POST(request: Request) {
             if (rawLines.length > 0) {
                 // 整形なしの生データとして保存 (表示の安定性優先)
                 // 英語マスターデータとして保存
-                await adminSupabase.from('optimized_transcripts').upsert({
-                    video_id: videoId,
-                    content: rawLines
-                }, { onConflict: 'video_id' });
+                await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, rawLines), { onConflict: 'video_id' });
                 console.log(`[Daily] Transcript saved for ${videoId}`);
             }
         } catch (e) {
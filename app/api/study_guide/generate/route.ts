@@ -199,6 +199,8 @@ export async function POST(request: Request) {
         const { error } = await adminSupabase.from('video_study_guides').upsert([{
             video_id: videoId,
             explanation_lang: targetExplanationLang, // Save lang
+            // Not generated from a hashed transcript: clear the batch's hash so precompute_study_guides.py regenerates it
+            source_hash: null,
             title: data.title,
             summary: data.summary,
             key_sentences: data.key_sentences,
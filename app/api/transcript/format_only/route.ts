@@ -1,6 +1,7 @@
 import { NextResponse } from 'next/server';
 import { GoogleGenerativeAI } from '@google/generative-ai';
 import { createClient } from '@supabase/supabase-js';
+import { transcriptRow } from '@/lib/transcript-codec';
 
 const adminSupabase = createClient(
     process.env.NEXT_PUBLIC_SUPABASE_URL!,
@@ -56,7 +57,7 @@ export async function POST(request: Request) {
         }
 
         // 英語マスターを保存
-        await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: finalFormatted });
+        await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, finalFormatted));
 
         return NextResponse.json({ success: true, count: finalFormatted.length, message: "Master transcript saved." });
 
@@ -4,6 +4,7 @@ import { createClient } from '@supabase/supabase-js';
 import { YoutubeTranscript } from 'youtube-transcript';
 // @ts-ignore
 import { Innertube, UniversalCache } from 'youtubei.js';
+import { decodeTranscript, transcriptRow } from '@/lib/transcript-codec';
 
 const adminSupabase = createClient(
     process.env.NEXT_PUBLIC_SUPABASE_URL!,
@@ -73,11 +74,11 @@ export async function GET(request: Request) {
             const { data: translationData } = await adminSupabase.from('localized_translations').select('translations').match({ video_id: videoId, language: code }).single();
             if (translationData) {
                 const { data: masterData } = await adminSupabase.from('optimized_transcripts').select('content').eq('video_id', videoId).single();
-                if (masterData) return NextResponse.json(mergeData(masterData.content, translationData.translations));
+                if (masterData) return NextResponse.json(mergeData(decodeTranscript(masterData.content), translationData.translations));
             }
         } else {
             const { data: masterDataEn } = await adminSupabase.from('optimized_transcripts').select('content').eq('video_id', videoId).single();
-            if (masterDataEn) return NextResponse.json(masterDataEn.content.map((l: any) => ({ ...l, translation: "" }))
+            if (masterDataEn) return NextResponse.json(decodeTranscript(masterDataEn.content).map((l: any) => ({ ...l, translation: "" }))
             );
         }
 
@@ -87,9 +88,10 @@ export async function GET(request: Request) {
 
         // まずDBのマスターデータを確認
         const { data: masterData } = await adminSupabase.from('optimized_transcripts').select('content').eq('video_id', videoId).single();
-        if (masterData && masterData.content && masterData.content.length > 0) {
+        const masterLines = masterData ? decodeTranscript(masterData.content) : null;
+        if (masterLines && masterLines.length > 0) {
             console.log('[API] Using cached master transcript for translation.');
-            rawLines = masterData.content;
+            rawLines = masterLines;
             useMasterData = true;
         }
 
@@ -136,7 +138,7 @@ export async function GET(request: Request) {
         // 長すぎる場合はAIスキップ (英語のみの場合)
         if (!useMasterData && rawLines.length > 2000 && code === 'en') {
             const safeData = rawLines.map(l => ({ ...l, translation: "" }));
-            await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: safeData });
+            await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, safeData));
             return NextResponse.json(safeData);
         }
 
@@ -179,7 +181,7 @@ export async function GET(request: Request) {
 
             // 5. 保存
             if (!useMasterData) {
-                await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: finalFormatted });
+                await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, finalFormatted));
             }
             if (code !== 'en') {
                 await adminSupabase.from('localized_translations').upsert({ video_id: videoId, language: code, translations: finalTranslation }, { onConflict: 'video_id, language' });
@@ -4,6 +4,7 @@ import { createClient } from '@supabase/supabase-js';
 import { YoutubeTranscript } from 'youtube-transcript';
 // @ts-ignore
 import { Innertube, UniversalCache } from 'youtubei.js';
+import { decodeTranscript, transcriptRow } from '@/lib/transcript-codec';
 
 const adminSupabase = createClient(
     process.env.NEXT_PUBLIC_SUPABASE_URL!,
@@ -41,7 +42,7 @@ export async function GET(request: Request) {
 
         if (masterData) {
             console.log('[API] Transcript already exists in DB.');
-            return NextResponse.json(masterData.content);
+            return NextResponse.json(decodeTranscript(masterData.content));
         }
 
         // 2. なければ新規取得 (YouTubeから)
@@ -84,7 +85,7 @@ export async function GET(request: Request) {
         // 長すぎる場合は生データを保存
         if (rawLines.length > 2000) {
             const safeData = rawLines.map(l => ({ text: l.text, offset: l.offset, duration: l.duration }));
-            await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: safeData });
+            await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, safeData));
             return NextResponse.json(safeData);
         }
 
@@ -111,7 +112,7 @@ export async function GET(request: Request) {
             }
 
             // 保存 (マスターデータ)
-            await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: finalFormatted });
+            await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, finalFormatted));
 
             return NextResponse.json(finalFormatted);
 
@@ -119,7 +120,7 @@ export async function GET(request: Request) {
             console.warn('[API] AI Processing Failed (Fallback to raw):', aiError);
             // 失敗時は生データを保存
             const safeData = rawLines.map(l => ({ text: l.text, offset: l.offset, duration: l.duration }));
-            await adminSupabase.from('optimized_transcripts').upsert({ video_id: videoId, content: safeData });
+            await adminSupabase.from('optimized_transcripts').upsert(transcriptRow(videoId, safeData));
             return NextResponse.json(safeData);
         }
 
@@ -11,16 +11,25 @@ supabase: Client = create_client(url, key)
 sql = """
 create table if not exists video_study_guides (
   id uuid default gen_random_uuid() primary key,
-  video_id text not null unique,
+  video_id text not null,
+  explanation_lang text,
   title text,
   summary text,
   key_sentences jsonb,
   vocabulary jsonb,
   grammar jsonb,
   quiz jsonb,
+  -- scripts/precompute_study_guides.py: content_hash of the transcript the guide was generated from
+  source_hash text,
+  generated_by text,
+  generated_at timestamptz,
   created_at timestamptz default now()
 );
 
+-- One guide per video and explanation language (upsert target of the API routes and the batch job)
+create unique index if not exists video_study_guides_video_lang_idx
+  on video_study_guides (video_id, explanation_lang);
+
 -- Enable RLS
 alter table video_study_guides enable row level security;
 
@@ -44,3 +53,4 @@ create policy "Public read" on video_study_guides for select using (true);
 
 print("Please run this SQL in your Supabase SQL Editor:")
 print(sql)
+print("Then pre-generate guides for all transcripts with scripts/precompute_study_guides.py")
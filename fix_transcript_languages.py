@@ -1,10 +1,22 @@
 import os
 import re
-import time
+import sys
+import argparse
 from pathlib import Path
 from dotenv import load_dotenv
 from supabase import create_client
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
+from youtube_transcript_api.formatters import WebVTTFormatter
+
+# Shared helpers live next to the subtitle scripts
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'scripts'))
+from caption_cache import CaptionCache
+from vtt_parser import iter_cues
+from run_journal import RunJournal, SUCCESS, NO_CAPTIONS, ERROR
+from rate_limit import AdaptiveRateLimiter
+from rest_writer import BulkUpdater
+from lang_id import identify
+from transcript_codec import content_to_text
 
 # --- Configuration ---
 env_path = Path('.') / '.env.local'
@@ -19,6 +31,10 @@ if not SUPABASE_URL or not SUPABASE_KEY:
 
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 ytt_api = YouTubeTranscriptApi()
+vtt_formatter = WebVTTFormatter()
+# Raw captions are cached locally (shared with scripts/save_subtitles.py),
+# so re-running after a cleaning tweak doesn't hit YouTube again.
+caption_cache = CaptionCache()
 
 # Map Subject (DB) to Language Code (YouTube)
 SUBJECT_TO_LANG_CODES = {
@@ -32,134 +48,323 @@ SUBJECT_TO_LANG_CODES = {
     'Chinese': ['zh', 'zh-Hans', 'zh-Hant', 'zh-CN', 'zh-TW'],
 }
 
-def get_expected_languages():
+# Mismatches are computed by this view on the database side, so the script
+# never pulls whole tables through the REST API (which truncates at its row limit).
+MISMATCH_VIEW = "transcript_language_mismatches"
+PAGE_SIZE = 500
+
+# --detect walks every transcript with a known subject (content included, so smaller pages)
+# and classifies the stored text locally; only rows whose text is confidently in another
+# language are re-fetched from YouTube.
+EXPECTED_VIEW = "transcript_expected_languages"
+DETECT_PAGE_SIZE = 100
+DETECT_MIN_CONFIDENCE = 0.6
+
+# YouTube request rate: by default no faster than the old one-second sleep per video.
+# Raising --max-rps lets it speed up while requests succeed; it always backs off
+# exponentially on 429 / "sign in to confirm" responses
+START_RPS = 1.0
+MIN_RPS = 0.05
+MAX_RPS = START_RPS
+
+# Fixed rows are buffered and written back this many at a time
+WRITE_BATCH_SIZE = 100
+
+# Refetched content differs per row, which a PostgREST update can't batch, so each batch
+# goes through this function instead (created by --print-sql; one call per batch)
+UPDATE_FUNCTION = "update_transcript_content"
+
+# Append-only record of each video's outcome, used by --resume
+JOURNAL_FILE = "fix_transcript_languages.journal.jsonl"
+
+limiter = AdaptiveRateLimiter(START_RPS, min_rate=MIN_RPS, max_rate=MAX_RPS)
+
+def build_mismatch_view_sql():
+    """
+    DDL for the expected-language and mismatch views, and for the function the writer batches updates through.
+    The subject -> language code table is generated from SUBJECT_TO_LANG_CODES, so re-run this after changing the mapping.
+    Roadmap subjects take precedence over library subjects (roadmap is usually more curated).
+    """
+    values = ",\n        ".join(
+        f"('{subject}', '{code}', {i})"
+        for subject, codes in SUBJECT_TO_LANG_CODES.items()
+        for i, code in enumerate(codes)
+    )
+    return f"""
+create or replace view {EXPECTED_VIEW} as
+with subject_langs (subject, lang_code, ord) as (
+    values
+        {values}
+),
+expected as (
+    select distinct on (video_id) video_id, subject
+    from (
+        select video_id, subject, 0 as priority from roadmap_items
+        where video_id is not null and subject is not null
+        union all
+        select video_id, subject, 1 as priority from library_videos
+        where video_id is not null and subject is not null
+    ) s
+    order by video_id, priority
+)
+select
+    t.video_id,
+    t.language as current_language,
+    e.subject as expected_subject,
+    array(
+        select sl.lang_code from subject_langs sl
+        where sl.subject = e.subject order by sl.ord
+    ) as expected_codes,
+    t.content
+from optimized_transcripts t
+join expected e on e.video_id = t.video_id;
+
+create or replace view {MISMATCH_VIEW} as
+select video_id, current_language, expected_subject, expected_codes
+from {EXPECTED_VIEW}
+where current_language is null
+   or not (current_language = any(expected_codes));
+
+-- Keyset pagination walks the view in video_id order
+create index if not exists roadmap_items_video_id_idx on roadmap_items (video_id);
+create index if not exists library_videos_video_id_idx on library_videos (video_id);
+
+-- Writes a batch of fixed transcripts in one statement and returns the ids it updated.
+-- security invoker (the default), so the same RLS update policy applies as for a plain update.
+create or replace function {UPDATE_FUNCTION}(batch jsonb)
+returns table (video_id text)
+language sql as $$
+    update optimized_transcripts t
+    set content = r.value -> 'content',
+        language = r.value ->> 'language',
+        content_hash = r.value ->> 'content_hash'
+    from jsonb_array_elements(batch) r
+    where t.video_id = r.value ->> 'video_id'
+    returning t.video_id;
+$$;
+
+-- Let the REST API see the new function
+notify pgrst, 'reload schema';
+"""
+
+def iter_view(view, columns, page_size=PAGE_SIZE):
+    """
+    Stream rows from a view using keyset pagination on video_id.
+    """
+    last_video_id = None
+    while True:
+        query = supabase.table(view).select(columns).order("video_id").limit(page_size)
+        if last_video_id is not None:
+            query = query.gt("video_id", last_video_id)
+
+        rows = query.execute().data
+        yield from rows
+        if len(rows) < page_size:
+            break
+        last_video_id = rows[-1]['video_id']
+
+def iter_mismatches(page_size=PAGE_SIZE):
+    """
+    Yields dicts: { video_id, current_language, expected_subject, expected_codes }
+    """
+    return iter_view(MISMATCH_VIEW, "video_id, current_language, expected_subject, expected_codes", page_size)
+
+def iter_expected(page_size=DETECT_PAGE_SIZE):
+    """
+    Every transcript with a known subject, label or not.
+    Yields dicts: { video_id, current_language, expected_subject, expected_codes, content }
+    """
+    return iter_view(EXPECTED_VIEW, "video_id, current_language, expected_subject, expected_codes, content", page_size)
+
+def detect_content_match(content, expected_codes):
     """
-    Fetch all videos from roadmap_items and library_videos to determine their expected subject.
-    Returns a dict: { video_id: subject }
+    Classify the stored text offline.
+    Returns (True/False, detected code) when confident, (None, detected code) otherwise.
     """
-    video_subjects = {}
-
-    # 1. Roadmap Items
-    print("Fetching roadmap items...")
-    res = supabase.table("roadmap_items").select("video_id, subject").execute()
-    for item in res.data:
-        if item['video_id'] and item['subject']:
-            video_subjects[item['video_id']] = item['subject']
-
-    # 2. Library Videos
-    print("Fetching library videos...")
-    res = supabase.table("library_videos").select("video_id, subject").execute()
-    for item in res.data:
-        if item['video_id'] and item['subject']:
-            # Roadmap takes precedence if conflict (arbitrary choice, but roadmap is usually more curated)
-            if item['video_id'] not in video_subjects:
-                video_subjects[item['video_id']] = item['subject']
-    
-    return video_subjects
-
-def get_current_transcripts():
+    detected, confidence = identify(content_to_text(content))
+    if detected is None or confidence < DETECT_MIN_CONFIDENCE:
+        return None, detected
+    return detected in {code.split('-')[0] for code in expected_codes}, detected
+
+def vtt_to_text(vtt):
     """
-    Fetch all optimized transcripts with their language.
-    Returns a list of dicts: [{ video_id, language, content }]
+    Join all cue texts of a WebVTT payload into one cleaned string.
     """
-    print("Fetching current transcripts...")
-    # Fetching all might be heavy, but let's try. If too large, we'd need pagination.
-    # For now assuming < 1000 items or reasonable size.
-    res = supabase.table("optimized_transcripts").select("video_id, language").execute()
-    return res.data
+    text_segments = [cue['text'] for cue in iter_cues(vtt, require_header=False)]
+    full_text = " ".join(text_segments)
+    return re.sub(r'\s+', ' ', full_text).strip()
 
 def fetch_youtube_transcript(video_id, lang_codes):
     """
     Fetch transcript from YouTube in the specified language.
+    Reads through the local caption cache first.
     """
+    cached = caption_cache.get(video_id, langs=lang_codes)
+    if cached is not None:
+        return vtt_to_text(cached), "Cached"
+
+    limiter.acquire()
     try:
         # Use fetch directly. It prefers manually created transcripts.
         # It will raise an exception if no transcript matches the language.
         data = ytt_api.fetch(video_id, languages=lang_codes)
-        
-        # Clean text
-        text_segments = [line['text'] for line in data]
-        full_text = " ".join(text_segments)
-        full_text = full_text.replace("\n", " ")
-        full_text = re.sub(r'\s+', ' ', full_text).strip()
-        return full_text, "Success"
+
+        # Keep the raw captions as WebVTT so every script shares one cache format
+        vtt = vtt_formatter.format_transcript(data)
+        kind = 'auto' if data.is_generated else 'manual'
+        caption_cache.put(video_id, data.language_code, kind, vtt.encode('utf-8'))
+
+        limiter.report()
+        return vtt_to_text(vtt), "Success"
             
     except NoTranscriptFound:
+        limiter.report()
         return None, "Not Found"
     except Exception as e:
-        return None, str(e)
+        limiter.report(e)
+        return None, f"{type(e).__name__}: {e}"
 
-def main():
+def main(resume=False, journal_path=JOURNAL_FILE, batch_size=WRITE_BATCH_SIZE, detect=False, rps=None, max_rps=None):
     print("--- Starting Transcript Language Fix ---")
-    
-    expected_map = get_expected_languages()
-    current_transcripts = get_current_transcripts()
-    
-    print(f"Found {len(expected_map)} videos with expected subjects.")
-    print(f"Found {len(current_transcripts)} existing transcripts.")
+    # Load tests run against a local stand-in and can go well above the YouTube-safe rate
+    if rps is not None:
+        limiter.rate = rps
+    if max_rps is not None:
+        limiter.max_rate = max_rps
+    limiter.max_rate = max(limiter.max_rate, limiter.rate)
 
     mismatch_count = 0
     fixed_count = 0
-    
-    for t in current_transcripts:
-        vid = t['video_id']
-        current_lang = t.get('language')
-        
-        if vid not in expected_map:
-            continue
-            
-        expected_subject = expected_map[vid]
-        expected_codes = SUBJECT_TO_LANG_CODES.get(expected_subject)
-        
-        if not expected_codes:
-            print(f"Skipping {vid}: Unknown subject '{expected_subject}'")
-            continue
-
-        # Check for mismatch
-        is_mismatch = False
-        if current_lang not in expected_codes:
-            is_mismatch = True
+    relabeled_count = 0
+    resumed_skip_count = 0
+    journal = RunJournal(journal_path)
+
+    def on_written(vid, error):
+        # Called once per row after its update, so the journal only marks rows that really landed
+        nonlocal fixed_count
+        if error is None:
+            fixed_count += 1
+            journal.record(vid, SUCCESS)
+        else:
+            journal.record(vid, ERROR, type(error).__name__)
+
+    def on_relabeled(vid, error):
+        nonlocal relabeled_count
+        if error is None:
+            relabeled_count += 1
+            journal.record(vid, SUCCESS)
+        else:
+            journal.record(vid, ERROR, type(error).__name__)
+
+    # Leaving the with block (normally or on an exception) flushes the remaining rows.
+    # Updates, not upserts: the anon key only needs an UPDATE policy, and a video_id
+    # deleted since the scan is reported as an error instead of being recreated.
+    # Each batch is one call to UPDATE_FUNCTION; without it, rows fall back to one update each.
+    writer = BulkUpdater(supabase, "optimized_transcripts", "video_id", batch_size,
+                         on_result=on_written, rpc=UPDATE_FUNCTION)
+    # Label-only fixes are counted separately; rows getting the same label go out as one update
+    relabeler = BulkUpdater(supabase, "optimized_transcripts", "video_id", batch_size, on_result=on_relabeled)
+
+    if detect:
+        print(f"Classifying stored transcripts from '{EXPECTED_VIEW}'...")
+        rows = iter_expected()
+    else:
+        print(f"Streaming mismatches from '{MISMATCH_VIEW}'...")
+        rows = iter_mismatches()
+
+    # The journal is listed first so it closes last, after the writers have recorded their final rows
+    with journal, writer, relabeler:
+        for t in rows:
+            vid = t['video_id']
+            current_lang = t.get('current_language')
+            expected_subject = t['expected_subject']
+            expected_codes = t.get('expected_codes')
             
-        if is_mismatch:
-            print(f"Mismatch found for {vid}: Current='{current_lang}', Expected='{expected_subject}' ({expected_codes})")
+            if not expected_codes:
+                print(f"Skipping {vid}: Unknown subject '{expected_subject}'")
+                continue
+
+            label_ok = current_lang in expected_codes
+            if detect:
+                content_ok, detected = detect_content_match(t.get('content'), expected_codes)
+                if content_ok is None:
+                    # Not sure what the text is: fall back to the label check
+                    content_ok = label_ok
+                if content_ok and label_ok:
+                    continue
+                if content_ok:
+                    # Text is already in the right language, only the label is wrong: no YouTube call needed
+                    print(f"Relabel {vid}: Current='{current_lang}', text looks like '{detected}' -> '{expected_codes[0]}'")
+                    relabeler.add({"video_id": vid, "language": expected_codes[0]})
+                    continue
+                print(f"Content mismatch for {vid}: Label='{current_lang}', text looks like '{detected}', Expected='{expected_subject}' ({expected_codes})")
+            else:
+                print(f"Mismatch found for {vid}: Current='{current_lang}', Expected='{expected_subject}' ({expected_codes})")
             mismatch_count += 1
+
+            # Finished earlier, or failed recently and still backing off
+            if resume and journal.should_skip(vid):
+                print(f"  -> Skipped (journal: {journal.entries[vid]['status']}).")
+                resumed_skip_count += 1
+                continue
             
             # Fetch new transcript
             print(f"  -> Fetching new transcript in {expected_codes}...")
             new_text, status = fetch_youtube_transcript(vid, expected_codes)
             
             if new_text:
-                print(f"  -> Success! Updating database...")
-                try:
-                    # We don't know exactly which code matched, but we can assume the first one or just save the subject?
-                    # Ideally we should save the actual code, but fetch() doesn't return it easily in this structure.
-                    # Wait, fetch() returns FetchedTranscript?
-                    # If it returns a list of dicts, we don't know the code.
-                    # But we can just save the PRIMARY code (e.g. 'en') or the Subject name?
-                    # The DB has 'language' column.
-                    # Let's save the first code in the list as a canonical code, OR keep it simple.
-                    # Actually, if we successfully fetched, it means one of them matched.
-                    # Let's save the first code for now, or 'en' for English.
-                    canonical_lang = expected_codes[0]
-                    
-                    supabase.table("optimized_transcripts").update({
-                        "content": new_text,
-                        "language": canonical_lang
-                    }).eq("video_id", vid).execute()
-                    fixed_count += 1
-                    print(f"  -> Saved as '{canonical_lang}'.")
-                except Exception as e:
-                    print(f"  -> DB Error: {e}")
+                # We don't know exactly which code matched, but we can assume the first one or just save the subject?
+                # Ideally we should save the actual code, but fetch() doesn't return it easily in this structure.
+                # Wait, fetch() returns FetchedTranscript?
+                # If it returns a list of dicts, we don't know the code.
+                # But we can just save the PRIMARY code (e.g. 'en') or the Subject name?
+                # The DB has 'language' column.
+                # Let's save the first code in the list as a canonical code, OR keep it simple.
+                # Actually, if we successfully fetched, it means one of them matched.
+                # Let's save the first code for now, or 'en' for English.
+                canonical_lang = expected_codes[0]
+                
+                writer.add({
+                    "video_id": vid,
+                    "content": new_text,
+                    "language": canonical_lang,
+                    # The stored hash describes the old content; readers recompute it when it is empty
+                    "content_hash": None
+                })
+                print(f"  -> Success! Queued for update as '{canonical_lang}'.")
             else:
+                if status == "Not Found":
+                    journal.record(vid, NO_CAPTIONS)
+                else:
+                    journal.record(vid, ERROR, status.split(":")[0])
                 print(f"  -> Failed to fetch transcript: {status}")
-            
-            # Sleep to avoid rate limits
-            time.sleep(1)
 
     print("------------------------------------------------")
     print(f"Process Complete.")
     print(f"Total Mismatches Found: {mismatch_count}")
     print(f"Total Fixed: {fixed_count}")
+    if detect:
+        print(f"Relabeled without refetch: {relabeled_count}")
+    if writer.failed or relabeler.failed:
+        print(f"DB Errors: {len(writer.failed) + len(relabeler.failed)}")
+    if resume:
+        print(f"Skipped by journal: {resumed_skip_count}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Re-fetch transcripts whose language doesn't match the video's subject.")
+    parser.add_argument("--print-sql", action="store_true", help="Print the DDL for the mismatch views and the batch update function, then exit")
+    parser.add_argument("--resume", action="store_true", help="Skip videos the journal marks as finished or backing off")
+    parser.add_argument("--journal", default=JOURNAL_FILE, help="Path of the run journal")
+    parser.add_argument("--batch-size", type=int, default=WRITE_BATCH_SIZE, help="Rows buffered per write batch")
+    parser.add_argument("--detect", action="store_true",
+                        help="Classify stored text offline and refetch only rows whose content is in the wrong language")
+    parser.add_argument("--rps", type=float, default=None, help=f"Starting requests per second (default: {START_RPS})")
+    parser.add_argument("--max-rps", type=float, default=None, help=f"Upper bound while requests succeed (default: {MAX_RPS})")
+    args = parser.parse_args()
+
+    if args.print_sql:
+        print("Please run this SQL in your Supabase SQL Editor:")
+        print(build_mismatch_view_sql())
+    else:
+        main(resume=args.resume, journal_path=args.journal, batch_size=args.batch_size, detect=args.detect,
+             rps=args.rps, max_rps=args.max_rps)
@@ -0,0 +1,39 @@
+import { inflateSync } from 'zlib';
+
+// optimized_transcripts.content のデコード (エンコード側は scripts/transcript_codec.py)
+// 従来のブロック配列と、列指向形式 { fmt: 'columnar', v: 1, ... } の両方を受け付ける
+
+export type TranscriptBlock = { text: string; offset: number; duration: number };
+
+type Columns = { n: number; o: number[]; d: number[]; t: string; b: number[] };
+
+const FORMAT = 'columnar';
+const VERSION = 1;
+
+export function decodeTranscript(content: any): any {
+    // 従来形式 (配列) や想定外の値はそのまま返す
+    if (!content || Array.isArray(content) || content.fmt !== FORMAT) return content;
+    if (content.v !== VERSION) throw new Error(`Unsupported transcript format version: ${content.v}`);
+
+    const columns: Columns = content.z
+        ? JSON.parse(inflateSync(Buffer.from(content.z, 'base64')).toString('utf-8'))
+        : content;
+
+    // b は UTF-16 のコード単位での終了位置なので、String.slice でそのまま切り出せる
+    const blocks: TranscriptBlock[] = new Array(columns.n);
+    let offset = 0;
+    let start = 0;
+    for (let i = 0; i < columns.n; i++) {
+        offset += columns.o[i];
+        blocks[i] = { text: columns.t.slice(start, columns.b[i]), offset, duration: columns.d[i] };
+        start = columns.b[i];
+    }
+    return blocks;
+}
+
+// optimized_transcripts に content を書き込むときの行。
+// content_hash は本文から計算した値 (scripts/transcript_codec.py の content_hash) なので、
+// 本文を書き換える側は古い値を残さずに空にする (空の行は読む側が content から計算し直す)
+export function transcriptRow(videoId: string, content: any) {
+    return { video_id: videoId, content, content_hash: null };
+}
@@ -1,10 +1,15 @@
 import os
 import re
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 from supabase import create_client, Client
 from youtube_transcript_api import YouTubeTranscriptApi, TranscriptsDisabled, NoTranscriptFound
 
+# 共通モジュールは字幕スクリプトと同じ scripts/ にある
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'scripts'))
+from rest_writer import BulkUpserter
+
 # ==========================================
 # 1. .env.local の読み込み設定
 # ==========================================
@@ -23,6 +28,9 @@ if not SUPABASE_URL or not SUPABASE_KEY:
     print("変数名が合っているか確認してください。")
     exit(1)
 
+# video_transcripts にまとめて書き込む件数
+WRITE_BATCH_SIZE = 50
+
 # ==========================================
 # 対象の動画リスト
 # ==========================================
@@ -58,6 +66,17 @@ def process_videos():
     print(f"Supabaseに接続しました: {SUPABASE_URL}")
     print("処理を開始します...")
 
+    def on_written(video_id, error):
+        if error is None:
+            print(f"  [保存完了] {video_id}")
+
+    # with を抜けるとき (例外で中断した場合も) に残りをまとめて書き込む
+    with BulkUpserter(supabase, "video_transcripts", "video_id", WRITE_BATCH_SIZE, on_result=on_written) as writer:
+        process_items(writer)
+
+    print(f"\n完了しました。(保存: {writer.written}件, 失敗: {len(writer.failed)}件)")
+
+def process_items(writer):
     for item in video_list:
         video_id = item["video_id"]
         subject = item["roadmap_subject"]
@@ -97,16 +116,14 @@ def process_videos():
                     "is_auto_generated": is_auto
                 }
 
-                # Upsert実行
-                supabase.table("video_transcripts").upsert(data).execute()
-                print(f"  -> 保存完了 (文字数: {len(cleaned_text)})")
+                # Upsert はまとめて実行する (WRITE_BATCH_SIZE 件ごと)
+                writer.add(data)
+                print(f"  -> 保存待ち (文字数: {len(cleaned_text)})")
 
         except TranscriptsDisabled:
             print("  -> [エラー] 字幕機能が無効です。")
         except Exception as e:
             print(f"  -> [エラー] 予期せぬエラー: {str(e)}")
 
-    print("\n完了しました。")
-
 if __name__ == "__main__":
     process_videos()
\ No newline at end of file
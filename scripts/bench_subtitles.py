@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from vtt_parser import time_to_ms, clean_text, parse_vtt, parse_and_merge_vtt, iter_cues, merge_cues
+from sentence_restore import restore_sentences, LLM_THRESHOLD
+
+# ==========================================
+# 字幕パース・結合処理のベンチマーク
+#
+# 合成した VTT コーパス (短いクリップ / 3時間の講義 / 単語タグだらけの自動字幕 / CJK) に対して
+# 各関数のスループット (cues/s, MB/s) とピークメモリを測り、保存済みのベースラインと比較する。
+# 速さは cues/s そのものではなく、同じ実行の中で交互に測った基準の処理 (reference_workload) に対する比で比べるので、
+# マシンの速さや実行ごとの CPU クロックの揺れに左右されにくい。
+# ベースラインより遅く (またはメモリが多く) なっていたら終了コード 1 で失敗する。
+# あわせて、自動字幕のロールアップ重複除去でブロック数と保存サイズがどれだけ減るか、
+# 文の復元 (sentence_restore.py) の confidence と LLM 整形が必要かどうかも表示する。
+#
+#   python bench_subtitles.py                  # 測定してベースラインと比較
+#   python bench_subtitles.py --save-baseline  # 現在の結果をベースラインとして保存
+# ==========================================
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+DEFAULT_TOLERANCE = 0.25
+# 小さいケースのピークメモリは数 KB なので、割合だけでなく絶対値の余裕も持たせる
+MEMORY_SLACK_KB = 64
+DEFAULT_REPEAT = 5
+# 悪化と判定された項目は、この回数まで測り直して良い方を採る (共有マシンでの一時的な揺れで落ちないように)
+DEFAULT_CONFIRM_RUNS = 2
+SEED = 20240101
+
+EN_WORDS = (
+    "so today we are going to talk about how the present perfect works in everyday "
+    "conversation and why native speakers use it when the result still matters now"
+).split()
+JA_PHRASES = ["今日は", "現在完了形について", "説明します", "日常会話で", "よく使われる", "表現です", "例えば", "もう食べました"]
+ZH_PHRASES = ["今天我们", "来学习", "现在完成时", "在日常对话中", "非常常用", "比如说", "我已经吃过了"]
+# 文の復元に渡す言語 (書いていないコーパスは en)
+CORPUS_LANGS = {'cjk': 'ja'}
+
+# 基準の処理に使う VTT の長さ (秒)
+REFERENCE_DURATION_SEC = 600
+REFERENCE_TAG_RE = re.compile(r'<[^>]+>')
+
+
+def format_ts(ms):
+    return "%02d:%02d:%02d.%03d" % (ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, ms % 1000)
+
+
+def gen_manual_vtt(rng, duration_sec, text_fn):
+    """ 手動字幕風: 1キュー1〜2行、ときどき間があく """
+    lines = ["WEBVTT", "Kind: captions", "Language: en", ""]
+    t = 0
+    n = 0
+    while t < duration_sec * 1000:
+        d = rng.randint(1200, 4000)
+        n += 1
+        lines.append(str(n))
+        lines.append(f"{format_ts(t)} --> {format_ts(t + d)} align:start position:0%")
+        lines.append(text_fn(rng))
+        lines.append("")
+        t += d + rng.choice((0, 0, 0, 150, 1500))
+    return "\n".join(lines), n
+
+
+def gen_auto_vtt(rng, duration_sec):
+    """
+    YouTube 自動字幕風: 単語ごとの <時刻><c> タグ付きの長いキューと、10ms の確定キューが交互に並び、
+    前の行が次のキューにもう一度出てくる (ロールアップ表示)
+    """
+    lines = ["WEBVTT", "Kind: captions", "Language: en", ""]
+    t = 0
+    n = 0
+    prev = ""
+    while t < duration_sec * 1000:
+        words = [rng.choice(EN_WORDS) for _ in range(rng.randint(4, 9))]
+        d = rng.randint(1500, 3500)
+        step = d // len(words)
+        tagged = words[0] + "".join(
+            f"<{format_ts(t + step * (i + 1))}><c> {w}</c>" for i, w in enumerate(words[1:])
+        )
+        lines.append(f"{format_ts(t)} --> {format_ts(t + d)} align:start position:0%")
+        if prev:
+            lines.append(prev)
+        lines.append(tagged)
+        lines.append("")
+        lines.append(f"{format_ts(t + d)} --> {format_ts(t + d + 10)} align:start position:0%")
+        current = " ".join(words)
+        if prev:
+            lines.append(prev)
+        lines.append(current)
+        lines.append("")
+        prev = current
+        t += d + 10
+        n += 2
+    return "\n".join(lines), n
+
+
+def en_sentence(rng):
+    text = " ".join(rng.choice(EN_WORDS) for _ in range(rng.randint(3, 12)))
+    return text + rng.choice(("", "", ".", "?", "!"))
+
+
+def cjk_sentence(rng):
+    phrases = rng.choice((JA_PHRASES, ZH_PHRASES))
+    return "".join(rng.choice(phrases) for _ in range(rng.randint(1, 4))) + rng.choice(("", "。", "？", "！"))
+
+
+def build_corpus():
+    """ ベンチマーク用の合成コーパス。シード固定なので毎回同じ内容になる """
+    rng = random.Random(SEED)
+    corpus = {}
+    corpus['short_clip'] = gen_manual_vtt(rng, 120, en_sentence)
+    corpus['lecture_3h'] = gen_manual_vtt(rng, 3 * 3600, en_sentence)
+    corpus['auto_word_tags'] = gen_auto_vtt(rng, 3600)
+    corpus['cjk'] = gen_manual_vtt(rng, 3600, cjk_sentence)
+    return corpus
+
+
+def reference_lines():
+    """ 基準の処理の入力。シード固定の手動字幕風と自動字幕風の VTT の行 """
+    rng = random.Random(SEED + 1)
+    manual, _ = gen_manual_vtt(rng, REFERENCE_DURATION_SEC, en_sentence)
+    auto, _ = gen_auto_vtt(rng, REFERENCE_DURATION_SEC)
+    return (manual + "\n" + auto).split("\n")
+
+
+def reference_workload(lines):
+    """
+    速さの比較の基準にする、パースに似た文字列処理 (このリポジトリのコードは使わない)。
+    ベンチマークの値の意味が変わるので、この関数は変えないこと。
+    """
+    total = 0
+    for line in lines:
+        line = line.strip()
+        if '-->' in line:
+            start = line.partition(' --> ')[0]
+            total += sum(int(float(part)) for part in start.split(':'))
+        elif line and not line.isdigit():
+            total += len(REFERENCE_TAG_RE.sub('', line).strip())
+    return total
+
+
+def measure(fn, repeat, reference=None):
+    """
+    repeat 回実行して最速の時間と、1回分のピークメモリ (bytes) を返す。
+    reference を渡すと fn と交互に実行し、その最速の時間も返す (クロックの揺れが両方に同じようにかかる)
+    Returns: (best, peak, reference_best)
+    """
+    best = float('inf')
+    reference_best = float('inf')
+    for _ in range(repeat):
+        if reference is not None:
+            start = time.perf_counter()
+            reference()
+            reference_best = min(reference_best, time.perf_counter() - start)
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, reference_best
+
+
+def run_benchmarks(repeat, only=None):
+    """ only (項目名の集合) を渡すとその項目だけ測る """
+    corpus = build_corpus()
+    ref_lines = reference_lines()
+    results = {}
+
+    for name, (vtt, cue_count) in corpus.items():
+        size_mb = len(vtt.encode('utf-8')) / (1024 * 1024)
+        lines = vtt.split('\n')
+        timestamps = [part for line in lines if '-->' in line for part in line.split(' --> ')[:1]]
+        text_lines = [line for line in lines if line and '-->' not in line]
+
+        cases = {
+            # time_to_ms / clean_text は「1行あたり」の処理なので、行数を cues として数える
+            'time_to_ms': (lambda: [time_to_ms(ts) for ts in timestamps], len(timestamps)),
+            'clean_text': (lambda: [clean_text(line) for line in text_lines], len(text_lines)),
+            'parse_vtt': (lambda: parse_vtt(vtt), cue_count),
+            'parse_and_merge_vtt': (lambda: parse_and_merge_vtt(vtt), cue_count),
+            'restore_sentences': (
+                lambda: restore_sentences(iter_cues(vtt), CORPUS_LANGS.get(name, 'en')), cue_count
+            ),
+        }
+        for fn_name, (fn, units) in cases.items():
+            if only is not None and f"{fn_name}/{name}" not in only:
+                continue
+            elapsed, peak, reference = measure(fn, repeat, lambda: reference_workload(ref_lines))
+            results[f"{fn_name}/{name}"] = {
+                'cues_per_sec': round(units / elapsed, 1),
+                'mb_per_sec': round(size_mb / elapsed, 3),
+                # 基準の処理1回分の時間に何 cues 処理できるか (マシンによらず比べられる値)
+                'cues_per_ref': round(units * reference / elapsed, 1),
+                'peak_kb': round(peak / 1024, 1),
+            }
+    return results
+
+
+def dedupe_report(corpus=None):
+    """ 重複除去なし / ありで結合後のブロック数と JSON のサイズを比べる """
+    corpus = corpus or build_corpus()
+    report = {}
+    for name, (vtt, _) in corpus.items():
+        before = list(merge_cues(iter_cues(vtt, collapse_overlaps=False)))
+        after = parse_and_merge_vtt(vtt)
+        report[name] = {
+            'blocks_before': len(before),
+            'blocks_after': len(after),
+            'bytes_before': len(json.dumps(before, ensure_ascii=False).encode('utf-8')),
+            'bytes_after': len(json.dumps(after, ensure_ascii=False).encode('utf-8')),
+        }
+    return report
+
+
+def print_dedupe_report(report):
+    print(f"{'corpus':20} {'blocks':>15} {'stored bytes':>21} {'saved':>7}")
+    for name, r in report.items():
+        saved = 1 - r['bytes_after'] / r['bytes_before'] if r['bytes_before'] else 0
+        print(f"{name:20} {r['blocks_before']:>7} -> {r['blocks_after']:<5} "
+              f"{r['bytes_before']:>9} -> {r['bytes_after']:<8} {saved:>6.0%}")
+
+
+def restore_report(corpus=None):
+    """ merge_cues と文の復元で、ブロック数と confidence を比べる """
+    corpus = corpus or build_corpus()
+    report = {}
+    for name, (vtt, _) in corpus.items():
+        merged = parse_and_merge_vtt(vtt)
+        restored, confidence = restore_sentences(iter_cues(vtt), CORPUS_LANGS.get(name, 'en'))
+        report[name] = {
+            'blocks_merged': len(merged),
+            'blocks_restored': len(restored),
+            'confidence': confidence,
+        }
+    return report
+
+
+def print_restore_report(report):
+    print(f"{'corpus':20} {'blocks':>15} {'confidence':>11} {'LLM pass':>9}")
+    for name, r in report.items():
+        needs_llm = 'yes' if r['confidence'] < LLM_THRESHOLD else 'no'
+        print(f"{name:20} {r['blocks_merged']:>7} -> {r['blocks_restored']:<5} {r['confidence']:>11} {needs_llm:>9}")
+
+
+def compare(results, baseline, tolerance):
+    """ ベースラインとの比較。悪化した項目の (項目名, メッセージ) のリストを返す """
+    regressions = []
+    for key, current in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if 'cues_per_ref' not in base:
+            # cues/s しかない古いベースラインは別のマシンの値かもしれないので比べない
+            continue
+        if current['cues_per_ref'] < base['cues_per_ref'] * (1 - tolerance):
+            regressions.append(
+                (key, f"{key}: throughput {current['cues_per_ref']} cues/ref < baseline {base['cues_per_ref']}")
+            )
+        if current['peak_kb'] > base['peak_kb'] * (1 + tolerance) + MEMORY_SLACK_KB:
+            regressions.append(
+                (key, f"{key}: peak memory {current['peak_kb']} KB > baseline {base['peak_kb']}")
+            )
+    return regressions
+
+
+def print_table(results, baseline):
+    print(f"{'case':42} {'cues/s':>12} {'MB/s':>9} {'cues/ref':>10} {'peak KB':>10} {'vs base':>8}")
+    for key, r in results.items():
+        base = baseline.get(key)
+        ratio = f"{r['cues_per_ref'] / base['cues_per_ref']:.2f}x" if base and 'cues_per_ref' in base else "-"
+        print(f"{key:42} {r['cues_per_sec']:>12} {r['mb_per_sec']:>9} {r['cues_per_ref']:>10} {r['peak_kb']:>10} {ratio:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="字幕パース・結合処理のベンチマーク")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help="各ケースの実行回数 (最速値を採用, デフォルト: %(default)s)")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="ベースラインからの許容幅 (デフォルト: %(default)s)")
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help="ベースラインのパス (デフォルト: %(default)s)")
+    parser.add_argument('--confirm-runs', type=int, default=DEFAULT_CONFIRM_RUNS,
+                        help="悪化した項目を測り直す回数 (デフォルト: %(default)s)")
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="今回の結果をベースラインとして保存する")
+    args = parser.parse_args()
+
+    results = run_benchmarks(max(1, args.repeat))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    if not args.save_baseline:
+        for _ in range(args.confirm_runs):
+            regressed = {key for key, _ in compare(results, baseline, args.tolerance)}
+            if not regressed:
+                break
+            for key, r in run_benchmarks(max(1, args.repeat), only=regressed).items():
+                if r['cues_per_ref'] > results[key]['cues_per_ref']:
+                    results[key] = r
+
+    print_table(results, baseline)
+    print()
+    print_dedupe_report(dedupe_report())
+    print()
+    print_restore_report(restore_report())
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline saved: {args.baseline}")
+        return 0
+
+    if not baseline:
+        print("\nNo baseline found. Run with --save-baseline first.")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\n!!! PERFORMANCE REGRESSION !!!")
+        for _, message in regressions:
+            print(f"  {message}")
+        return 1
+
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,242 @@
+import gzip
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+# ==========================================
+# 字幕の生データ (VTT) のローカルキャッシュ
+#
+# (動画ID, 言語, トラック種別) → 圧縮済み VTT。
+# 本体は内容の SHA-256 をファイル名にして保存し (同じ内容は1つだけ)、
+# 索引と取得日時・最終アクセス日時は SQLite に持つ。
+# TTL を過ぎたものはミス扱い、合計サイズが上限を超えたら古いアクセス順 (LRU) に削除する。
+#
+# パースや結合ルールを変えただけなら、YouTube に再アクセスせずにキャッシュから作り直せる。
+# ==========================================
+
+DEFAULT_CACHE_DIR = os.environ.get('CAPTION_CACHE_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.caption_cache'
+)
+# 上限と TTL は環境変数でも変えられる (save_subtitles.py では --cache-max-mb / --cache-ttl-days)
+DEFAULT_MAX_BYTES = int(float(os.environ.get('CAPTION_CACHE_MAX_MB') or 512) * 1024 * 1024)
+DEFAULT_TTL_SEC = int(float(os.environ.get('CAPTION_CACHE_TTL_DAYS') or 30) * 24 * 3600)
+
+
+class TeeReader:
+    """ 読み込んだバイト列を sink にも書き出すラッパー (パースしながらキャッシュに保存する用) """
+
+    def __init__(self, source, sink):
+        self.source = source
+        self.sink = sink
+
+    def read(self, size=-1):
+        chunk = self.source.read(size)
+        if chunk:
+            self.sink.write(chunk)
+        return chunk
+
+
+class _CacheWriter:
+    """ 一時ファイルに gzip で書き込み、正常終了したときだけキャッシュに登録する """
+
+    def __init__(self, cache, video_id, lang, kind):
+        self.cache = cache
+        self.key = (video_id, lang, kind)
+        self.sha = hashlib.sha256()
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.root, suffix='.tmp')
+        self._raw = os.fdopen(fd, 'wb')
+        self._gz = gzip.GzipFile(fileobj=self._raw, mode='wb', mtime=0)
+        self.discarded = False
+
+    def write(self, data):
+        self.sha.update(data)
+        self._gz.write(data)
+
+    def discard(self):
+        """ 書き込んだ内容を登録しない (中身が字幕として不正だった場合など) """
+        self.discarded = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._gz.close()
+        self._raw.close()
+        if exc_type is None and not self.discarded:
+            self.cache._commit(self.key, self.sha.hexdigest(), self.tmp_path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        return False
+
+
+class CaptionCache:
+    """ 字幕の生データのキャッシュ。スレッド間・プロセス間で共有してよい """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, ttl_sec=DEFAULT_TTL_SEC):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, 'index.sqlite'), timeout=30, check_same_thread=False)
+        self._db.executescript("""
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha TEXT PRIMARY KEY,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS entries (
+            video_id TEXT NOT NULL,
+            lang TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            sha TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            PRIMARY KEY (video_id, lang, kind)
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+        """)
+        self._db.commit()
+
+    def _blob_path(self, sha):
+        return os.path.join(self.root, 'blobs', sha[:2], f"{sha}.vtt.gz")
+
+    def lookup(self, video_id, langs=None, kind=None):
+        """
+        キャッシュの索引を引く。langs (言語コードの候補) / kind が None なら条件なし。
+        複数該当する場合は最後に取得したものを返す。
+        Returns: {'video_id', 'lang', 'kind', 'sha', 'fetched_at'} / なければ None
+        """
+        entries = self.lookup_all(video_id, langs, kind)
+        return entries[0] if entries else None
+
+    def lookup_all(self, video_id, langs=None, kind=None):
+        """
+        lookup と同じ条件で、該当するものをすべて新しく取得した順に返す (呼び出し側でトラックを選ぶ用)。
+        TTL 切れ・本体のないものは削除して除く。
+        """
+        sql = "SELECT video_id, lang, kind, sha, fetched_at FROM entries WHERE video_id = ?"
+        params = [video_id]
+        if langs is not None:
+            langs = [langs] if isinstance(langs, str) else list(langs)
+            sql += f" AND lang IN ({','.join('?' * len(langs))})"
+            params.extend(langs)
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " ORDER BY fetched_at DESC"
+
+        with self._lock:
+            now = time.time()
+            entries = []
+            stale = []
+            for row in self._db.execute(sql, params).fetchall():
+                entry = dict(zip(('video_id', 'lang', 'kind', 'sha', 'fetched_at'), row))
+                key = (entry['video_id'], entry['lang'], entry['kind'])
+                if (self.ttl_sec and now - entry['fetched_at'] > self.ttl_sec) \
+                        or not os.path.exists(self._blob_path(entry['sha'])):
+                    stale.append(key)
+                else:
+                    entries.append(entry)
+            if stale:
+                self._delete_entries(stale)
+            if entries:
+                self._db.executemany(
+                    "UPDATE entries SET last_access = ? WHERE video_id = ? AND lang = ? AND kind = ?",
+                    [(now, e['video_id'], e['lang'], e['kind']) for e in entries]
+                )
+                self._db.commit()
+        return entries
+
+    def open(self, entry):
+        """ lookup の結果から、展開済み VTT を読むバイナリストリームを開く """
+        return gzip.open(self._blob_path(entry['sha']), 'rb')
+
+    def get(self, video_id, langs=None, kind=None):
+        """ 展開済み VTT のバイト列を返す。なければ None """
+        entry = self.lookup(video_id, langs, kind)
+        if entry is None:
+            return None
+        with self.open(entry) as f:
+            return f.read()
+
+    def writer(self, video_id, lang, kind):
+        """
+        キャッシュへの書き込み口。with ブロックを正常に抜けたときだけ登録される。
+            with cache.writer(vid, 'en', 'auto') as sink:
+                parse(TeeReader(resp, sink))
+        """
+        return _CacheWriter(self, video_id, lang, kind)
+
+    def put(self, video_id, lang, kind, payload):
+        with self.writer(video_id, lang, kind) as sink:
+            sink.write(payload)
+
+    def _commit(self, key, sha, tmp_path):
+        blob_path = self._blob_path(sha)
+        with self._lock:
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                shutil.move(tmp_path, blob_path)
+            size = os.path.getsize(blob_path)
+
+            now = time.time()
+            self._db.execute("INSERT OR REPLACE INTO blobs (sha, size) VALUES (?, ?)", (sha, size))
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (video_id, lang, kind, sha, fetched_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, sha, now, now)
+            )
+            # 置き換えで参照されなくなった古い本体を掃除してから上限をチェックする
+            self._delete_entries([])
+            self._evict()
+            self._db.commit()
+
+    def _delete_entries(self, keys):
+        self._db.executemany("DELETE FROM entries WHERE video_id = ? AND lang = ? AND kind = ?", keys)
+        # どのエントリからも参照されなくなった本体を消す
+        orphans = self._db.execute(
+            "SELECT sha FROM blobs WHERE sha NOT IN (SELECT sha FROM entries)"
+        ).fetchall()
+        for (sha,) in orphans:
+            try: os.remove(self._blob_path(sha))
+            except FileNotFoundError: pass
+        self._db.executemany("DELETE FROM blobs WHERE sha = ?", orphans)
+        self._db.commit()
+
+    def total_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _evict(self):
+        """ 合計サイズが上限以下になるまで、最終アクセスが古いものから削除する """
+        if not self.max_bytes:
+            return
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+
+        victims = []
+        refs = dict(self._db.execute("SELECT sha, COUNT(*) FROM entries GROUP BY sha").fetchall())
+        rows = self._db.execute(
+            "SELECT e.video_id, e.lang, e.kind, e.sha, b.size FROM entries e JOIN blobs b ON b.sha = e.sha "
+            "ORDER BY e.last_access ASC"
+        )
+        for video_id, lang, kind, sha, size in rows:
+            if total <= self.max_bytes:
+                break
+            victims.append((video_id, lang, kind))
+            refs[sha] -= 1
+            # 重複排除で共有している本体は、最後のエントリが消えたときにだけ消えて容量が空く
+            if refs[sha] == 0:
+                total -= size
+        self._delete_entries(victims)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
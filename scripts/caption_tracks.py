@@ -0,0 +1,125 @@
+import re
+
+# ==========================================
+# 字幕トラックの選択
+#
+# extract_info のメタデータだけを見て、ダウンロードする字幕を1本に絞る。
+# 優先順位:
+#   1. 手動字幕 > 自動生成字幕
+#   2. 動画の元の言語 > 翻訳 (自動翻訳トラック等)
+#   3. 教材の科目の言語 (expected_lang) に一致するもの
+#   4. lang_patterns の並び順
+# ==========================================
+
+# 科目名 (DB) → 言語コード (YouTube)
+SUBJECT_TO_LANG = {
+    'English': 'en',
+    'French': 'fr',
+    'Spanish': 'es',
+    'German': 'de',
+    'Italian': 'it',
+    'Japanese': 'ja',
+    'Korean': 'ko',
+    'Chinese': 'zh',
+}
+
+# yt-dlp は自動生成の元言語トラックを 'en-orig' のように命名する
+ORIG_SUFFIX = '-orig'
+
+
+def base_lang(lang):
+    """ 'zh-Hans' → 'zh', 'en-orig' → 'en' """
+    if not lang:
+        return None
+    return lang.split('-')[0].lower()
+
+
+def normalize_lang(lang):
+    """ 保存用の言語コード ('-orig' を外す) """
+    if lang and lang.endswith(ORIG_SUFFIX):
+        return lang[:-len(ORIG_SUFFIX)]
+    return lang
+
+
+def list_tracks(info, lang_patterns, ext='vtt'):
+    """
+    lang_patterns (yt-dlp の subtitleslangs と同じ正規表現) に合う字幕トラックを列挙する。
+    Returns: [{'lang', 'track_lang', 'kind', 'original', 'url', 'ext', 'rank'}]
+    """
+    video_lang = base_lang(info.get('language'))
+    tracks = []
+
+    for key, kind in (('subtitles', 'manual'), ('automatic_captions', 'auto')):
+        for track_lang, formats in (info.get(key) or {}).items():
+            lang = normalize_lang(track_lang)
+            pattern_index = next(
+                (i for i, p in enumerate(lang_patterns) if re.fullmatch(p, lang)), None
+            )
+            if pattern_index is None:
+                continue
+
+            fmt = next((f for f in formats if f.get('ext') == ext and f.get('url')), None)
+            if fmt is None:
+                continue
+
+            if kind == 'auto':
+                # 自動字幕は '-orig' が元音声の認識結果、それ以外は機械翻訳
+                original = track_lang.endswith(ORIG_SUFFIX) or (
+                    video_lang is not None and base_lang(lang) == video_lang
+                    and f"{track_lang}{ORIG_SUFFIX}" not in info.get(key)
+                )
+            else:
+                original = video_lang is None or base_lang(lang) == video_lang
+
+            tracks.append({
+                'lang': lang,
+                'track_lang': track_lang,
+                'kind': kind,
+                'original': original,
+                'url': fmt['url'],
+                'ext': fmt.get('ext'),
+                'rank': pattern_index,
+            })
+    return tracks
+
+
+def select_track(info, lang_patterns, expected_lang=None, ext='vtt'):
+    """ 優先順位が最も高い字幕トラックを1本選ぶ。なければ None """
+    expected = base_lang(expected_lang)
+
+    def sort_key(track):
+        return (
+            track['kind'] != 'manual',
+            not track['original'],
+            expected is not None and base_lang(track['lang']) != expected,
+            track['rank'],
+            track['track_lang'],
+        )
+
+    tracks = list_tracks(info, lang_patterns, ext)
+    if not tracks:
+        return None
+    return min(tracks, key=sort_key)
+
+
+def select_cached_track(entries, lang_patterns, expected_lang=None):
+    """
+    CaptionCache.lookup_all の結果から、select_track と同じ優先順位で1本選ぶ
+    (lookup は手動・自動を問わず最後に取得したものを返すので、優先順位が崩れる)。
+    Returns: (entry, track) / 候補がなければ None
+    """
+    # extract_info のメタデータと同じ形にして select_track に渡す (url の代わりに entries の位置を入れる)
+    info = {'subtitles': {}, 'automatic_captions': {}}
+    for i, entry in enumerate(entries):
+        key = 'subtitles' if entry['kind'] == 'manual' else 'automatic_captions'
+        info[key][entry['lang']] = [{'ext': 'vtt', 'url': str(i)}]
+    track = select_track(info, lang_patterns, expected_lang)
+    if track is None:
+        return None
+    return entries[int(track['url'])], track
+
+
+def describe_track(track):
+    """ ログ用の短い説明: 'en (manual, original)' """
+    origin = 'original' if track['original'] else 'translated'
+    return f"{track['track_lang']} ({track['kind']}, {origin})"
@@ -0,0 +1,408 @@
+import os
+import sys
+import socket
+import argparse
+import threading
+import time
+from collections import Counter
+import psycopg2
+from psycopg2.extras import execute_values
+from run_journal import SUCCESS, NO_CAPTIONS, ERROR, RETRY_BASE_SEC, RETRY_MAX_SEC
+
+# ==========================================
+# 複数マシンで字幕取得を分担するための Postgres のキューテーブル
+#
+# 動画ごとに状態 (pending / leased / done / no_captions / failed)、リースの持ち主と期限、試行回数を持つ。
+# ワーカーは FOR UPDATE SKIP LOCKED でまとめて取り出す (claim) ので、
+# 何台・何プロセスで同時に回しても同じ動画を二重に取得しない。
+# 処理中の動画のリースはバックグラウンドで延長し、
+# ワーカーが落ちてリースが切れた動画は他のワーカーが取り直す。
+#
+#   python claim_queue.py init                  # テーブル作成
+#   python claim_queue.py enqueue video_ids.txt # 動画IDを投入
+#   python claim_queue.py status                # 状態ごとの件数
+#   python claim_queue.py selftest              # ローカルの Postgres で複数ワーカーの排他を確かめる
+#   python save_subtitles.py --queue            # 各マシンで実行
+# ==========================================
+
+QUEUE_TABLE = "transcript_ingest_queue"
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+# NO_CAPTIONS は run_journal と同じ 'no_captions'
+
+DEFAULT_LEASE_SEC = 10 * 60
+DEFAULT_CLAIM_SIZE = 20
+# claim で何も取れなくても、待ち時間中の動画がこの秒数以内に取り出せるようになるなら待つ
+DEFAULT_QUEUE_WAIT_SEC = 15 * 60
+# この回数失敗したら failed にして、それ以上は取り出さない
+DEFAULT_MAX_ATTEMPTS = 8
+
+SCHEMA_SQL = f"""
+CREATE TABLE IF NOT EXISTS {QUEUE_TABLE} (
+    video_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT '{PENDING}',
+    lease_owner TEXT,
+    lease_expires_at TIMESTAMPTZ,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS {QUEUE_TABLE}_pending_idx
+    ON {QUEUE_TABLE} (available_at) WHERE state = '{PENDING}';
+CREATE INDEX IF NOT EXISTS {QUEUE_TABLE}_leased_idx
+    ON {QUEUE_TABLE} (lease_expires_at) WHERE state = '{LEASED}';
+"""
+
+ENQUEUE_SQL = f"""
+INSERT INTO {QUEUE_TABLE} (video_id) VALUES %s
+ON CONFLICT (video_id) DO NOTHING
+RETURNING video_id
+"""
+
+# 取り出せるのは、待ち時間を過ぎた pending と、リースが切れた leased
+CLAIM_SQL = f"""
+WITH picked AS (
+    SELECT video_id FROM {QUEUE_TABLE}
+    WHERE (state = '{PENDING}' AND available_at <= now())
+       OR (state = '{LEASED}' AND lease_expires_at < now())
+    ORDER BY available_at, video_id
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE {QUEUE_TABLE} AS q
+SET state = '{LEASED}',
+    lease_owner = %(owner)s,
+    lease_expires_at = now() + make_interval(secs => %(lease_sec)s),
+    attempts = q.attempts + 1,
+    updated_at = now()
+FROM picked
+WHERE q.video_id = picked.video_id
+RETURNING q.video_id
+"""
+
+RENEW_SQL = f"""
+UPDATE {QUEUE_TABLE}
+SET lease_expires_at = now() + make_interval(secs => %(lease_sec)s), updated_at = now()
+WHERE video_id = ANY(%(ids)s) AND state = '{LEASED}' AND lease_owner = %(owner)s
+RETURNING video_id
+"""
+
+FINISH_SQL = f"""
+UPDATE {QUEUE_TABLE}
+SET state = %(state)s, lease_owner = NULL, lease_expires_at = NULL,
+    last_error = %(error)s, updated_at = now()
+WHERE video_id = %(video_id)s AND lease_owner = %(owner)s
+"""
+
+# 失敗したら試行回数に応じて間隔をあけて pending に戻す (上限を超えたら failed)
+RELEASE_SQL = f"""
+UPDATE {QUEUE_TABLE}
+SET state = CASE WHEN attempts >= %(max_attempts)s THEN '{FAILED}' ELSE '{PENDING}' END,
+    lease_owner = NULL, lease_expires_at = NULL, last_error = %(error)s,
+    available_at = now() + make_interval(secs => LEAST(%(max_sec)s, %(base_sec)s * power(2, attempts - 1))),
+    updated_at = now()
+WHERE video_id = %(video_id)s AND lease_owner = %(owner)s
+"""
+
+# 中断で手放す分は試行回数に数えない
+RELEASE_HELD_SQL = f"""
+UPDATE {QUEUE_TABLE}
+SET state = '{PENDING}', lease_owner = NULL, lease_expires_at = NULL,
+    attempts = GREATEST(0, attempts - 1), last_error = %(error)s, updated_at = now()
+WHERE video_id = ANY(%(ids)s) AND lease_owner = %(owner)s
+"""
+
+STATUS_SQL = f"SELECT state, count(*) FROM {QUEUE_TABLE} GROUP BY state ORDER BY state"
+
+# claim で何も取れなかったときに残っているもの (再試行の待ち時間中 / 他のワーカーがリース中)
+BACKLOG_SQL = f"""
+SELECT count(*) FILTER (WHERE state = '{PENDING}'),
+       count(*) FILTER (WHERE state = '{LEASED}'),
+       EXTRACT(EPOCH FROM min(available_at) FILTER (WHERE state = '{PENDING}') - now())
+FROM {QUEUE_TABLE}
+WHERE state IN ('{PENDING}', '{LEASED}')
+"""
+
+SELFTEST_SCHEMA = "claim_queue_selftest"
+
+
+def default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ClaimQueue:
+    """
+    1ワーカー (プロセス) 分のキュー操作。
+    conn は autocommit で使う (claim は1文で完結するのでトランザクションは不要)。
+    record() は run_journal.RunJournal と同じ形なので、ジャーナルと同じ場所で結果を報告できる。
+    """
+
+    def __init__(self, conn, owner=None, lease_sec=DEFAULT_LEASE_SEC, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.conn = conn
+        self.owner = owner or default_owner()
+        self.lease_sec = lease_sec
+        self.max_attempts = max_attempts
+        # claim してまだ結果を報告していない動画 (リース延長の対象)
+        self.held = set()
+        self._lock = threading.Lock()
+        self._renewer = None
+        self._stop = threading.Event()
+
+    def ensure_schema(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute(SCHEMA_SQL)
+
+    def enqueue(self, video_ids):
+        """ 動画IDを投入する。既にあるものはそのまま。追加した件数を返す """
+        rows = [(vid,) for vid in dict.fromkeys(video_ids)]
+        if not rows:
+            return 0
+        with self.conn.cursor() as cursor:
+            return len(execute_values(cursor, ENQUEUE_SQL, rows, page_size=1000, fetch=True))
+
+    def claim(self, limit=DEFAULT_CLAIM_SIZE):
+        with self.conn.cursor() as cursor:
+            cursor.execute(CLAIM_SQL, {'limit': limit, 'owner': self.owner, 'lease_sec': self.lease_sec})
+            video_ids = [row[0] for row in cursor.fetchall()]
+        with self._lock:
+            self.held.update(video_ids)
+        return video_ids
+
+    def renew(self):
+        """ 保持中のリースを延長する。他のワーカーに取られていたものは held から外して返す """
+        with self._lock:
+            video_ids = list(self.held)
+        if not video_ids:
+            return []
+        with self.conn.cursor() as cursor:
+            cursor.execute(RENEW_SQL, {'ids': video_ids, 'owner': self.owner, 'lease_sec': self.lease_sec})
+            renewed = {row[0] for row in cursor.fetchall()}
+        lost = [vid for vid in video_ids if vid not in renewed]
+        if lost:
+            with self._lock:
+                self.held.difference_update(lost)
+            print(f"  [Queue] Lost lease on {len(lost)} videos")
+        return lost
+
+    def record(self, video_id, status, error=None):
+        """ 結果を反映してリースを手放す。status は run_journal の SUCCESS / NO_CAPTIONS / ERROR """
+        with self.conn.cursor() as cursor:
+            if status == ERROR:
+                cursor.execute(RELEASE_SQL, {
+                    'video_id': video_id, 'owner': self.owner, 'error': error,
+                    'max_attempts': self.max_attempts, 'base_sec': RETRY_BASE_SEC, 'max_sec': RETRY_MAX_SEC,
+                })
+            else:
+                state = DONE if status == SUCCESS else NO_CAPTIONS
+                cursor.execute(FINISH_SQL, {'video_id': video_id, 'owner': self.owner, 'state': state, 'error': error})
+        with self._lock:
+            self.held.discard(video_id)
+
+    def release_all(self, error='interrupted'):
+        """ 終了時に、結果を報告できなかった動画をすぐ取り直せるように戻す """
+        with self._lock:
+            video_ids = list(self.held)
+        if video_ids:
+            with self.conn.cursor() as cursor:
+                cursor.execute(RELEASE_HELD_SQL, {'ids': video_ids, 'owner': self.owner, 'error': error})
+        with self._lock:
+            self.held.clear()
+
+    def start_renewer(self, interval_sec=None):
+        """ リース期限の 1/3 ごとに延長するスレッドを起動する """
+        interval_sec = interval_sec or max(1, self.lease_sec // 3)
+
+        def loop():
+            while not self._stop.wait(interval_sec):
+                try:
+                    self.renew()
+                except Exception as e:
+                    print(f"  [Queue] Lease renewal failed: {e}")
+
+        self._renewer = threading.Thread(target=loop, name='lease-renewer', daemon=True)
+        self._renewer.start()
+
+    def stop_renewer(self):
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+
+    def status(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute(STATUS_SQL)
+            return dict(cursor.fetchall())
+
+    def backlog(self):
+        """
+        claim で何も取れなかったときの残り。
+        Returns: (待ち時間中の pending の件数, リース中の件数, 次の pending が取り出せるまでの秒数 / なければ None)
+        """
+        with self.conn.cursor() as cursor:
+            cursor.execute(BACKLOG_SQL)
+            waiting, leased, next_sec = cursor.fetchone()
+        return waiting, leased, float(next_sec) if next_sec is not None else None
+
+
+class QueueJournal:
+    """ 結果を RunJournal とキューの両方に報告する (save_subtitles.py --queue 用) """
+
+    def __init__(self, queue, journal):
+        self.queue = queue
+        self.journal = journal
+
+    def record(self, video_id, status, error=None):
+        self.journal.record(video_id, status, error)
+        self.queue.record(video_id, status, error)
+
+    def close(self):
+        self.journal.close()
+
+
+def selftest(dsn, workers=2, videos=500, claim_size=DEFAULT_CLAIM_SIZE):
+    """
+    ローカルの Postgres で claim の排他を確かめる (テーブルは専用のスキーマに作り、最後に消す)。
+      - workers 本の接続が同時に claim しても、同じ動画を二重に取り出さないこと
+      - リースを切らしたワーカー (途中で落ちた想定) の動画を、他のワーカーが取り直すこと
+    Returns: 問題のメッセージのリスト (空なら成功)
+    """
+    def connect():
+        conn = psycopg2.connect(dsn, options=f"-c search_path={SELFTEST_SCHEMA}")
+        conn.autocommit = True
+        return conn
+
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SELFTEST_SCHEMA} CASCADE; CREATE SCHEMA {SELFTEST_SCHEMA}")
+    conns = []
+    try:
+        setup = connect()
+        conns.append(setup)
+        queue = ClaimQueue(setup, owner='selftest-setup')
+        queue.ensure_schema()
+        video_ids = [f"selftest{i:05d}" for i in range(videos)]
+        queue.enqueue(video_ids)
+
+        # 取り出したまま結果を報告せずに落ちたワーカー
+        crashed_conn = connect()
+        conns.append(crashed_conn)
+        abandoned = ClaimQueue(crashed_conn, owner='selftest-crashed', lease_sec=1).claim(claim_size)
+
+        claims = []
+        claims_lock = threading.Lock()
+        barrier = threading.Barrier(workers)
+        errors = []
+
+        def work(index):
+            conn = connect()
+            conns.append(conn)
+            worker = ClaimQueue(conn, owner=f"selftest-{index}")
+            barrier.wait()
+            try:
+                while True:
+                    claimed = worker.claim(claim_size)
+                    if not claimed:
+                        waiting, leased, _ = worker.backlog()
+                        if not waiting and not leased:
+                            return
+                        # 落ちたワーカーのリースが切れるのを待つ
+                        time.sleep(0.2)
+                        continue
+                    with claims_lock:
+                        claims.extend((worker.owner, vid) for vid in claimed)
+                    for vid in claimed:
+                        worker.record(vid, SUCCESS)
+            except Exception as e:
+                errors.append(f"{worker.owner}: {e}")
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        problems = list(errors)
+        counts = Counter(vid for _, vid in claims)
+        duplicated = [vid for vid, n in counts.items() if n > 1]
+        if duplicated:
+            problems.append(f"{len(duplicated)} videos claimed twice (e.g. {duplicated[0]})")
+        missing = set(video_ids) - set(counts)
+        if missing:
+            problems.append(f"{len(missing)} videos never claimed")
+        if abandoned and not set(abandoned) <= set(counts):
+            problems.append("expired leases were not reclaimed")
+        per_worker = Counter(owner for owner, _ in claims)
+        if len(per_worker) < min(workers, 2):
+            problems.append(f"only {len(per_worker)} worker(s) claimed anything")
+        status = queue.status()
+        if status != {DONE: videos}:
+            problems.append(f"unexpected final states: {status}")
+        print(f"Claims per worker: {dict(per_worker)}, reclaimed after lease expiry: {len(abandoned)}")
+        return problems
+    finally:
+        for conn in conns:
+            conn.close()
+        with admin.cursor() as cursor:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SELFTEST_SCHEMA} CASCADE")
+        admin.close()
+
+
+def read_id_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read().replace(',', ' ').replace('\n', ' ')
+    return [vid.strip() for vid in content.split() if vid.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="字幕取得キュー (transcript_ingest_queue) の管理")
+    parser.add_argument('--dsn', default=os.getenv('DATABASE_URL'),
+                        help="接続文字列 (デフォルト: 環境変数 DATABASE_URL)")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('init', help="テーブルとインデックスを作成する")
+    enqueue = sub.add_parser('enqueue', help="動画IDのファイル (空白・改行・カンマ区切り) を投入する")
+    enqueue.add_argument('path')
+    sub.add_parser('status', help="状態ごとの件数を表示する")
+    test = sub.add_parser('selftest', help=f"スキーマ {SELFTEST_SCHEMA} に作ったキューで、複数ワーカーの claim を確かめる")
+    test.add_argument('--workers', type=int, default=2, help="同時に claim するワーカー数 (デフォルト: %(default)s)")
+    test.add_argument('--videos', type=int, default=500, help="投入する動画数 (デフォルト: %(default)s)")
+    args = parser.parse_args()
+
+    if not args.dsn:
+        print("Error: set DATABASE_URL or pass --dsn")
+        return 1
+
+    if args.command == 'selftest':
+        problems = selftest(args.dsn, workers=max(2, args.workers), videos=args.videos)
+        for problem in problems:
+            print(f"FAIL: {problem}")
+        if not problems:
+            print("OK")
+        return 1 if problems else 0
+
+    conn = psycopg2.connect(args.dsn)
+    conn.autocommit = True
+    queue = ClaimQueue(conn)
+    try:
+        if args.command == 'init':
+            queue.ensure_schema()
+            print(f"Table '{QUEUE_TABLE}' ready.")
+        elif args.command == 'enqueue':
+            queue.ensure_schema()
+            video_ids = read_id_file(args.path)
+            added = queue.enqueue(video_ids)
+            print(f"Enqueued {added} new videos ({len(video_ids) - added} already queued).")
+        elif args.command == 'status':
+            for state, count in queue.status().items():
+                print(f"{state:12} {count:>8}")
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,17 @@
+import os
 import sys
 import json
-import re
+import time
+import signal
+import asyncio
+import argparse
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from vtt_parser import iter_cues
+from caption_tracks import select_track, select_cached_track
+from caption_cache import CaptionCache, TeeReader
+from ydl_session import YdlSessions, new_session
 
 # yt_dlp (推奨) または youtube_dl をインポート
 try:
@@ -12,100 +23,81 @@ except ImportError:
         print(json.dumps([{"error": "yt-dlp or youtube-dl python library is not installed."}]))
         sys.exit(1)
 
-def time_to_ms(t_str):
-    """ '00:00:01.234' 形式の文字列をミリ秒に変換 """
+# 同時に取得する動画数のデフォルト (--concurrency で上書き可)
+DEFAULT_CONCURRENCY = 1
+
+# キャッシュ上で英語字幕として扱う言語コード
+CACHE_LANGS = ('en', 'en-orig')
+
+YDL_OPTS = {
+    'writesubtitles': True,
+    'writeautomaticsub': True, # 自動生成字幕も取得
+    'subtitleslangs': ['en'],  # 英語のみ対象
+    'skip_download': True,
+    'quiet': True,
+    'no_warnings': True,
+}
+
+def open_sessions():
+    """ ワーカースレッドごとに使い回す YoutubeDL (Cookie や keep-alive の接続を動画間で共有する) """
+    return YdlSessions(lambda: new_session(YoutubeDL, YDL_OPTS))
+
+def open_cache():
+    """ 字幕キャッシュを開く。使えない環境では None (キャッシュなしで動く) """
     try:
-        if '.' in t_str:
-            hms, ms = t_str.split('.')
-        else:
-            hms, ms = t_str, 0
-            
-        parts = hms.split(':')
-        h, m, s = 0, 0, 0
-        
-        if len(parts) == 3:
-            h, m, s = map(int, parts)
-        elif len(parts) == 2:
-            m, s = map(int, parts)
-            
-        return (h * 3600 + m * 60 + s) * 1000 + int(ms)
-    except:
-        return 0
-
-def parse_vtt(content):
-    """ WebVTT形式の字幕テキストをパースして辞書リストにする """
-    lines = []
-    current_start = 0
-    current_end = 0
-    
-    for line in content.split('\n'):
-        line = line.strip()
-        if '-->' in line:
-            # タイムスタンプ行: "00:00:01.000 --> 00:00:03.000 align:start ..."
-            try:
-                times = line.split(' --> ')
-                if len(times) >= 2:
-                    current_start = time_to_ms(times[0].strip())
-                    # 終了時間の後ろに設定情報がつくことがあるのでスペースで切る
-                    current_end = time_to_ms(times[1].strip().split(' ')[0])
-            except:
-                pass
-        elif line and not line.isdigit() and line != 'WEBVTT':
-            # 字幕テキスト行 (タグ除去)
-            text = re.sub(r'<[^>]+>', '', line).strip()
-            # 重複や空行を除外
-            if text and (not lines or lines[-1]['text'] != text):
-                lines.append({
-                    'text': text,
-                    'offset': current_start,
-                    'duration': max(0, current_end - current_start)
-                })
-    return lines
-
-def fetch_single_video(video_id):
-    """ 1つの動画IDの字幕を取得する """
-    ydl_opts = {
-        'writesubtitles': True,
-        'writeautomaticsub': True, # 自動生成字幕も取得
-        'subtitleslangs': ['en'],  # 英語のみ対象
-        'skip_download': True,
-        'quiet': True,
-        'no_warnings': True,
-    }
+        return CaptionCache()
+    except Exception:
+        return None
+
+def parse_cues_with_cache(stream, video_id, track, cache):
+    """ 字幕をパースしつつ、生データをキャッシュにも保存する """
+    if cache is None:
+        return list(iter_cues(stream, require_header=False))
+
+    with cache.writer(video_id, track['track_lang'], track['kind']) as sink:
+        raw_lines = list(iter_cues(TeeReader(stream, sink), require_header=False))
+        if not raw_lines:
+            sink.discard()
+    return raw_lines
+
+def read_cached_cues(video_id, cache):
+    """
+    キャッシュ済みの英語字幕をパースし直す。YouTube から取るときと同じ優先順位 (手動 > 自動) で選ぶ。
+    Returns: rawLines / キャッシュになければ None
+    """
+    selected = select_cached_track(cache.lookup_all(video_id, CACHE_LANGS), ['en'])
+    if selected is None:
+        return None
+    entry, _ = selected
+    try:
+        with cache.open(entry) as f:
+            return list(iter_cues(f, require_header=False))
+    except (OSError, EOFError):
+        # lookup と open の間に追い出された (または本体が壊れている): キャッシュミスとして YouTube から取り直す
+        return None
+
+def fetch_single_video(video_id, cache=None, sessions=None):
+    """ 1つの動画IDの字幕を取得する。sessions があればこのスレッドの YoutubeDL を使い回す """
+    # キャッシュにあれば YouTube にアクセスしない
+    raw_lines = read_cached_cues(video_id, cache) if cache is not None else None
+    if raw_lines:
+        return {'videoId': video_id, 'success': True, 'rawLines': raw_lines}
 
     try:
-        with YoutubeDL(ydl_opts) as ydl:
+        with (nullcontext(sessions.get()) if sessions is not None else new_session(YoutubeDL, YDL_OPTS)) as ydl:
             try:
                 info = ydl.extract_info(video_id, download=False)
             except Exception:
                 return {'videoId': video_id, 'success': False, 'error': 'Video not found or unavailable'}
 
-            caption_url = None
-            
-            # 1. 手動アップロード字幕 (en) を探す
-            if 'subtitles' in info and 'en' in info['subtitles']:
-                # vtt形式を優先
-                for sub in info['subtitles']['en']:
-                    if sub.get('ext') == 'vtt':
-                        caption_url = sub['url']
-                        break
-                # なければ最初に見つかったもの
-                if not caption_url and info['subtitles']['en']:
-                    caption_url = info['subtitles']['en'][0]['url']
-
-            # 2. なければ自動生成字幕 (en) を探す
-            if not caption_url and 'automatic_captions' in info and 'en' in info['automatic_captions']:
-                for sub in info['automatic_captions']['en']:
-                    if sub.get('ext') == 'vtt':
-                        caption_url = sub['url']
-                        break
-                if not caption_url and info['automatic_captions']['en']:
-                    caption_url = info['automatic_captions']['en'][0]['url']
+            # 英語の字幕トラックを1本選ぶ (手動 > 自動、元の言語 > 翻訳)
+            track = select_track(info, ['en'])
+            caption_url = track['url'] if track else None
 
             if caption_url:
-                # 字幕データをダウンロードしてパース
-                sub_content = ydl.urlopen(caption_url).read().decode('utf-8')
-                raw_lines = parse_vtt(sub_content)
+                # 字幕データをダウンロードしながらパース (全体をメモリに載せない)
+                with ydl.urlopen(caption_url) as resp:
+                    raw_lines = parse_cues_with_cache(resp, video_id, track, cache)
                 
                 if raw_lines:
                     return {'videoId': video_id, 'success': True, 'rawLines': raw_lines}
@@ -117,24 +109,222 @@ def fetch_single_video(video_id):
     except Exception as e:
         return {'videoId': video_id, 'success': False, 'error': str(e)}
 
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="YouTube の英語字幕を取得して JSON で出力する")
+    parser.add_argument('ids', nargs='*', help="動画ID (スペース・カンマ区切り)")
+    parser.add_argument('--ndjson', action='store_true',
+                        help="1動画ごとに、取得でき次第 JSON を1行ずつ出力する (完了順)")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help="同時に取得する動画数 (デフォルト: %(default)s)")
+    parser.add_argument('--serve', action='store_true',
+                        help="常駐して、標準入力から1行1リクエストの JSON を受け付ける (応答は標準出力に1行ずつ)")
+    parser.add_argument('--socket', default=None,
+                        help="--serve で標準入出力の代わりにこの Unix ソケットで待ち受ける")
+    # '-0CJxeQaZUQ' のように '-' で始まる動画IDはオプション扱いされるので、ID として拾い直す
+    args, extra = parser.parse_known_args(argv)
+    args.ids += extra
+    return args
+
+async def run_batch(video_ids, cache, concurrency, on_result, executor=None, sessions=None):
+    """
+    動画を最大 concurrency 件ずつ並列に取得し、終わったものから on_result(index, result) を呼ぶ。
+    yt-dlp はブロッキングなので、専用のスレッドプールで実行する。
+    executor / sessions を渡した場合はそれを使う (常駐モードでリクエスト間で共有する)。
+    """
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            await run_batch(video_ids, cache, concurrency, on_result, executor, sessions)
+        return
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(index, vid):
+        async with semaphore:
+            result = await loop.run_in_executor(executor, fetch_single_video, vid, cache, sessions)
+        on_result(index, result)
+
+    await asyncio.gather(*(run_one(i, vid) for i, vid in enumerate(video_ids)))
+
+def write_ndjson_line(index, result):
+    sys.stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+def split_ids(values):
+    """ 引数やリクエストの動画IDを分解する (カンマ区切りなどが混ざっていても対応できるように) """
+    if isinstance(values, str):
+        values = [values]
+    ids = []
+    for value in values:
+        ids.extend(str(value).replace(',', ' ').split())
+    return ids
+
+class SubtitleServer:
+    """
+    常駐モード (--serve)。yt-dlp の読み込みとスレッドプールを起動時に1回だけ済ませておき、
+    1行1リクエストの JSON を受け付ける。
+        リクエスト: {"id": 任意, "videoIds": ["ID1", "ID2"]}   ("videoIds" は文字列でもよい)
+        応答:       {"id": 同じ値, "results": [...], "latencyMs": 123.4}
+        失敗時:     {"id": 同じ値 (読めないリクエストなら null), "success": false, "error": "..."}
+    results は通常の実行時の出力と同じ形 (入力順)。
+    複数のリクエストは並行して処理し、終わった順に応答する (id で対応を取る)。
+    """
+
+    def __init__(self, cache, concurrency):
+        self.cache = cache
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.sessions = open_sessions()
+        self.served = 0
+
+    async def handle(self, line):
+        start = time.perf_counter()
+        request_id = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            request_id = request.get('id')
+            video_ids = split_ids(request.get('videoIds') or [])
+        except (ValueError, TypeError) as e:
+            return {'id': request_id, 'success': False, 'error': f"Invalid request: {e}"}
+
+        results = [None] * len(video_ids)
+
+        def store_result(index, result):
+            results[index] = result
+
+        try:
+            await run_batch(video_ids, self.cache, self.concurrency, store_result, self.executor, self.sessions)
+        except Exception as e:
+            # 応答を書かないとクライアントが待ち続けるので、失敗もこのリクエストの応答として返す
+            print(f"[serve] request {request_id!r} failed: {type(e).__name__}: {e}", file=sys.stderr, flush=True)
+            return {'id': request_id, 'success': False, 'error': f"{type(e).__name__}: {e}"}
+        latency_ms = round((time.perf_counter() - start) * 1000, 1)
+        self.served += 1
+        print(f"[serve] request {request.get('id')!r}: {len(video_ids)} videos in {latency_ms} ms",
+              file=sys.stderr, flush=True)
+        return {'id': request.get('id'), 'results': results, 'latencyMs': latency_ms}
+
+    async def _serve_lines(self, read_line, write_line):
+        """ read_line() が空になるまで読み、リクエストごとにタスクを立てて応答を書く """
+        tasks = set()
+
+        async def respond(line):
+            await write_line(json.dumps(await self.handle(line), ensure_ascii=False))
+
+        while True:
+            line = await read_line()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            task = asyncio.create_task(respond(line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        # 入力が閉じられても、受け付けたリクエストには応答してから終わる
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        # 標準入力の読み込みで取得用のスレッドを塞がないよう、別のスレッドで読む
+        with ThreadPoolExecutor(max_workers=1) as stdin_reader:
+            async def read_line():
+                return await loop.run_in_executor(stdin_reader, sys.stdin.readline)
+
+            async def write_line(text):
+                sys.stdout.write(text + "\n")
+                sys.stdout.flush()
+
+            print("[serve] ready (stdin)", file=sys.stderr, flush=True)
+            await self._serve_lines(read_line, write_line)
+
+    async def serve_unix(self, path):
+        async def on_connect(reader, writer):
+            async def write_line(text):
+                writer.write(text.encode('utf-8') + b"\n")
+                await writer.drain()
+
+            async def read_line():
+                # 壊れたバイト列も1つのリクエストとして扱い、Invalid request を返す
+                return (await reader.readline()).decode('utf-8', errors='replace')
+
+            try:
+                await self._serve_lines(read_line, write_line)
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        # 前回の実行で残ったソケットファイルは消してから待ち受ける
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(on_connect, path=path)
+        os.chmod(path, 0o600)
+        # SIGTERM / SIGINT で止めたときもソケットファイルを消してから終わる
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        print(f"[serve] ready ({path})", file=sys.stderr, flush=True)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.sessions.close_all()
+
 if __name__ == "__main__":
     # 引数からIDリストを取得 (スペース区切りを想定)
     # 例: python scripts/fetch_subtitles.py id1 id2 id3
-    input_ids = []
-    for arg in sys.argv[1:]:
-        # カンマ区切りなどが混ざっていても対応できるように分解
-        parts = arg.replace(',', ' ').split()
-        input_ids.extend(parts)
+    #     python scripts/fetch_subtitles.py --ndjson --concurrency 4 id1 id2 id3
+    #     python scripts/fetch_subtitles.py --serve --concurrency 4          # 常駐 (標準入出力)
+    #     python scripts/fetch_subtitles.py --serve --socket /tmp/subs.sock  # 常駐 (Unix ソケット)
+    args = parse_args(sys.argv[1:])
+
+    if args.serve:
+        server = SubtitleServer(open_cache(), max(1, args.concurrency))
+        try:
+            if args.socket:
+                asyncio.run(server.serve_unix(args.socket))
+            else:
+                asyncio.run(server.serve_stdio())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        sys.exit(0)
+
+    input_ids = split_ids(args.ids)
 
     if not input_ids:
         # IDがない場合は空リストを返す
-        print(json.dumps([]))
+        if not args.ndjson:
+            print(json.dumps([]))
         sys.exit(0)
 
-    results = []
-    for vid in input_ids:
-        result = fetch_single_video(vid)
-        results.append(result)
+    cache = open_cache()
+    concurrency = max(1, args.concurrency)
+    sessions = open_sessions()
+
+    try:
+        if args.ndjson:
+            # 1動画終わるごとに1行ずつ出力 (呼び出し側はすぐに処理を始められる)
+            asyncio.run(run_batch(input_ids, cache, concurrency, write_ndjson_line, sessions=sessions))
+        else:
+            results = [None] * len(input_ids)
+
+            def store_result(index, result):
+                results[index] = result
+
+            asyncio.run(run_batch(input_ids, cache, concurrency, store_result, sessions=sessions))
 
-    # 結果をJSON配列として標準出力に出力
-    print(json.dumps(results, ensure_ascii=False))
\ No newline at end of file
+            # 結果をJSON配列として標準出力に出力 (入力順)
+            print(json.dumps(results, ensure_ascii=False))
+    finally:
+        sessions.close_all()
@@ -0,0 +1,203 @@
+import math
+import unicodedata
+from collections import Counter
+
+# ==========================================
+# 字幕テキストのオフライン言語判定 (外部ライブラリなし)
+#
+# まず文字の種類 (ハングル / かな / 漢字 / キリル / アラビア) で決まる言語を判定し、
+# ラテン文字の言語 (en / fr / es / de / it / pt) は文字 n-gram (1〜3文字) の
+# ナイーブベイズで判定する。n-gram のプロファイルは下の SAMPLES から起動時に作る。
+#
+# 対象は fix_transcript_languages.py の SUBJECT_TO_LANG_CODES と
+# save_subtitles.py の TARGET_LANGS に出てくる言語。
+# ==========================================
+
+NGRAM_SIZES = (1, 2, 3)
+# 判定に使うのは先頭からこの文字数まで (長い講義でも一定の時間で終わる)
+MAX_CHARS = 3000
+# ラテン文字の判定で、1文字あたりの対数尤度の差がこれ未満なら自信なしとする
+MIN_MARGIN = 0.02
+# 文字の種類で判定するときに必要な割合
+SCRIPT_MIN_RATIO = 0.3
+# 文字の種類からも n-gram からも判定できない短いテキスト
+MIN_LETTERS = 20
+
+SAMPLES = {
+    'en': (
+        "so today we are going to talk about how the present perfect works in everyday conversation "
+        "and why native speakers use it when the result still matters now. I have already finished my "
+        "homework, but she has not called me back yet. Have you ever been to the mountains in winter? "
+        "The weather was really nice this morning, so we decided to walk to the station instead of "
+        "taking the bus. If you want to improve your listening, you should watch videos with subtitles "
+        "and repeat the sentences out loud. This is one of the most important things that I learned "
+        "when I was studying abroad. Thank you for watching, and don't forget to subscribe to the "
+        "channel. What do you think about it? Let me know in the comments below. They would like to "
+        "know which of these words you use the most, and whether it sounds natural to you."
+    ),
+    'fr': (
+        "aujourd'hui nous allons parler du passé composé et de la façon dont les Français l'utilisent "
+        "dans la vie de tous les jours. Je suis allé au marché ce matin et j'ai acheté des légumes pour "
+        "le dîner. Est-ce que vous avez déjà visité Paris en hiver? Il fait beau aujourd'hui, alors on "
+        "va se promener au bord de la rivière avec les enfants. Si vous voulez améliorer votre "
+        "compréhension, il faut écouter des vidéos avec des sous-titres et répéter les phrases à voix "
+        "haute. C'est une des choses les plus importantes que j'ai apprises quand j'étais étudiant à "
+        "l'étranger. Merci d'avoir regardé cette vidéo, n'oubliez pas de vous abonner à la chaîne. "
+        "Qu'est-ce que vous en pensez? Dites-le-moi dans les commentaires, parce que c'est très "
+        "intéressant pour nous de savoir quels mots vous utilisez le plus souvent."
+    ),
+    'es': (
+        "hoy vamos a hablar del pretérito perfecto y de cómo lo usan los hablantes nativos en la vida "
+        "cotidiana. Esta mañana he ido al mercado y he comprado verduras para la cena. ¿Alguna vez has "
+        "estado en las montañas en invierno? Hace buen tiempo hoy, así que vamos a pasear por el parque "
+        "con los niños. Si quieres mejorar tu comprensión, tienes que escuchar vídeos con subtítulos y "
+        "repetir las frases en voz alta. Es una de las cosas más importantes que aprendí cuando estaba "
+        "estudiando en el extranjero. Muchas gracias por ver este vídeo, y no te olvides de suscribirte "
+        "al canal. ¿Qué piensas tú? Dímelo en los comentarios, porque para nosotros es muy interesante "
+        "saber cuáles de estas palabras usas más y si te parecen naturales."
+    ),
+    'de': (
+        "heute sprechen wir über das Perfekt und darüber, wie Muttersprachler es im Alltag benutzen. "
+        "Ich bin heute Morgen auf den Markt gegangen und habe Gemüse für das Abendessen gekauft. Warst "
+        "du schon einmal im Winter in den Bergen? Das Wetter ist heute sehr schön, deshalb gehen wir mit "
+        "den Kindern im Park spazieren. Wenn du dein Hörverständnis verbessern möchtest, solltest du "
+        "Videos mit Untertiteln schauen und die Sätze laut wiederholen. Das ist eine der wichtigsten "
+        "Sachen, die ich gelernt habe, als ich im Ausland studiert habe. Vielen Dank fürs Zuschauen und "
+        "vergiss nicht, den Kanal zu abonnieren. Was denkst du darüber? Schreib es mir in die "
+        "Kommentare, weil es für uns sehr interessant ist zu wissen, welche Wörter du am meisten "
+        "benutzt und ob sie für dich natürlich klingen."
+    ),
+    'it': (
+        "oggi parliamo del passato prossimo e di come lo usano i madrelingua nella vita di tutti i "
+        "giorni. Stamattina sono andato al mercato e ho comprato la verdura per la cena. Sei mai stato "
+        "in montagna d'inverno? Oggi fa bel tempo, quindi andiamo a fare una passeggiata nel parco con "
+        "i bambini. Se vuoi migliorare la tua comprensione, devi ascoltare dei video con i sottotitoli "
+        "e ripetere le frasi ad alta voce. È una delle cose più importanti che ho imparato quando "
+        "studiavo all'estero. Grazie mille per aver guardato questo video, e non dimenticare di "
+        "iscriverti al canale. Che cosa ne pensi? Scrivimelo nei commenti, perché per noi è molto "
+        "interessante sapere quali di queste parole usi di più e se ti sembrano naturali."
+    ),
+    'pt': (
+        "hoje vamos falar sobre o pretérito perfeito e sobre como os falantes nativos o usam no dia a "
+        "dia. Hoje de manhã eu fui ao mercado e comprei legumes para o jantar. Você já esteve nas "
+        "montanhas no inverno? O tempo está muito bom hoje, então vamos passear no parque com as "
+        "crianças. Se você quer melhorar a sua compreensão, precisa assistir a vídeos com legendas e "
+        "repetir as frases em voz alta. Essa é uma das coisas mais importantes que eu aprendi quando "
+        "estava estudando no exterior. Muito obrigado por assistir a este vídeo, e não se esqueça de "
+        "se inscrever no canal. O que você acha disso? Me conte nos comentários, porque para nós é "
+        "muito interessante saber quais dessas palavras você usa mais e se elas parecem naturais."
+    ),
+}
+
+
+def _script(ch):
+    """ 文字の種類。判定に使わない文字は None """
+    code = ord(ch)
+    if 0xAC00 <= code <= 0xD7AF or 0x1100 <= code <= 0x11FF or 0x3130 <= code <= 0x318F:
+        return 'hangul'
+    if 0x3040 <= code <= 0x30FF:
+        return 'kana'
+    if 0x4E00 <= code <= 0x9FFF or 0x3400 <= code <= 0x4DBF:
+        return 'han'
+    if 0x0400 <= code <= 0x04FF:
+        return 'cyrillic'
+    if 0x0600 <= code <= 0x06FF:
+        return 'arabic'
+    if ch.isalpha() and unicodedata.name(ch, '').startswith('LATIN'):
+        return 'latin'
+    return None
+
+
+def _normalize(text):
+    """ 小文字にして、単語の境界をスペース1つで表す (n-gram が単語の先頭・末尾も拾えるように) """
+    return ' ' + ' '.join(''.join(ch if ch.isalpha() or ch == "'" else ' ' for ch in text.lower()).split()) + ' '
+
+
+def _ngrams(text):
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            if gram != ' ' * n:
+                yield gram
+
+
+class LanguageIdentifier:
+    """
+    identify(text) は (言語コード, 確信度 0〜1) を返す。判定できなければ (None, 0.0)。
+    プロファイルは最初の呼び出しで1回だけ作る。
+    """
+
+    def __init__(self, samples=SAMPLES):
+        self.samples = samples
+        self._profiles = None
+
+    def _build(self):
+        profiles = {}
+        for lang, sample in self.samples.items():
+            counts = Counter(_ngrams(_normalize(sample)))
+            total = sum(counts.values())
+            # 未知の n-gram には加算スムージングで小さな確率を与える
+            vocab = len(counts) + 1
+            profiles[lang] = ({g: math.log((c + 1) / (total + vocab)) for g, c in counts.items()},
+                              math.log(1 / (total + vocab)))
+        self._profiles = profiles
+
+    def _script_language(self, text):
+        counts = Counter(filter(None, map(_script, text)))
+        letters = sum(counts.values())
+        if letters == 0:
+            return None, 0.0, 0
+        if counts['hangul'] / letters >= SCRIPT_MIN_RATIO:
+            return 'ko', counts['hangul'] / letters, letters
+        if counts['kana'] / letters >= 0.1:
+            # 日本語は漢字とかなが混ざる。かなが少しでもまとまってあれば日本語
+            return 'ja', (counts['kana'] + counts['han']) / letters, letters
+        if counts['han'] / letters >= SCRIPT_MIN_RATIO:
+            return 'zh', counts['han'] / letters, letters
+        if counts['cyrillic'] / letters >= SCRIPT_MIN_RATIO:
+            return 'ru', counts['cyrillic'] / letters, letters
+        if counts['arabic'] / letters >= SCRIPT_MIN_RATIO:
+            return 'ar', counts['arabic'] / letters, letters
+        if counts['latin'] / letters >= SCRIPT_MIN_RATIO:
+            return 'latin', counts['latin'] / letters, letters
+        return None, 0.0, letters
+
+    def scores(self, text):
+        """ ラテン文字の各言語の、n-gram 1つあたりの平均対数尤度 """
+        if self._profiles is None:
+            self._build()
+        grams = Counter(_ngrams(_normalize(text)))
+        total = sum(grams.values()) or 1
+        return {
+            lang: sum(count * table.get(gram, unseen) for gram, count in grams.items()) / total
+            for lang, (table, unseen) in self._profiles.items()
+        }
+
+    def identify(self, text, max_chars=MAX_CHARS):
+        text = text[:max_chars]
+        lang, ratio, letters = self._script_language(text)
+        if lang != 'latin':
+            return (lang, round(ratio, 3)) if lang and letters >= MIN_LETTERS // 4 else (None, 0.0)
+        if letters < MIN_LETTERS:
+            return None, 0.0
+
+        ranked = sorted(self.scores(text).items(), key=lambda item: item[1], reverse=True)
+        (best, best_score), (_, second_score) = ranked[0], ranked[1]
+        margin = best_score - second_score
+        # 差が MIN_MARGIN で 0.5、その数倍で 1 に近づく
+        confidence = 1 - math.exp(-margin / MIN_MARGIN * math.log(2))
+        return best, round(confidence * ratio, 3)
+
+    def identify_batch(self, texts, max_chars=MAX_CHARS):
+        return [self.identify(text, max_chars) for text in texts]
+
+
+_default = LanguageIdentifier()
+
+
+def identify(text, max_chars=MAX_CHARS):
+    return _default.identify(text, max_chars)
+
+
+def identify_batch(texts, max_chars=MAX_CHARS):
+    return _default.identify_batch(texts, max_chars)
@@ -0,0 +1,21 @@
+import os
+
+from yt_dlp.extractor.youtube import YoutubeIE
+from yt_dlp.utils import ExtractorError
+
+# ==========================================
+# load_test.py 用の yt-dlp プラグイン (load_test.py が PYTHONPATH に入れたときだけ読み込まれる)
+#
+# YouTube の抽出器を上書きして、動画ページの代わりに字幕サーバーのスタンドイン
+# (環境変数 LOAD_TEST_CAPTION_SERVER) からメタデータを取る。
+# extract_info から先 (字幕の選択・ダウンロード・ファイルへの書き出し) は本番と同じ処理を通る。
+# ==========================================
+
+
+class LoadTestYoutubeIE(YoutubeIE, plugin_name='load_test'):
+    def _real_extract(self, url):
+        server = os.getenv('LOAD_TEST_CAPTION_SERVER')
+        if not server:
+            raise ExtractorError('LOAD_TEST_CAPTION_SERVER is not set', expected=True)
+        video_id = self._match_id(url)
+        return self._download_json(f"{server}/info/{video_id}", video_id)
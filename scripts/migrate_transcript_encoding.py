@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import argparse
+import psycopg2
+from psycopg2.extras import Json, execute_values
+from transcript_codec import encode_transcript, decode_transcript, FORMAT
+
+# ==========================================
+# optimized_transcripts.content を従来の配列形式から列指向形式に変換する
+# (--revert で配列形式に戻す)
+#
+#   DATABASE_URL=postgresql://... python migrate_transcript_encoding.py --dry-run
+#   DATABASE_URL=postgresql://... python migrate_transcript_encoding.py
+#
+# video_id 順にキーセットで読み、batch-size 件ずつ UPDATE してコミットするので、
+# 途中で止めてもそのまま再実行すれば続きから変換される。
+# ==========================================
+
+DEFAULT_BATCH_SIZE = 200
+
+SELECT_LEGACY_SQL = """
+SELECT video_id, content, octet_length(content::text)
+FROM optimized_transcripts
+WHERE jsonb_typeof(content) = 'array' AND video_id > %s
+ORDER BY video_id
+LIMIT %s
+"""
+
+SELECT_COLUMNAR_SQL = """
+SELECT video_id, content, octet_length(content::text)
+FROM optimized_transcripts
+WHERE jsonb_typeof(content) = 'object' AND content->>'fmt' = %s AND video_id > %s
+ORDER BY video_id
+LIMIT %s
+"""
+
+UPDATE_SQL = """
+UPDATE optimized_transcripts AS t
+SET content = v.content::jsonb
+FROM (VALUES %s) AS v (video_id, content)
+WHERE t.video_id = v.video_id
+"""
+
+# 列指向形式には text / offset / duration しか入らない
+ENCODED_KEYS = {'text', 'offset', 'duration'}
+
+
+def is_convertible(blocks):
+    """
+    情報を落とさずに変換できるか。
+    余分なキーがあるブロックは、値が空 (AI 整形経由の translation: "" など) でも変換しない
+    (列指向形式では落ちてしまい、--revert で元に戻らない)。
+    """
+    for block in blocks:
+        if not isinstance(block, dict) or not isinstance(block.get('text'), str):
+            return False
+        for key in ('offset', 'duration'):
+            value = block.get(key)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value != int(value):
+                return False
+        if block.keys() - ENCODED_KEYS:
+            return False
+    return True
+
+
+def iter_rows(cursor, revert, batch_size):
+    last_video_id = ''
+    while True:
+        if revert:
+            cursor.execute(SELECT_COLUMNAR_SQL, (FORMAT, last_video_id, batch_size))
+        else:
+            cursor.execute(SELECT_LEGACY_SQL, (last_video_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        yield rows
+        last_video_id = rows[-1][0]
+
+
+def convert(content, revert, compress):
+    if revert:
+        return decode_transcript(content)
+    if not is_convertible(content):
+        return None
+    return encode_transcript(content, compress=compress)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="optimized_transcripts.content を列指向形式に変換する")
+    parser.add_argument('--dsn', default=os.getenv('DATABASE_URL'),
+                        help="接続文字列 (デフォルト: 環境変数 DATABASE_URL)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="1回の UPDATE で変換する件数 (デフォルト: %(default)s)")
+    parser.add_argument('--compress', choices=('auto', 'always', 'never'), default='auto',
+                        help="zlib 圧縮するか (auto: 長い字幕だけ, デフォルト: %(default)s)")
+    parser.add_argument('--revert', action='store_true',
+                        help="列指向形式の行を従来の配列形式に戻す")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="書き込まずに、変換できる件数とサイズの変化だけ表示する")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.dsn:
+        print("Error: set DATABASE_URL or pass --dsn")
+        return 1
+    compress = {'auto': None, 'always': True, 'never': False}[args.compress]
+
+    conn = psycopg2.connect(args.dsn)
+    cursor = conn.cursor()
+
+    converted = 0
+    skipped = 0
+    bytes_before = 0
+    bytes_after = 0
+    try:
+        for rows in iter_rows(cursor, args.revert, max(1, args.batch_size)):
+            updates = []
+            for video_id, content, size in rows:
+                new_content = convert(content, args.revert, compress)
+                if new_content is None:
+                    print(f"  Skipped {video_id}: blocks carry extra fields")
+                    skipped += 1
+                    continue
+                encoded = json.dumps(new_content, ensure_ascii=False)
+                bytes_before += size
+                bytes_after += len(encoded.encode('utf-8'))
+                updates.append((video_id, Json(new_content)))
+
+            if updates and not args.dry_run:
+                execute_values(cursor, UPDATE_SQL, updates, page_size=len(updates))
+                conn.commit()
+            converted += len(updates)
+            print(f"Converted {converted} rows ({bytes_before / (1024 * 1024):.1f} MB -> {bytes_after / (1024 * 1024):.1f} MB)")
+    finally:
+        cursor.close()
+        conn.close()
+
+    print("\n==============================")
+    print(f"{'Would convert' if args.dry_run else 'Converted'}: {converted}")
+    print(f"Skipped: {skipped}")
+    if bytes_before:
+        print(f"Size: {bytes_before:,} -> {bytes_after:,} bytes ({bytes_after / bytes_before:.0%})")
+    print("==============================")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,425 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import unicodedata
+from array import array
+from itertools import accumulate
+from collections import defaultdict
+from transcript_codec import decode_transcript, content_digest, stored_hash_trusted, TranscriptFormatError
+
+# ==========================================
+# 全字幕の転置インデックス (単語・フレーズ検索用)
+#
+# optimized_transcripts.content のブロック (parse_and_merge_vtt で結合したもの) をトークンに分け、
+# トークン → (動画, 動画内の位置) のポスティングリストを SQLite に保存する。
+# 位置からブロック番号・開始時刻 ms へは blocks テーブル (各ブロックの先頭の位置) で引く。
+# フレーズは動画内の位置が連続するかで判定するので、ブロックをまたいでも見つかる。
+#
+#   - ラテン文字・キリル文字などは単語単位、漢字・かな・ハングルは1文字単位のトークン
+#     (日本語・中国語は単語の区切りがなく、韓国語は助詞が付くので、文字の並びで一致させる)
+#   - ポスティングは (動画, トークン) ごとに位置の差分を 16bit (収まらなければ 32bit) の配列にした BLOB
+#     (検索時の展開が C の速さで済み、1出現あたり 2バイト)
+#   - content_hash が変わった動画だけを入れ直す (--full で全件)
+#     (content_hash を空にするトリガーがない DB では、保存されたハッシュを信用せず content から計算して比べる)
+#
+#   DATABASE_URL=postgresql://... python phrase_index.py build
+#   python phrase_index.py build --corpus corpus.bin   # transcript_corpus.py で書き出したファイルから
+#   python phrase_index.py search "present perfect"
+#   python phrase_index.py search "食べました" --limit 20
+# ==========================================
+
+DEFAULT_INDEX_PATH = os.environ.get('PHRASE_INDEX_PATH') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'phrase_index.sqlite'
+)
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_LIMIT = 50
+
+# 1文字ずつトークンにする文字 (かな・漢字・ハングル・CJK互換漢字)
+CJK_CHARS = '぀-ヿ㐀-䶿一-鿿가-힯ᄀ-ᇿ㄰-㆏豈-﫿'
+TOKEN_RE = re.compile(rf"[{CJK_CHARS}]|[^\W_{CJK_CHARS}]+(?:'[^\W_{CJK_CHARS}]+)*")
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS videos (
+    doc_id INTEGER PRIMARY KEY,
+    video_id TEXT NOT NULL UNIQUE,
+    content_hash TEXT,
+    language TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    doc_id INTEGER NOT NULL,
+    block_no INTEGER NOT NULL,
+    first_pos INTEGER NOT NULL,
+    offset_ms INTEGER NOT NULL,
+    duration_ms INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (doc_id, block_no)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tokens (
+    token_id INTEGER PRIMARY KEY,
+    token TEXT NOT NULL UNIQUE,
+    df INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS postings (
+    token_id INTEGER NOT NULL,
+    doc_id INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (token_id, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+CREATE INDEX IF NOT EXISTS blocks_pos ON blocks (doc_id, first_pos);
+"""
+
+SOURCE_SQL = """
+SELECT video_id, content_hash, language FROM optimized_transcripts
+WHERE content IS NOT NULL AND video_id > %s
+ORDER BY video_id
+LIMIT %s
+"""
+
+CONTENT_SQL = "SELECT video_id, content FROM optimized_transcripts WHERE video_id = ANY(%s)"
+
+
+def tokenize(text):
+    """ 小文字・NFKC に正規化してトークンに分ける (全角英数字や半角カナもそろう) """
+    return TOKEN_RE.findall(unicodedata.normalize('NFKC', text).lower())
+
+
+def encode_positions(positions):
+    """ 位置 (昇順) → 先頭1バイトの型コード + 差分の配列 (リトルエンディアン) """
+    deltas = [b - a for a, b in zip([0, *positions], positions)]
+    typecode = 'H' if max(deltas, default=0) < 0x10000 else 'I'
+    data = array(typecode, deltas)
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return typecode.encode('ascii') + data.tobytes()
+
+
+def decode_positions(blob):
+    data = array(chr(blob[0]))
+    data.frombytes(blob[1:])
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return list(accumulate(data))
+
+
+class PhraseIndex:
+    """ SQLite の転置インデックス。書き込みは1プロセスから、検索は何プロセスからでもよい """
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA_SQL)
+        self._db.commit()
+        self._token_ids = None
+
+    def close(self):
+        self._db.close()
+
+    def indexed_hashes(self):
+        return dict(self._db.execute("SELECT video_id, content_hash FROM videos"))
+
+    def _token_id_map(self):
+        if self._token_ids is None:
+            self._token_ids = dict(self._db.execute("SELECT token, token_id FROM tokens"))
+        return self._token_ids
+
+    def _ensure_tokens(self, tokens):
+        ids = self._token_id_map()
+        new = [token for token in tokens if token not in ids]
+        if new:
+            self._db.executemany("INSERT OR IGNORE INTO tokens (token) VALUES (?)", [(t,) for t in new])
+            for start in range(0, len(new), 500):
+                chunk = new[start:start + 500]
+                ids.update(self._db.execute(
+                    f"SELECT token, token_id FROM tokens WHERE token IN ({','.join('?' * len(chunk))})", chunk
+                ))
+        return ids
+
+    def _delete_doc(self, doc_id):
+        token_ids = [row[0] for row in self._db.execute("SELECT token_id FROM postings WHERE doc_id = ?", (doc_id,))]
+        self._db.executemany("UPDATE tokens SET df = df - 1 WHERE token_id = ?", [(t,) for t in token_ids])
+        self._db.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+        self._db.execute("DELETE FROM blocks WHERE doc_id = ?", (doc_id,))
+
+    def add_video(self, video_id, blocks, content_hash=None, language=None):
+        """ 動画1本分を入れ直す (前の内容は消す)。コミットは呼び出し側で commit() する """
+        row = self._db.execute("SELECT doc_id FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+        if row is not None:
+            doc_id = row[0]
+            self._delete_doc(doc_id)
+            self._db.execute(
+                "UPDATE videos SET content_hash = ?, language = ?, indexed_at = ? WHERE doc_id = ?",
+                (content_hash, language, time.time(), doc_id)
+            )
+        else:
+            doc_id = self._db.execute(
+                "INSERT INTO videos (video_id, content_hash, language, indexed_at) VALUES (?, ?, ?, ?)",
+                (video_id, content_hash, language, time.time())
+            ).lastrowid
+
+        positions = defaultdict(list)
+        block_rows = []
+        pos = 0
+        for block_no, block in enumerate(blocks):
+            text = block.get('text') or ''
+            block_rows.append((doc_id, block_no, pos, int(block.get('offset') or 0),
+                               int(block.get('duration') or 0), text))
+            for token in tokenize(text):
+                positions[token].append(pos)
+                pos += 1
+
+        self._db.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?)", block_rows)
+        ids = self._ensure_tokens(list(positions))
+        self._db.executemany(
+            "INSERT INTO postings (token_id, doc_id, data) VALUES (?, ?, ?)",
+            [(ids[token], doc_id, encode_positions(occ)) for token, occ in positions.items()]
+        )
+        self._db.executemany("UPDATE tokens SET df = df + 1 WHERE token_id = ?",
+                             [(ids[token],) for token in positions])
+        return pos
+
+    def remove_video(self, video_id):
+        row = self._db.execute("SELECT doc_id FROM videos WHERE video_id = ?", (video_id,)).fetchone()
+        if row is not None:
+            self._delete_doc(row[0])
+            self._db.execute("DELETE FROM videos WHERE doc_id = ?", (row[0],))
+
+    def commit(self):
+        self._db.commit()
+
+    def _select_in(self, sql, ids, *params):
+        """ sql の {ids} を ? の並びにして、ids を 500 件ずつ渡して実行する """
+        ids = list(ids)
+        rows = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows.extend(self._db.execute(sql.format(ids=','.join('?' * len(chunk))), [*params, *chunk]))
+        return rows
+
+    def search(self, phrase, limit=DEFAULT_LIMIT, language=None):
+        """
+        フレーズが出てくる箇所を (video_id, 開始時刻) 順に返す。同じブロックに何度出てきても1件。
+        Returns: [{'video_id', 'block', 'offset', 'text'}]
+        """
+        query = tokenize(phrase)
+        if not query:
+            return []
+        distinct = list(dict.fromkeys(query))
+        rows = self._select_in("SELECT token, token_id, df FROM tokens WHERE token IN ({ids})", distinct)
+        if len(rows) < len(distinct) or any(df <= 0 for _, _, df in rows):
+            return []
+
+        # 出現する動画の少ないトークンから順に、候補の動画を絞り込む
+        rows.sort(key=lambda row: row[2])
+        postings = {}
+        docs = None
+        for token, token_id, _ in rows:
+            if docs is None:
+                found = self._db.execute("SELECT doc_id, data FROM postings WHERE token_id = ?", (token_id,))
+            else:
+                found = self._select_in(
+                    "SELECT doc_id, data FROM postings WHERE token_id = ? AND doc_id IN ({ids})", docs, token_id
+                )
+            postings[token] = dict(found)
+            docs = set(postings[token]) if docs is None else docs & set(postings[token])
+            if not docs:
+                return []
+
+        if language:
+            videos = self._select_in("SELECT doc_id, video_id FROM videos WHERE language LIKE ? AND doc_id IN ({ids})",
+                                     docs, f"{language}%")
+        else:
+            videos = self._select_in("SELECT doc_id, video_id FROM videos WHERE doc_id IN ({ids})", docs)
+        videos.sort(key=lambda row: row[1])
+
+        results = []
+        for doc_id, video_id in videos:
+            starts = decode_positions(postings[query[0]][doc_id])
+            if len(query) > 1:
+                others = [(i, set(decode_positions(postings[token][doc_id])))
+                          for i, token in enumerate(query) if i > 0]
+                starts = [p for p in starts if all(p + i in found for i, found in others)]
+            last_block = None
+            for pos in starts:
+                block_no, offset, text = self._db.execute(
+                    "SELECT block_no, offset_ms, text FROM blocks WHERE doc_id = ? AND first_pos <= ? "
+                    "ORDER BY first_pos DESC LIMIT 1", (doc_id, pos)
+                ).fetchone()
+                if block_no == last_block:
+                    continue
+                last_block = block_no
+                results.append({'video_id': video_id, 'block': block_no, 'offset': offset, 'text': text})
+                if len(results) >= limit:
+                    return results
+        return results
+
+    def stats(self):
+        videos, = self._db.execute("SELECT count(*) FROM videos").fetchone()
+        tokens, = self._db.execute("SELECT count(*) FROM tokens WHERE df > 0").fetchone()
+        postings, size = self._db.execute("SELECT count(*), coalesce(sum(length(data)), 0) FROM postings").fetchone()
+        return {'videos': videos, 'tokens': tokens, 'postings': postings, 'posting_bytes': size}
+
+
+def build(index, dsn, full=False, prune=False, page_size=DEFAULT_PAGE_SIZE):
+    """
+    optimized_transcripts から、content_hash が変わった (またはまだ入っていない) 動画だけを入れ直す。
+    content_hash が空の行は content を読んで計算してから比べる。
+    content_hash を空にするトリガー (transcript_codec.CONTENT_HASH_TRIGGER) がない DB では、
+    保存されたハッシュが古いかもしれないので、全行の content を読んで比べる。
+    Returns: (入れ直した件数, 変わっていなかった件数, 削除した件数)
+    """
+    # 検索だけなら psycopg2 は不要なので、ここで読み込む
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    cursor = conn.cursor()
+    indexed = index.indexed_hashes()
+    seen = set()
+    updated = unchanged = skipped = 0
+    last_video_id = ''
+    try:
+        trusted = stored_hash_trusted(cursor)
+        if not trusted and not full:
+            print("  [Index] content_hash is not kept in sync by a trigger; comparing digests of every row's content")
+        while True:
+            cursor.execute(SOURCE_SQL, (last_video_id, page_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_video_id = rows[-1][0]
+
+            languages = {}
+            targets = []
+            for video_id, digest, language in rows:
+                seen.add(video_id)
+                languages[video_id] = language
+                if full or not trusted or digest is None or indexed.get(video_id) != digest:
+                    targets.append(video_id)
+                else:
+                    unchanged += 1
+            if not targets:
+                continue
+
+            cursor.execute(CONTENT_SQL, (targets,))
+            for video_id, content in cursor.fetchall():
+                digest = content_digest(content)
+                if not full and indexed.get(video_id) == digest:
+                    unchanged += 1
+                    continue
+                try:
+                    blocks = decode_transcript(content)
+                except TranscriptFormatError:
+                    # 1つの文字列 (fix_transcript_languages.py が書き直した行) などはブロックがないので入れない
+                    blocks = None
+                if not isinstance(blocks, list):
+                    if video_id in indexed:
+                        # 前の content の索引が検索に出ないよう消す
+                        index.remove_video(video_id)
+                    skipped += 1
+                    continue
+                index.add_video(video_id, blocks, digest, languages.get(video_id))
+                updated += 1
+            index.commit()
+            print(f"  [Index] up to {last_video_id}: {updated} indexed, {unchanged} unchanged")
+    finally:
+        cursor.close()
+        conn.close()
+        if skipped:
+            print(f"  [Index] Skipped {skipped} rows whose content is not a block list")
+
+    removed = 0
+    if prune:
+        for video_id in set(indexed) - seen:
+            index.remove_video(video_id)
+            removed += 1
+        index.commit()
+    return updated, unchanged, removed
+
+
+def build_from_corpus(index, path, full=False, prune=False):
+    """ build と同じ更新を、transcript_corpus.py で書き出したファイルから行う (DB にはアクセスしない) """
+    from transcript_corpus import TranscriptCorpus
+
+    indexed = index.indexed_hashes()
+    seen = set()
+    updated = unchanged = 0
+    with TranscriptCorpus(path) as corpus:
+        for video in corpus:
+            seen.add(video.video_id)
+            if not full and video.content_hash and indexed.get(video.video_id) == video.content_hash:
+                unchanged += 1
+                continue
+            index.add_video(video.video_id, video.blocks(), video.content_hash, video.language)
+            updated += 1
+            if updated % DEFAULT_PAGE_SIZE == 0:
+                index.commit()
+        index.commit()
+
+    removed = 0
+    if prune:
+        for video_id in set(indexed) - seen:
+            index.remove_video(video_id)
+            removed += 1
+        index.commit()
+    return updated, unchanged, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="字幕の転置インデックス (フレーズ検索)")
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH, help="インデックスのパス (デフォルト: %(default)s)")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = sub.add_parser('build', help="optimized_transcripts からインデックスを更新する")
+    build_parser.add_argument('--dsn', default=os.getenv('DATABASE_URL'),
+                              help="接続文字列 (デフォルト: 環境変数 DATABASE_URL)")
+    build_parser.add_argument('--corpus', default=None,
+                              help="DB の代わりに transcript_corpus.py export で書き出したファイルから作る")
+    build_parser.add_argument('--full', action='store_true', help="変わっていない動画も入れ直す")
+    build_parser.add_argument('--prune', action='store_true', help="DB からなくなった動画をインデックスから消す")
+    build_parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                              help="1回に読み込む件数 (デフォルト: %(default)s)")
+
+    search_parser = sub.add_parser('search', help="フレーズを検索する")
+    search_parser.add_argument('phrase')
+    search_parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help="最大件数 (デフォルト: %(default)s)")
+    search_parser.add_argument('--lang', default=None, help="言語コードで絞り込む (例: en, ja)")
+
+    sub.add_parser('stats', help="インデックスの件数とサイズを表示する")
+    args = parser.parse_args()
+
+    index = PhraseIndex(args.index)
+    try:
+        if args.command == 'build':
+            start = time.perf_counter()
+            if args.corpus:
+                updated, unchanged, removed = build_from_corpus(index, args.corpus, args.full, args.prune)
+            elif args.dsn:
+                updated, unchanged, removed = build(index, args.dsn, args.full, args.prune, args.page_size)
+            else:
+                print("Error: set DATABASE_URL or pass --dsn / --corpus")
+                return 1
+            print(f"Indexed {updated} videos ({unchanged} unchanged, {removed} removed) "
+                  f"in {time.perf_counter() - start:.1f}s")
+        elif args.command == 'search':
+            start = time.perf_counter()
+            results = index.search(args.phrase, args.limit, args.lang)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            for r in results:
+                seconds = r['offset'] // 1000
+                print(f"{r['video_id']}  {seconds // 60:>4}:{seconds % 60:02d}  {r['text']}")
+            print(f"\n{len(results)} hits in {elapsed_ms:.1f} ms")
+        elif args.command == 'stats':
+            for key, value in index.stats().items():
+                print(f"{key:14} {value:>12}")
+    finally:
+        index.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
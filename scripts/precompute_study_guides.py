@@ -0,0 +1,486 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2
+from psycopg2.extras import Json, execute_values
+from rate_limit import AdaptiveRateLimiter
+from caption_tracks import SUBJECT_TO_LANG, base_lang
+from transcript_codec import content_to_text, content_digest
+
+# ==========================================
+# video_study_guides の事前生成 (バッチ)
+#
+# optimized_transcripts のうち、学習ガイドがまだない (または字幕が変わって古くなった) 動画を探し、
+# LLM で並列に生成してまとめて書き戻す。閲覧時に生成を待たせないよう、全動画分を先に作っておく。
+#
+#   - 生成結果は (字幕の content_hash, 解説言語, 参照ガイド, プロンプト版, モデル) をキーに
+#     ローカルの SQLite にキャッシュするので、字幕が変わっていない動画は二度と生成しない
+#   - LLM へのリクエストは rate_limit.AdaptiveRateLimiter で制限する (429 でバックオフ)
+#   - LLM クライアントは差し替えられる (--llm stub で API を呼ばずに全体の流れを試せる)
+#
+#   DATABASE_URL=postgresql://... python precompute_study_guides.py --llm stub --dry-run
+#   DATABASE_URL=postgresql://... python precompute_study_guides.py --explanation-lang Japanese --explanation-lang English
+# ==========================================
+
+GUIDE_TABLE = "video_study_guides"
+
+# 生成する解説言語 (--explanation-lang で上書き可。app/api/study_guide/generate と同じ既定値)
+DEFAULT_EXPLANATION_LANGS = ['Japanese']
+
+# プロンプトや出力の形を変えたら上げる (キャッシュのキーに入る)
+PROMPT_VERSION = 1
+# LLM に渡す字幕の文字数 (API ルートと同じ)
+TRANSCRIPT_CHARS = 30000
+
+DEFAULT_WORKERS = 4
+DEFAULT_RPS = 1.0
+DEFAULT_MIN_RPS = 0.1
+DEFAULT_MAX_RPS = 4.0
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_MODEL = 'gemini-2.5-flash'
+
+DEFAULT_CACHE_DIR = os.environ.get('STUDY_GUIDE_CACHE_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '.guide_cache'
+)
+
+GUIDE_KEYS = ('title', 'summary', 'key_sentences', 'vocabulary', 'grammar', 'quiz')
+
+# 言語コード → 科目名 (プロンプトの Target Language)
+LANG_TO_SUBJECT = {lang: subject for subject, lang in SUBJECT_TO_LANG.items()}
+
+SCHEMA_SQL = f"""
+ALTER TABLE {GUIDE_TABLE}
+    ADD COLUMN IF NOT EXISTS explanation_lang TEXT,
+    ADD COLUMN IF NOT EXISTS source_hash TEXT,
+    ADD COLUMN IF NOT EXISTS generated_by TEXT,
+    ADD COLUMN IF NOT EXISTS generated_at TIMESTAMPTZ;
+CREATE UNIQUE INDEX IF NOT EXISTS {GUIDE_TABLE}_video_lang_idx
+    ON {GUIDE_TABLE} (video_id, explanation_lang);
+"""
+
+# ガイドがない動画と、生成元の字幕のハッシュが今の字幕と違う動画 (source_hash のない既存のガイドは古いとは見なさない)
+# content_hash が空の行 (古い行や、アプリ側で本文を書き換えた行) は SQL では比べられないので候補として返し、
+# iter_pending が content から計算したハッシュで比べ直す
+# ref_* は同じ動画の別の解説言語のガイド (あれば同じ例文・単語・文法項目で作らせる)
+PENDING_SQL = f"""
+SELECT t.video_id, t.content, t.language, t.content_hash, g.source_hash,
+       ref.key_sentences, ref.vocabulary, ref.grammar
+FROM optimized_transcripts AS t
+LEFT JOIN {GUIDE_TABLE} AS g
+    ON g.video_id = t.video_id AND g.explanation_lang = %(lang)s
+LEFT JOIN LATERAL (
+    SELECT key_sentences, vocabulary, grammar FROM {GUIDE_TABLE} AS r
+    WHERE r.video_id = t.video_id AND r.explanation_lang IS DISTINCT FROM %(lang)s
+    ORDER BY r.created_at
+    LIMIT 1
+) AS ref ON TRUE
+WHERE t.content IS NOT NULL AND t.video_id > %(after)s
+  AND (g.video_id IS NULL
+       OR (%(stale)s AND g.source_hash IS NOT NULL
+           AND (t.content_hash IS NULL OR g.source_hash <> t.content_hash)))
+ORDER BY t.video_id
+LIMIT %(limit)s
+"""
+
+UPSERT_SQL = f"""
+INSERT INTO {GUIDE_TABLE}
+    (video_id, explanation_lang, title, summary, key_sentences, vocabulary, grammar, quiz,
+     source_hash, generated_by, generated_at)
+VALUES %s
+ON CONFLICT (video_id, explanation_lang)
+DO UPDATE SET
+    title = EXCLUDED.title,
+    summary = EXCLUDED.summary,
+    key_sentences = EXCLUDED.key_sentences,
+    vocabulary = EXCLUDED.vocabulary,
+    grammar = EXCLUDED.grammar,
+    quiz = EXCLUDED.quiz,
+    source_hash = EXCLUDED.source_hash,
+    generated_by = EXCLUDED.generated_by,
+    generated_at = EXCLUDED.generated_at;
+"""
+UPSERT_TEMPLATE = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, now())"
+
+GUIDE_FORMAT = """
+Output JSON format:
+{{
+    "title": "A catchy title for this lesson",
+    "summary": "A 3-sentence summary of the video content in {lang}.",
+    "key_sentences": [
+        {{ "sentence": "{sentence}", "translation": "Translation in {lang}", "explanation": "Explanation in {lang}" }}
+    ],
+    "vocabulary": [
+        {{ "word": "{word}", "meaning": "Meaning in {lang}", "context": "Example usage" }}
+    ],
+    "grammar": [
+        {{ "point": "{point}", "explanation": "Explanation in {lang}" }}
+    ],
+    "quiz": [
+        {{ "question": "Question about the video content (in Target Language)", "options": ["A", "B", "C", "D"], "answer": "Correct Option (e.g. A)" }}
+    ]
+}}
+"""
+
+
+class GuideError(ValueError):
+    """ LLM の出力が学習ガイドとして使えない """
+
+
+def build_prompt(text, subject, explanation_lang, reference=None):
+    """ app/api/study_guide/generate/route.ts と同じプロンプト (reference があれば項目をそろえる版) """
+    header = f"""
+You are a language teacher creating a study guide for a video.
+Target Language (Video Language): {subject}
+Explanation Language: {explanation_lang}
+
+Analyze the following transcript and create a comprehensive study guide.
+
+Transcript:
+{text[:TRANSCRIPT_CHARS]}... (truncated if too long)
+"""
+    if reference:
+        sentences = '\n'.join(s.get('sentence', '') for s in reference['key_sentences'] or [])
+        vocab = '\n'.join(v.get('word', '') for v in reference['vocabulary'] or [])
+        grammar = '\n'.join(g.get('point', '') for g in reference['grammar'] or [])
+        return header + f"""
+IMPORTANT: You MUST use the following EXACT items for consistency with other language guides.
+
+Required Key Sentences (Translate and Explain these):
+{sentences}
+
+Required Vocabulary (Define these):
+{vocab}
+
+Required Grammar Points (Explain these):
+{grammar}
+""" + GUIDE_FORMAT.format(
+            lang=explanation_lang, sentence="Original sentence (MUST MATCH REQUIRED)",
+            word="Word (MUST MATCH REQUIRED)", point="Grammar point (MUST MATCH REQUIRED)",
+        ) + f"""
+Requirements:
+1. "key_sentences": Use the EXACT sentences provided above. Provide translation and explanation in {explanation_lang}.
+2. "vocabulary": Use the EXACT words provided above. Provide meaning in {explanation_lang}.
+3. "grammar": Use the EXACT grammar points provided above. Provide explanation in {explanation_lang}.
+4. "quiz": Create 3 comprehension questions.
+5. Output ONLY the JSON.
+"""
+    return header + GUIDE_FORMAT.format(
+        lang=explanation_lang, sentence="Original sentence in Target Language",
+        word="Word in Target Language", point="Grammar point",
+    ) + f"""
+Requirements:
+1. "key_sentences": Pick 3-5 most useful sentences. The "sentence" MUST be in the Target Language. The "explanation" MUST be in {explanation_lang}.
+2. "vocabulary": Pick 5-10 difficult/useful words.
+3. "grammar": Pick 2-3 grammar points used in the video.
+4. "quiz": Create 3 comprehension questions.
+5. Output ONLY the JSON.
+"""
+
+
+def parse_guide(text):
+    """ LLM の出力 (コードフェンス付きでもよい) を学習ガイドの dict にする """
+    try:
+        data = json.loads(re.sub(r'```json|```', '', text).strip())
+    except json.JSONDecodeError as e:
+        raise GuideError(f"Invalid JSON from LLM: {e}") from e
+    if not isinstance(data, dict):
+        raise GuideError("LLM output is not a JSON object")
+    missing = [key for key in GUIDE_KEYS if key not in data]
+    if missing:
+        raise GuideError(f"LLM output is missing {', '.join(missing)}")
+    return {key: data[key] for key in GUIDE_KEYS}
+
+
+class GeminiClient:
+    """ Gemini (google-generativeai) で生成する。complete(prompt) は JSON の文字列を返す """
+
+    def __init__(self, model=DEFAULT_MODEL, api_key=None):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key or os.getenv('GOOGLE_GEMINI_KEY'))
+        self.name = f"gemini:{model}"
+        self._model = genai.GenerativeModel(model, generation_config={'response_mime_type': 'application/json'})
+
+    def complete(self, prompt):
+        return self._model.generate_content(prompt).text
+
+
+class StubClient:
+    """
+    API を呼ばないローカルのクライアント (動作確認・負荷試験用)。
+    プロンプトの字幕から、決まった手順で形だけ整ったガイドを作る。
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency_sec=0.0):
+        self.latency_sec = latency_sec
+
+    def complete(self, prompt):
+        if self.latency_sec:
+            time.sleep(self.latency_sec)
+        match = re.search(r'Transcript:\n(.*?)\.\.\. \(truncated if too long\)', prompt, re.S)
+        text = match.group(1) if match else ''
+        sentences = [s.strip() for s in re.split(r'(?<=[.?!。？！])\s*', text) if s.strip()][:5]
+        words = sorted({w.strip('.,?!"') for w in text.split() if len(w) > 6}, key=lambda w: (-len(w), w))[:8]
+        return json.dumps({
+            'title': sentences[0][:60] if sentences else 'Study guide',
+            'summary': ' '.join(sentences[:3]),
+            'key_sentences': [{'sentence': s, 'translation': '', 'explanation': ''} for s in sentences],
+            'vocabulary': [{'word': w, 'meaning': '', 'context': ''} for w in words],
+            'grammar': [],
+            'quiz': [],
+        }, ensure_ascii=False)
+
+
+def make_client(kind, model=DEFAULT_MODEL):
+    if kind == 'stub':
+        return StubClient()
+    return GeminiClient(model)
+
+
+class GuideCache:
+    """ 生成結果のキャッシュ (キー → ガイドの JSON)。スレッド間で共有してよい """
+
+    def __init__(self, root=DEFAULT_CACHE_DIR):
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, 'guides.sqlite'), timeout=30, check_same_thread=False)
+        self._db.execute("""
+        CREATE TABLE IF NOT EXISTS guides (
+            key TEXT PRIMARY KEY,
+            guide TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+        """)
+        self._db.commit()
+
+    @staticmethod
+    def make_key(source_hash, explanation_lang, subject, reference, generated_by):
+        payload = json.dumps([source_hash, explanation_lang, subject, reference, PROMPT_VERSION, generated_by],
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT guide FROM guides WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, guide):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO guides (key, guide, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(guide, ensure_ascii=False), time.time())
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class GuideBatchWriter:
+    """ 生成したガイドをためておき、複数行の INSERT ... ON CONFLICT でまとめて書き込む """
+
+    def __init__(self, cursor, batch_size=DEFAULT_BATCH_SIZE):
+        self.cursor = cursor
+        self.batch_size = max(1, batch_size)
+        self.pending = {}
+        self.written = 0
+        self.failed = []
+
+    def add(self, video_id, explanation_lang, guide, source_hash, generated_by):
+        self.pending[(video_id, explanation_lang)] = (
+            video_id, explanation_lang, guide['title'], guide['summary'],
+            Json(guide['key_sentences']), Json(guide['vocabulary']), Json(guide['grammar']), Json(guide['quiz']),
+            source_hash, generated_by,
+        )
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        rows, self.pending = list(self.pending.values()), {}
+        if not rows:
+            return
+        try:
+            execute_values(self.cursor, UPSERT_SQL, rows, template=UPSERT_TEMPLATE, page_size=len(rows))
+            self.written += len(rows)
+        except Exception as e:
+            # まとめて失敗した場合は1行ずつ書き直して、失敗した行だけを特定する
+            print(f"  [DB] Batch of {len(rows)} failed ({e}). Retrying row by row...")
+            for row in rows:
+                try:
+                    execute_values(self.cursor, UPSERT_SQL, [row], template=UPSERT_TEMPLATE)
+                    self.written += 1
+                except Exception as row_error:
+                    print(f"  [DB Error] {row[0]} ({row[1]}): {row_error}")
+                    self.failed.append((row[0], row[1]))
+
+
+def iter_pending(cursor, explanation_lang, stale=True, page_size=DEFAULT_PAGE_SIZE):
+    """ ガイドを作る必要のある動画を video_id 順にページ単位で返す """
+    last_video_id = ''
+    while True:
+        cursor.execute(PENDING_SQL, {'lang': explanation_lang, 'stale': stale, 'after': last_video_id,
+                                     'limit': page_size})
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        page = []
+        for video_id, content, language, digest, guide_hash, ref_sentences, ref_vocab, ref_grammar in rows:
+            source_hash = digest or content_digest(content)
+            if guide_hash is not None and guide_hash == source_hash:
+                # content_hash が空なだけで、ガイドを作った時と同じ字幕
+                continue
+            reference = None
+            if ref_sentences or ref_vocab or ref_grammar:
+                reference = {'key_sentences': ref_sentences, 'vocabulary': ref_vocab, 'grammar': ref_grammar}
+            page.append({
+                'video_id': video_id,
+                'content': content,
+                'subject': LANG_TO_SUBJECT.get(base_lang(language), language or 'English'),
+                'source_hash': source_hash,
+                'reference': reference,
+            })
+        if page:
+            yield page
+        last_video_id = rows[-1][0]
+
+
+def generate_guide(client, limiter, item, explanation_lang):
+    prompt = build_prompt(content_to_text(item['content']), item['subject'], explanation_lang, item['reference'])
+    limiter.acquire()
+    try:
+        text = client.complete(prompt)
+    except Exception as e:
+        limiter.report(e)
+        raise
+    limiter.report()
+    return parse_guide(text)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="video_study_guides を事前に生成する")
+    parser.add_argument('--dsn', default=os.getenv('DATABASE_URL'),
+                        help="接続文字列 (デフォルト: 環境変数 DATABASE_URL)")
+    parser.add_argument('--explanation-lang', action='append', dest='explanation_langs',
+                        help="解説言語 (複数指定可, デフォルト: %s)" % ', '.join(DEFAULT_EXPLANATION_LANGS))
+    parser.add_argument('--llm', choices=('gemini', 'stub'), default='gemini',
+                        help="LLM クライアント (stub は API を呼ばない, デフォルト: %(default)s)")
+    parser.add_argument('--model', default=DEFAULT_MODEL, help="Gemini のモデル (デフォルト: %(default)s)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="並列に生成する数 (デフォルト: %(default)s)")
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                        help="開始時の1秒あたりリクエスト数 (デフォルト: %(default)s)")
+    parser.add_argument('--min-rps', type=float, default=DEFAULT_MIN_RPS,
+                        help="スロットリング時に下げる下限 (デフォルト: %(default)s)")
+    parser.add_argument('--max-rps', type=float, default=DEFAULT_MAX_RPS,
+                        help="成功が続いたときに上げる上限 (デフォルト: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="DBにまとめて書き込む件数 (デフォルト: %(default)s)")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help="1回に読み込む字幕の件数 (デフォルト: %(default)s)")
+    parser.add_argument('--limit', type=int, default=None, help="生成する件数の上限 (解説言語ごと)")
+    parser.add_argument('--missing-only', action='store_true',
+                        help="ガイドのない動画だけを対象にする (字幕が変わった動画は作り直さない)")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="生成結果のキャッシュの場所 (デフォルト: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true', help="生成結果のキャッシュを使わない")
+    parser.add_argument('--dry-run', action='store_true', help="対象の件数だけを表示する")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not args.dsn:
+        print("Error: set DATABASE_URL or pass --dsn")
+        return 1
+    explanation_langs = args.explanation_langs or DEFAULT_EXPLANATION_LANGS
+
+    conn = psycopg2.connect(args.dsn)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(SCHEMA_SQL)
+
+    if args.dry_run:
+        for explanation_lang in explanation_langs:
+            total = sum(len(page) for page in iter_pending(cursor, explanation_lang, not args.missing_only,
+                                                            args.page_size))
+            print(f"{explanation_lang}: {total} guides to generate")
+        cursor.close()
+        conn.close()
+        return 0
+
+    client = make_client(args.llm, args.model)
+    limiter = AdaptiveRateLimiter(args.rps, args.min_rps, args.max_rps)
+    cache = None if args.no_cache else GuideCache(args.cache_dir)
+    writer = GuideBatchWriter(cursor, args.batch_size)
+    generated = cached = errors = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            # 解説言語ごとに順に作る (先に書き込んだ言語のガイドが、次の言語の参照になる)
+            for explanation_lang in explanation_langs:
+                done = 0
+                for page in iter_pending(cursor, explanation_lang, not args.missing_only, args.page_size):
+                    if args.limit is not None:
+                        page = page[:max(0, args.limit - done)]
+                        if not page:
+                            break
+                    done += len(page)
+
+                    futures = {}
+                    for item in page:
+                        key = GuideCache.make_key(item['source_hash'], explanation_lang, item['subject'],
+                                                  item['reference'], client.name)
+                        guide = cache.get(key) if cache is not None else None
+                        if guide is not None:
+                            # 同じ字幕から作ったことがある: LLM は呼ばない
+                            writer.add(item['video_id'], explanation_lang, guide, item['source_hash'], client.name)
+                            cached += 1
+                            continue
+                        future = executor.submit(generate_guide, client, limiter, item, explanation_lang)
+                        futures[future] = (item, key)
+
+                    for future in as_completed(futures):
+                        item, key = futures[future]
+                        try:
+                            guide = future.result()
+                        except Exception as e:
+                            print(f"  [Error] {item['video_id']} ({explanation_lang}): {str(e)[:100]}")
+                            errors += 1
+                            continue
+                        if cache is not None:
+                            cache.put(key, guide)
+                        writer.add(item['video_id'], explanation_lang, guide, item['source_hash'], client.name)
+                        generated += 1
+                        print(f"  [Generated] {item['video_id']} ({explanation_lang})")
+                    writer.flush()
+    finally:
+        # 途中で中断しても、生成済みの分は書き込んでから終了する
+        writer.flush()
+        if cache is not None:
+            cache.close()
+        cursor.close()
+        conn.close()
+
+    print("\n==============================")
+    print(f"Generated: {generated}")
+    print(f"From cache: {cached}")
+    print(f"Written: {writer.written}")
+    if writer.failed:
+        print(f"DB Errors: {len(writer.failed)}")
+    print(f"LLM Errors: {errors}")
+    print("==============================")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import random
+import threading
+import time
+from collections import deque
+
+# ==========================================
+# YouTube へのアクセス間隔の制御 (save_subtitles.py / fix_transcript_languages.py 共通)
+#
+# トークンバケットでリクエストの開始を制限し、
+#   - 成功が続く間は少しずつレートを上げる (加算的増加)
+#   - 429 や "Sign in to confirm you're not a bot" が返ったらレートを半分にし、
+#     ジッター付きの指数バックオフで全ワーカーを一時停止する (乗算的減少)
+#   - 直近の失敗率が高すぎるときはサーキットブレーカーで実行全体をしばらく止める
+# ==========================================
+
+# スロットリングと見なすエラーメッセージ / 例外クラス名 (小文字で比較)
+THROTTLE_MARKERS = (
+    '429',
+    'too many requests',
+    'sign in to confirm',
+    'toomanyrequests',
+    'requestblocked',
+    'ipblocked',
+)
+
+# スロットリング時の全体停止 (秒)
+BACKOFF_BASE_SEC = 30
+BACKOFF_MAX_SEC = 15 * 60
+
+
+def is_throttle_error(error):
+    """ 例外 (またはエラーメッセージ) が YouTube 側のレート制限によるものか """
+    if isinstance(error, BaseException):
+        text = f"{type(error).__name__}: {error}"
+    else:
+        text = str(error)
+    text = text.lower()
+    return any(marker in text for marker in THROTTLE_MARKERS)
+
+
+class CircuitBreaker:
+    """ 直近 window 件のうち失敗が failure_ratio 以上になったら cooldown 秒止める """
+
+    def __init__(self, window=20, min_samples=10, failure_ratio=0.5, cooldown_sec=300):
+        self.results = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.failure_ratio = failure_ratio
+        self.cooldown_sec = cooldown_sec
+        self.open_until = 0.0
+
+    def record(self, ok):
+        self.results.append(ok)
+        if len(self.results) < self.min_samples:
+            return
+        failures = self.results.count(False)
+        if failures / len(self.results) >= self.failure_ratio:
+            self.open_until = time.monotonic() + self.cooldown_sec
+            self.results.clear()
+            print(f"  [Circuit] {failures} recent failures. Pausing all requests for {self.cooldown_sec}s.")
+
+
+class AdaptiveRateLimiter:
+    """
+    複数スレッドで共有するトークンバケット。
+    acquire() でリクエストの枠を取り、結果を on_success / on_throttle / on_failure で報告する。
+    min_rate == max_rate にすれば固定レートとして使える。
+    """
+
+    def __init__(self, rate, min_rate=None, max_rate=None, increase=0.05, decrease=0.5,
+                 burst=1.0, jitter=0.5, breaker=None):
+        # rate: 開始時の1秒あたりリクエスト数 (0以下なら無制限)
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate
+        self.max_rate = max_rate if max_rate is not None else rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        # jitter: 待ち時間を最大この割合だけランダムに延ばす (一定間隔のアクセスを避ける)
+        self.jitter = jitter
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+        self._lock = threading.Lock()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._throttle_streak = 0
+
+    def acquire(self):
+        """ 枠が空くまで (バックオフ中・ブレーカー作動中はその間も) ブロックする """
+        if self.rate is None or self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                pause = max(self._paused_until, self.breaker.open_until) - now
+                if pause <= 0:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate * random.uniform(1, 1 + self.jitter)
+                else:
+                    wait = pause
+            time.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self._throttle_streak = 0
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            self.breaker.record(True)
+
+    def on_throttle(self):
+        with self._lock:
+            self._throttle_streak += 1
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            backoff = min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC * 2 ** (self._throttle_streak - 1))
+            backoff *= random.uniform(0.5, 1.5)
+            self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+            self.breaker.record(False)
+        print(f"  [RateLimit] Throttled. Backing off {backoff:.0f}s, rate -> {self.rate:.2f}/s")
+
+    def on_failure(self):
+        """ スロットリング以外の失敗 (レートは変えず、ブレーカーにだけ数える) """
+        with self._lock:
+            self.breaker.record(False)
+
+    def report(self, error=None):
+        """ 結果をまとめて報告する。error が None なら成功 """
+        if error is None:
+            self.on_success()
+        elif is_throttle_error(error):
+            self.on_throttle()
+        else:
+            self.on_failure()
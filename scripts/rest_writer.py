@@ -0,0 +1,172 @@
+# ==========================================
+# Supabase クライアント (REST) 経由の書き込みをまとめるバッファ
+# (fix_transcript_languages.py / save_to_supabase.py 共通)
+#
+# 1行ごとに upsert すると毎回 HTTP の往復が発生するので、
+# batch_size 行たまるごとに1回の一括 upsert で送る。
+# 一括で失敗したときは1行ずつ送り直し、どの行が失敗したかを報告する。
+# with 文で使えば、途中で例外が起きても残りを書き込んでから抜ける。
+#
+# 既存の行を書き換えるだけのスクリプトは BulkUpdater を使う。
+# upsert は行が無ければ作るので、RLS の下では UPDATE に加えて INSERT のポリシーも要り、
+# 消えた video_id の行を作り直してしまう。update なら UPDATE のポリシー
+# (と、更新した行を確かめるための SELECT のポリシー) だけで済み、行は作られない。
+#
+# PostgREST の update は1回に1組の値しか送れないので、値が行ごとに違う行 (本文など) を
+# まとめて書くには、バッチを jsonb の配列で受け取って UPDATE ... FROM jsonb_array_elements で
+# 書き換える SQL 関数を用意し、rpc= にその名前を渡す (バッチごとに1回の呼び出し)。
+# 関数は SECURITY INVOKER (デフォルト) のままにして、update と同じ RLS のポリシーで動かす。
+# 関数の例は fix_transcript_languages.py --print-sql を参照。
+# ==========================================
+
+import json
+
+DEFAULT_BATCH_SIZE = 100
+
+
+class BulkUpserter:
+    """
+    rows を table に一括 upsert する。
+    key_column の値が同じ行は、1回の upsert に2回入らないよう後から来た方で上書きする。
+    on_result(key, error) は行ごとに書き込み後に呼ばれる (成功なら error は None)。
+    """
+
+    def __init__(self, client, table, key_column, batch_size=DEFAULT_BATCH_SIZE, on_conflict=None, on_result=None):
+        self.client = client
+        self.table = table
+        self.key_column = key_column
+        self.batch_size = max(1, batch_size)
+        self.on_conflict = on_conflict
+        self.on_result = on_result
+        self.pending = {}
+        self.written = 0
+        self.failed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        return False
+
+    def add(self, row):
+        self.pending[row[self.key_column]] = row
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _upsert(self, rows):
+        options = {'on_conflict': self.on_conflict} if self.on_conflict else {}
+        self.client.table(self.table).upsert(rows, **options).execute()
+
+    def flush(self):
+        if not self.pending:
+            return
+        rows = list(self.pending.values())
+        self.pending = {}
+        try:
+            self._upsert(rows)
+            self.written += len(rows)
+            for row in rows:
+                self._report(row, None)
+        except Exception as e:
+            # まとめて失敗した場合は1行ずつ書き直して、失敗した行だけを特定する
+            print(f"  [DB] Bulk upsert of {len(rows)} rows into {self.table} failed ({e}). Retrying row by row...")
+            for row in rows:
+                try:
+                    self._upsert([row])
+                    self.written += 1
+                    self._report(row, None)
+                except Exception as row_error:
+                    print(f"  [DB Error] {row[self.key_column]}: {row_error}")
+                    self.failed.append((row[self.key_column], row_error))
+                    self._report(row, row_error)
+
+    def _report(self, row, error):
+        if self.on_result is not None:
+            self.on_result(row[self.key_column], error)
+
+
+class BulkUpdater(BulkUpserter):
+    """
+    BulkUpserter と同じ使い方で、既存の行だけを update する (行は作らない)。
+    rpc を指定すると、バッチ全体を {'batch': rows} としてその関数に1回で渡す
+    (関数は更新した行の key_column を返す)。関数の呼び出しが失敗したときと rpc がないときは、
+    key_column 以外の値がまったく同じ行を in_ でまとめて1回の update にし、
+    値が行ごとに違う行 (本文など) は1行ずつ update する。
+    該当する行が無かったものは LookupError として on_result に報告する。
+    """
+
+    def __init__(self, client, table, key_column, batch_size=DEFAULT_BATCH_SIZE, on_result=None, rpc=None):
+        super().__init__(client, table, key_column, batch_size, on_result=on_result)
+        self.rpc = rpc
+
+    def _update(self, values, keys):
+        query = self.client.table(self.table).update(values)
+        if len(keys) == 1:
+            query = query.eq(self.key_column, keys[0])
+        else:
+            query = query.in_(self.key_column, keys)
+        # 更新できた行のキーだけを返してもらう
+        response = query.select(self.key_column).execute()
+        return {row[self.key_column] for row in response.data}
+
+    def _update_group(self, values, keys):
+        """ 値が同じ行をまとめて update し、{key: error (成功なら None)} を返す """
+        errors = {}
+        try:
+            updated = self._update(values, keys)
+        except Exception as e:
+            if len(keys) == 1:
+                return {keys[0]: e}
+            print(f"  [DB] Bulk update of {len(keys)} rows in {self.table} failed ({e}). Retrying row by row...")
+            updated = set()
+            for key in keys:
+                try:
+                    updated |= self._update(values, [key])
+                except Exception as row_error:
+                    errors[key] = row_error
+        for key in keys:
+            if key not in errors and key not in updated:
+                errors[key] = LookupError(f"no {self.table} row with {self.key_column}={key}")
+        return {key: errors.get(key) for key in keys}
+
+    def _update_batch(self, rows):
+        """ rpc でまとめて update し、{key: error (成功なら None)} を返す """
+        response = self.client.rpc(self.rpc, {'batch': rows}).execute()
+        updated = {row[self.key_column] for row in response.data}
+        return {
+            row[self.key_column]: None if row[self.key_column] in updated
+            else LookupError(f"no {self.table} row with {self.key_column}={row[self.key_column]}")
+            for row in rows
+        }
+
+    def _report_all(self, results):
+        for key, error in results.items():
+            if error is None:
+                self.written += 1
+            else:
+                print(f"  [DB Error] {key}: {error}")
+                self.failed.append((key, error))
+            self._report({self.key_column: key}, error)
+
+    def flush(self):
+        if not self.pending:
+            return
+        rows = list(self.pending.values())
+        self.pending = {}
+        if self.rpc is not None:
+            try:
+                results = self._update_batch(rows)
+            except Exception as e:
+                print(f"  [DB] Batch update of {len(rows)} rows through {self.rpc} failed ({e}). "
+                      f"Falling back to per-row updates...")
+            else:
+                self._report_all(results)
+                return
+        groups = {}
+        for row in rows:
+            values = {column: value for column, value in row.items() if column != self.key_column}
+            group_key = json.dumps(values, sort_keys=True, default=str)
+            groups.setdefault(group_key, (values, []))[1].append(row[self.key_column])
+        for values, keys in groups.values():
+            self._report_all(self._update_group(values, keys))
@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import time
+
+# ==========================================
+# 長時間ジョブの実行ジャーナル (追記専用の JSON Lines)
+#
+# 1動画の処理が終わるたびに結果 (成功 / 字幕なし / エラー種別 / 試行回数) を1行追記する。
+# --resume で再開するときは、完了済みの動画を飛ばし、
+# 失敗が続いている動画は試行回数に応じて間隔をあけてから再試行する。
+# ==========================================
+
+SUCCESS = 'success'
+NO_CAPTIONS = 'no_captions'
+ERROR = 'error'
+
+# 再試行までの待ち時間
+RETRY_BASE_SEC = 60
+RETRY_MAX_SEC = 24 * 3600
+NO_CAPTIONS_RETRY_SEC = 7 * 24 * 3600
+
+
+class RunJournal:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で落ちた最後の行などは無視する
+                        continue
+                    self.entries[entry['video_id']] = entry
+
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def record(self, video_id, status, error=None):
+        """ 1動画の結果を追記する。失敗が続いた回数は attempts に数える """
+        with self._lock:
+            prev = self.entries.get(video_id)
+            attempts = 0
+            if status != SUCCESS:
+                attempts = (prev['attempts'] if prev and prev['status'] != SUCCESS else 0) + 1
+
+            entry = {
+                'video_id': video_id,
+                'status': status,
+                'error': error,
+                'attempts': attempts,
+                'ts': time.time(),
+            }
+            self.entries[video_id] = entry
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def retry_at(self, video_id):
+        """ 次に試してよい時刻 (UNIX time)。記録がなければ 0、完了済みなら None """
+        entry = self.entries.get(video_id)
+        if entry is None:
+            return 0
+        if entry['status'] == SUCCESS:
+            return None
+        if entry['status'] == NO_CAPTIONS:
+            return entry['ts'] + NO_CAPTIONS_RETRY_SEC
+        delay = min(RETRY_MAX_SEC, RETRY_BASE_SEC * 2 ** (entry['attempts'] - 1))
+        return entry['ts'] + delay
+
+    def should_skip(self, video_id, now=None):
+        """ 完了済み、または再試行の待ち時間中なら True """
+        retry_at = self.retry_at(video_id)
+        if retry_at is None:
+            return True
+        return (now or time.time()) < retry_at
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
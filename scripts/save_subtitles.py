@@ -2,12 +2,25 @@ import sys
 import json
 import re
 import time
-import random
 import os
 import glob
+import argparse
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import yt_dlp
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
+from rate_limit import AdaptiveRateLimiter
+from caption_tracks import SUBJECT_TO_LANG, select_track, select_cached_track, describe_track, base_lang
+from caption_cache import CaptionCache, TeeReader, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, DEFAULT_TTL_SEC
+from run_journal import RunJournal, SUCCESS, NO_CAPTIONS, ERROR
+from stage_metrics import MetricsRecorder, VideoMetrics, timed_parse_and_merge
+from transcript_codec import encode_transcript, content_hash, CONTENT_HASH_TRIGGER_SQL
+from vtt_parser import PARSER_VERSION
+from sentence_restore import SentenceRestorer, LLM_THRESHOLD
+from claim_queue import ClaimQueue, QueueJournal, DEFAULT_CLAIM_SIZE, DEFAULT_LEASE_SEC, DEFAULT_QUEUE_WAIT_SEC
+from ydl_session import YdlSessions, new_session
 
 # ==========================================
 # 設定エリア
@@ -23,205 +36,431 @@ TARGET_LANGS = [
     'ko.*', 'pt.*', 'ar.*', 'ru.*', 'de.*', 'it.*'
 ]
 
+# 並列取得の設定 (--workers / --rps / --min-rps / --max-rps で上書き可)
+# 既定では従来どおり 2〜3秒に1リクエストより速くしない。--max-rps を上げた場合だけ、成功が続くとそこまで上げる。
+# 429 などが返ったら min-rps まで下げてバックオフする
+DEFAULT_WORKERS = 1
+DEFAULT_RPS = 0.5
+DEFAULT_MIN_RPS = 0.05
+DEFAULT_MAX_RPS = DEFAULT_RPS
+
+# DBへの書き込みをまとめる件数 (--batch-size で上書き可)
+DEFAULT_BATCH_SIZE = 50
+
+# 実行ジャーナル (--resume で途中から再開するための記録)
+JOURNAL_FILE = "save_subtitles.journal.jsonl"
+
+# --refresh で取り直す目安 (--max-age-days で上書き可)
+DEFAULT_MAX_AGE_DAYS = 90
+
+# content カラムの形式 (--content-format で上書き可)
+#   columnar: transcript_codec.py の列指向形式 (読み込み側は lib/transcript-codec.ts でデコード)
+#   list:     従来のブロック配列
+# content を読む側がすべて列指向形式に対応するまでは、デフォルトは従来の配列のままにする
+DEFAULT_CONTENT_FORMAT = 'list'
+
 # ==========================================
 
-def get_db_connection():
+def get_db_connection(dsn=DB_CONNECTION_STRING):
     try:
-        conn = psycopg2.connect(DB_CONNECTION_STRING)
+        conn = psycopg2.connect(dsn)
         return conn
     except Exception as e:
         print(f"Error connecting to Supabase: {e}")
         sys.exit(1)
 
-def time_to_ms(t_str):
+def load_done_ids(cursor, video_ids):
+    """ 言語コード付きで保存済みの動画IDを 1回のクエリでまとめて取得する """
+    cursor.execute(
+        "SELECT video_id FROM optimized_transcripts WHERE language IS NOT NULL AND video_id = ANY(%s)",
+        (list(video_ids),)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+def load_row_states(cursor, video_ids):
+    """ --refresh 用: 保存済みの行の言語・ハッシュ・パーサーのバージョン・取得日時 """
+    cursor.execute(
+        "SELECT video_id, language, content_hash, parser_version, fetched_at "
+        "FROM optimized_transcripts WHERE video_id = ANY(%s)",
+        (list(video_ids),)
+    )
+    return {
+        row[0]: {'language': row[1], 'content_hash': row[2], 'parser_version': row[3], 'fetched_at': row[4]}
+        for row in cursor.fetchall()
+    }
+
+def plan_refresh(video_ids, states, max_age_sec, now=None):
+    """
+    --refresh で処理する動画を決める。
+    Returns: {video_id: キャッシュを使ってよい取得日時の下限 (UNIX time)}  含まれない動画は最新なので飛ばす
+      - 未保存 / 言語なし: キャッシュがあればそれを使う
+      - 取得から max_age_sec 以上たった行: それより新しいキャッシュがなければ取り直す
+      - パーサーのバージョンだけ古い行: キャッシュからパースし直す (なければ取り直す)
+    """
+    now = now or time.time()
+    cutoff = now - max_age_sec
+    plan = {}
+    for vid in video_ids:
+        state = states.get(vid)
+        if state is None or state['language'] is None:
+            plan[vid] = 0
+        elif state['fetched_at'] is None or state['fetched_at'].timestamp() < cutoff:
+            plan[vid] = cutoff
+        elif (state['parser_version'] or 0) < PARSER_VERSION:
+            plan[vid] = 0
+    return plan
+
+def to_timestamp(unix_time):
+    return datetime.fromtimestamp(unix_time, timezone.utc) if unix_time else None
+
+class TranscriptBatchWriter:
+    """ 取得結果をためておき、複数行の INSERT ... ON CONFLICT でまとめて書き込む """
+
+    UPSERT_SQL = """
+    INSERT INTO optimized_transcripts
+        (video_id, content, language, content_hash, source_kind, source_lang, parser_version, fetched_at,
+         sentence_confidence, sentence_needs_llm)
+    VALUES %s
+    ON CONFLICT (video_id) 
+    DO UPDATE SET 
+        content = EXCLUDED.content,
+        language = EXCLUDED.language,
+        content_hash = EXCLUDED.content_hash,
+        source_kind = EXCLUDED.source_kind,
+        source_lang = EXCLUDED.source_lang,
+        parser_version = EXCLUDED.parser_version,
+        fetched_at = EXCLUDED.fetched_at,
+        sentence_confidence = EXCLUDED.sentence_confidence,
+        sentence_needs_llm = EXCLUDED.sentence_needs_llm;
+    """
+
+    # 内容が変わっていない行は content を書き直さず、確認した記録だけ更新する
+    TOUCH_SQL = """
+    UPDATE optimized_transcripts AS t
+    SET parser_version = v.parser_version, fetched_at = v.fetched_at,
+        source_kind = v.source_kind, source_lang = v.source_lang,
+        sentence_confidence = v.sentence_confidence, sentence_needs_llm = v.sentence_needs_llm
+    FROM (VALUES %s) AS v (video_id, parser_version, fetched_at, source_kind, source_lang, sentence_confidence,
+                           sentence_needs_llm)
+    WHERE t.video_id = v.video_id;
+    """
+    TOUCH_TEMPLATE = "(%s, %s::integer, %s::timestamptz, %s, %s, %s::real, %s::boolean)"
+
+    def __init__(self, cursor, batch_size=DEFAULT_BATCH_SIZE, journal=None, recorder=None,
+                 content_format=DEFAULT_CONTENT_FORMAT):
+        self.cursor = cursor
+        self.content_format = content_format
+        self.recorder = recorder if recorder is not None else MetricsRecorder()
+        self.batch_size = max(1, batch_size)
+        # 成功はDBに書き込めた時点でジャーナルに記録する (バッファ中に落ちたら未完了扱い)
+        self.journal = journal
+        # 同じ video_id が1つの文に2回入ると ON CONFLICT がエラーになるので dict で持つ
+        self.pending = {}
+        self.pending_touch = {}
+        self.written = 0
+        self.unchanged = 0
+        self.failed = []
+
+    def add(self, video_id, subtitles, track, digest=None):
+        content = encode_transcript(subtitles) if self.content_format == 'columnar' else subtitles
+        self.pending[video_id] = (
+            video_id, Json(content), track['lang'], digest or content_hash(subtitles),
+            track['kind'], track['track_lang'], PARSER_VERSION, to_timestamp(track.get('fetched_at')),
+            track.get('sentence_confidence'), track.get('sentence_needs_llm'),
+        )
+        self.pending_touch.pop(video_id, None)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def touch(self, video_id, track):
+        """ 取り直した内容が保存済みと同じだったとき """
+        self.pending_touch[video_id] = (
+            video_id, PARSER_VERSION, to_timestamp(track.get('fetched_at')), track['kind'], track['track_lang'],
+            track.get('sentence_confidence'), track.get('sentence_needs_llm'),
+        )
+        if len(self.pending_touch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        rows, self.pending = list(self.pending.values()), {}
+        self.written += self._execute(self.UPSERT_SQL, None, rows)
+        rows, self.pending_touch = list(self.pending_touch.values()), {}
+        self.unchanged += self._execute(self.TOUCH_SQL, self.TOUCH_TEMPLATE, rows)
+
+    def _execute(self, sql, template, rows):
+        """ rows をまとめて書き込み、書き込めた件数を返す """
+        if not rows:
+            return 0
+        try:
+            with self.recorder.stage('db_write', rows=len(rows)):
+                execute_values(self.cursor, sql, rows, template=template, page_size=len(rows))
+            for row in rows:
+                self._record(row[0], SUCCESS)
+            return len(rows)
+        except Exception as e:
+            # まとめて失敗した場合は1行ずつ書き直して、失敗した行だけを特定する
+            print(f"  [DB] Batch of {len(rows)} failed ({e}). Retrying row by row...")
+            written = 0
+            for row in rows:
+                try:
+                    execute_values(self.cursor, sql, [row], template=template)
+                    written += 1
+                    self._record(row[0], SUCCESS)
+                except Exception as row_error:
+                    print(f"  [DB Error] {row[0]}: {row_error}")
+                    self.failed.append(row[0])
+                    self._record(row[0], ERROR, type(row_error).__name__)
+            return written
+
+    def _record(self, video_id, status, error=None):
+        if self.journal is not None:
+            self.journal.record(video_id, status, error)
+
+YDL_BASE_OPTS = {
+    'skip_download': True,
+    'quiet': True,
+    'no_warnings': True,
+    # エラーを握りつぶすと 429 や "Sign in to confirm" を検知できないので、例外として受け取る
+    'ignoreerrors': False,
+    'check_formats': False,
+    'http_headers': {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    }
+}
+
+# 一時ファイルに書き出す方式 (fetch_subtitle_data) 用。outtmpl は動画ごとに設定する
+YDL_FILE_OPTS = {
+    **YDL_BASE_OPTS,
+    'subtitlesformat': 'vtt',
+}
+
+def select_caption_track(ydl, video_id, expected_lang, metrics):
+    """
+    extract_info のメタデータから、ダウンロードする字幕トラックを1本だけ選ぶ。
+    Returns: (info, track)  対象の字幕がなければ track は None (メタデータが取れなければ例外)
+    """
+    # process=False: ここでは字幕の選択・ダウンロード処理を走らせずにメタデータだけ取る
+    with metrics.stage('metadata'):
+        info = ydl.extract_info(video_id, download=False, process=False)
+    if not info:
+        # 取得の失敗を「字幕なし」として記録すると長く飛ばされるので、エラーとして扱う
+        raise RuntimeError(f"No metadata returned for {video_id}")
+
+    track = select_track(info, TARGET_LANGS, expected_lang)
+    if track:
+        print(f"  [Track] {describe_track(track)}")
+    return info, track
+
+def parse_transcript(stream, track, metrics, read_stage='download'):
+    """
+    字幕をパースして文単位に復元する (sentence_restore.py)。
+    復元の確からしさは track['sentence_confidence'] に入れる (低いものだけ後で LLM に回す)。
+    LLM に回すかの判定 (LLM_THRESHOLD) も track['sentence_needs_llm'] に入れて DB に保存し、
+    アプリ側 (admin/batch_process_ids) はしきい値を持たずにそれを見る。
+    """
+    restorer = SentenceRestorer(track['lang'])
+    result_data = timed_parse_and_merge(stream, metrics, read_stage, merge=restorer.restore)
+    track['sentence_confidence'] = restorer.confidence if result_data else None
+    track['sentence_needs_llm'] = restorer.confidence < LLM_THRESHOLD if result_data else None
+    return result_data
+
+def parse_and_cache(stream, video_id, track, metrics, cache=None):
+    """ 字幕をパースしつつ、読んだ生データをそのままキャッシュにも保存する """
+    if cache is None:
+        return parse_transcript(stream, track, metrics)
+
+    with cache.writer(video_id, track['track_lang'], track['kind']) as sink:
+        result_data = parse_transcript(TeeReader(stream, sink), track, metrics)
+        if result_data is None:
+            sink.discard()
+    return result_data
+
+def fetch_subtitle_data_from_cache(video_id, cache, metrics, expected_lang=None, min_fetched_at=0):
+    """
+    キャッシュ済みの生データからパースし直す (YouTube にはアクセスしない)。
+    キャッシュには fix_transcript_languages.py が入れた別の言語のトラックなども混ざるので、
+    expected_lang があればその言語のものだけを候補にし、YouTube から取るときと同じ優先順位 (select_track) で選ぶ。
+    min_fetched_at より前に取得したキャッシュは使わない。
+    Returns: (subtitles, track) / キャッシュになければ None
+    """
+    entries = [e for e in cache.lookup_all(video_id) if e['fetched_at'] >= min_fetched_at]
+    if expected_lang:
+        entries = [e for e in entries if base_lang(e['lang']) == base_lang(expected_lang)]
+
+    selected = select_cached_track(entries, TARGET_LANGS, expected_lang)
+    if selected is None:
+        return None
+    entry, track = selected
+    track.update({'cached': True, 'fetched_at': entry['fetched_at']})
+
     try:
-        if '.' in t_str:
-            hms, ms = t_str.split('.')
-        else:
-            hms, ms = t_str, 0
-        parts = hms.split(':')
-        h, m, s = 0, 0, 0
-        if len(parts) == 3:
-            h, m, s = map(int, parts)
-        elif len(parts) == 2:
-            m, s = map(int, parts)
-        return (h * 3600 + m * 60 + s) * 1000 + int(ms)
-    except:
-        return 0
-
-def clean_text(text):
-    text = re.sub(r'<[^>]+>', '', text)       
-    text = re.sub(r'[\r\n]+', ' ', text)      
-    text = re.sub(r'\s+', ' ', text).strip()  
-    return text
-
-def parse_and_merge_vtt(content):
-    if "WEBVTT" not in content[:100]: 
+        f = cache.open(entry)
+    except FileNotFoundError:
+        # lookup と open の間に追い出された: キャッシュミスとして YouTube から取り直す
         return None
+    with f:
+        result_data = parse_transcript(f, track, metrics, read_stage='cache_read')
+    return result_data, track
 
-    raw_lines = []
-    current_start = 0
-    current_end = 0
-    
-    for line in content.split('\n'):
-        line = line.strip()
-        if '-->' in line:
-            try:
-                times = line.split(' --> ')
-                if len(times) >= 2:
-                    current_start = time_to_ms(times[0].strip())
-                    current_end = time_to_ms(times[1].strip().split(' ')[0])
-            except:
-                pass
-        elif line and not line.isdigit() and line != 'WEBVTT':
-            text = clean_text(line)
-            
-            if not text: continue
-            if text.startswith('#EXT'): continue
-            if text.startswith('http'): continue
-            if '-->' in text: continue
-            if '{' in text and '}' in text: continue 
-            if 'window.' in text: continue
-            if 'function(' in text: continue
-            if text.startswith('Kind:'): continue
-            if text.startswith('Language:'): continue
-            if 'captions language' in text.lower(): continue
-
-            if raw_lines and raw_lines[-1]['text'] == text:
-                continue
-                
-            raw_lines.append({
-                'text': text,
-                'offset': current_start,
-                'duration': max(0, current_end - current_start)
-            })
-
-    if not raw_lines:
-        return []
-
-    merged_lines = []
-    buffer_text = ""
-    buffer_start = raw_lines[0]['offset']
-    buffer_duration = 0
-    
-    for i, item in enumerate(raw_lines):
-        text = item['text']
-        duration = item['duration']
-        
-        if buffer_text:
-            buffer_text += " " + text
-        else:
-            buffer_text = text
-            buffer_start = item['offset']
-        
-        buffer_duration += duration
-        
-        is_end_of_sentence = (
-            text.endswith('.') or text.endswith('?') or text.endswith('!') or
-            text.endswith('。') or text.endswith('！') or text.endswith('？')
-        )
-        is_long_enough = len(buffer_text) > 80
-        
-        time_gap = 0
-        if i < len(raw_lines) - 1:
-            next_start = raw_lines[i+1]['offset']
-            current_end_time = item['offset'] + item['duration']
-            time_gap = next_start - current_end_time
-
-        is_big_gap = time_gap > 1000 
-
-        if is_end_of_sentence or (is_long_enough and not is_end_of_sentence) or is_big_gap:
-            merged_lines.append({
-                'text': buffer_text,
-                'offset': buffer_start,
-                'duration': buffer_duration
-            })
-            buffer_text = ""
-            buffer_duration = 0
-            if i < len(raw_lines) - 1:
-                buffer_start = raw_lines[i+1]['offset']
-
-    if buffer_text:
-        merged_lines.append({
-            'text': buffer_text,
-            'offset': buffer_start,
-            'duration': buffer_duration
-        })
-
-    return merged_lines
-
-def fetch_subtitle_data(video_id):
+def set_outtmpl(ydl, template):
+    """ 開いたままの YoutubeDL の出力ファイル名を差し替える (yt-dlp は outtmpl を dict に正規化している) """
+    outtmpl = ydl.params.get('outtmpl')
+    if isinstance(outtmpl, dict):
+        outtmpl['default'] = template
+    else:
+        ydl.params['outtmpl'] = template
+
+def fetch_subtitle_data_in_memory(video_id, expected_lang=None, cache=None, metrics=None, ydl=None):
+    """
+    一時ファイルを使わずに字幕を取得する。
+    選んだトラックの URL を ydl.urlopen で直接読み、ストリームのままパースする。
+    ydl を渡せばそのセッション (ydl_session.YdlSessions) を使い、なければ新しく作る。
+    Returns: (subtitles, track)  取得中のエラーは呼び出し側に投げる
+    """
+    metrics = metrics if metrics is not None else VideoMetrics(video_id)
+    result_data = None
+    track = None
+
+    with (nullcontext(ydl) if ydl is not None else new_session(yt_dlp.YoutubeDL, YDL_BASE_OPTS)) as ydl:
+        info, track = select_caption_track(ydl, video_id, expected_lang, metrics)
+        if track:
+            with metrics.stage('download'):
+                resp = ydl.urlopen(track['url'])
+            with resp:
+                result_data = parse_and_cache(resp, video_id, track, metrics, cache)
+
+    return result_data, track
+
+def fetch_subtitle_data(video_id, expected_lang=None, cache=None, metrics=None, ydl=None):
+    """
+    選んだ字幕トラック1本だけを yt-dlp に書き出させてパースする。
+    ydl を渡せばそのセッション (YDL_FILE_OPTS で作ったもの) を使い、なければ新しく作る。
+    Returns: (subtitles, track)  取得中のエラーは一時ファイルを消してから呼び出し側に投げる
+    """
     temp_filename = f"temp_{video_id}"
-    
-    ydl_opts = {
-        'skip_download': True,
-        'writesubtitles': True,
-        'writeautomaticsub': True,
-        'subtitlesformat': 'vtt',
-        'subtitleslangs': TARGET_LANGS,
-        'outtmpl': temp_filename,
-        'quiet': True,
-        'no_warnings': True,
-        'ignoreerrors': True,
-        'check_formats': False,
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        }
-    }
 
+    metrics = metrics if metrics is not None else VideoMetrics(video_id)
     result_data = None
-    detected_lang = None
+    track = None
 
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_id])
+        with (nullcontext(ydl) if ydl is not None else new_session(yt_dlp.YoutubeDL, YDL_FILE_OPTS)) as ydl:
+            info, track = select_caption_track(ydl, video_id, expected_lang, metrics)
+            if not track:
+                return None, None
+
+            # 選んだトラックだけが対象になるように絞ってから処理する
+            # (手動字幕を選んだ場合は自動字幕を、自動字幕を選んだ場合は手動字幕を無効化)
+            ydl.params['writesubtitles'] = track['kind'] == 'manual'
+            ydl.params['writeautomaticsub'] = track['kind'] == 'auto'
+            ydl.params['subtitleslangs'] = [re.escape(track['track_lang'])]
+            # セッションを使い回すので、出力先も動画ごとに設定し直す
+            set_outtmpl(ydl, temp_filename)
+            with metrics.stage('download'):
+                ydl.process_ie_result(info, download=True)
             
-            # ファイル名から言語を特定して読み込む
-            # 例: temp_ID.zh-Hans.vtt -> lang = zh-Hans
+            # 例: temp_ID.zh-Hans.vtt
             files = glob.glob(f"{temp_filename}*.vtt")
             
-            target_file = None
             if files:
-                target_file = files[0]
-                
-                # ファイル名から言語コード抽出 (temp_ID.LANG.vtt)
-                # 単純に split('.') で後ろから2番目を取る
-                parts = target_file.split('.')
-                if len(parts) >= 3:
-                    detected_lang = parts[-2] # .vttの一つ前
-                
-                print(f"  [Lang] Detected: {detected_lang}")
-
-                with open(target_file, 'r', encoding='utf-8') as f:
-                    raw_content = f.read()
+                # ファイルは丸ごと読み込まず、ストリームのままパースする
+                with open(files[0], 'rb') as f:
+                    result_data = parse_and_cache(f, video_id, track, metrics, cache)
                 
                 for f in files:
                     try: os.remove(f)
                     except: pass
-                
-                if raw_content:
-                    result_data = parse_and_merge_vtt(raw_content)
             
-    except Exception as e:
-        print(f"  [Error] {str(e)[:100]}")
+    except Exception:
         for f in glob.glob(f"{temp_filename}*"):
             try: os.remove(f)
             except: pass
+        raise
+
+    return result_data, track
+
+def load_expected_langs(cursor, video_ids):
+    """
+    roadmap_items / library_videos の科目から、動画ごとの期待される言語コードを引く。
+    両方にある場合は roadmap_items を優先する。
+    """
+    expected = {}
+    for table in ('library_videos', 'roadmap_items'):
+        try:
+            cursor.execute(
+                f"SELECT video_id, subject FROM {table} WHERE video_id = ANY(%s) AND subject IS NOT NULL",
+                (list(video_ids),)
+            )
+        except Exception as e:
+            print(f"  [Warn] Could not read {table}: {e}")
+            continue
+        for vid, subject in cursor.fetchall():
+            if subject in SUBJECT_TO_LANG:
+                expected[vid] = SUBJECT_TO_LANG[subject]
+    return expected
 
-    return result_data, detected_lang
+def parse_args():
+    parser = argparse.ArgumentParser(description="字幕を取得して optimized_transcripts に保存する")
+    parser.add_argument('--dsn', default=os.getenv('DATABASE_URL') or DB_CONNECTION_STRING,
+                        help="接続文字列 (デフォルト: 環境変数 DATABASE_URL、なければ DB_CONNECTION_STRING)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help="同時に取得するワーカー数 (デフォルト: %(default)s)")
+    parser.add_argument('--rps', type=float, default=DEFAULT_RPS,
+                        help="全ワーカー合計の開始時の1秒あたりリクエスト数 (デフォルト: %(default)s)")
+    parser.add_argument('--min-rps', type=float, default=DEFAULT_MIN_RPS,
+                        help="スロットリング時に下げる下限 (デフォルト: %(default)s)")
+    parser.add_argument('--max-rps', type=float, default=DEFAULT_MAX_RPS,
+                        help="成功が続いたときに上げる上限 (デフォルト: %(default)s)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="DBにまとめて書き込む件数 (デフォルト: %(default)s)")
+    parser.add_argument('--content-format', choices=('columnar', 'list'), default=DEFAULT_CONTENT_FORMAT,
+                        help="content カラムの保存形式 (デフォルト: %(default)s)")
+    parser.add_argument('--in-memory', action='store_true',
+                        help="一時ファイルを作らず、字幕をメモリ上で直接パースする")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help="字幕の生データのキャッシュ先 (デフォルト: %(default)s)")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="キャッシュを使わず、常に YouTube から取得する")
+    parser.add_argument('--cache-max-mb', type=float, default=DEFAULT_MAX_BYTES / 1024 / 1024,
+                        help="キャッシュの合計サイズの上限 (MB, 超えたら古いアクセス順に削除, デフォルト: %(default)s)")
+    parser.add_argument('--cache-ttl-days', type=float, default=DEFAULT_TTL_SEC / 86400,
+                        help="キャッシュを使う期限 (日, デフォルト: %(default)s)")
+    parser.add_argument('--journal', default=JOURNAL_FILE,
+                        help="実行ジャーナルのパス (デフォルト: %(default)s)")
+    parser.add_argument('--resume', action='store_true',
+                        help="ジャーナルを見て完了済みを飛ばし、失敗が続く動画は間隔をあけて再試行する")
+    parser.add_argument('--refresh', action='store_true',
+                        help="保存済みの行も見直す: 古い行は取り直し、パーサーだけ古い行はキャッシュからパースし直す")
+    parser.add_argument('--max-age-days', type=float, default=DEFAULT_MAX_AGE_DAYS,
+                        help="--refresh で取り直すまでの日数 (デフォルト: %(default)s)")
+    parser.add_argument('--queue', action='store_true',
+                        help=f"{ID_LIST_FILE} の代わりに Postgres のキュー (claim_queue.py) から動画を取り出す")
+    parser.add_argument('--claim-size', type=int, default=DEFAULT_CLAIM_SIZE,
+                        help="キューから1回に取り出す件数 (デフォルト: %(default)s)")
+    parser.add_argument('--lease-sec', type=int, default=DEFAULT_LEASE_SEC,
+                        help="取り出した動画のリース期間 (秒, デフォルト: %(default)s)")
+    parser.add_argument('--queue-wait-sec', type=float, default=DEFAULT_QUEUE_WAIT_SEC,
+                        help="キューが空でも、再試行の待ち時間中の動画がこの秒数以内に取り出せるようになるなら待つ (デフォルト: %(default)s)")
+    parser.add_argument('--metrics', default=None,
+                        help="動画ごと・ステージごとの計測値を JSON Lines で書き出すパス")
+    parser.add_argument('--prom', default=None,
+                        help="終了時に Prometheus textfile 形式の集計を書き出すパス")
+    return parser.parse_args()
 
 def main():
-    try:
-        with open(ID_LIST_FILE, 'r', encoding='utf-8') as f:
-            content = f.read().replace(',', ' ').replace('\n', ' ')
-            video_ids = [vid.strip() for vid in content.split() if vid.strip()]
-    except FileNotFoundError:
-        print(f"Error: {ID_LIST_FILE} not found.")
-        return
+    args = parse_args()
 
-    print(f"Target Videos: {len(video_ids)}")
-    
-    conn = get_db_connection()
+    if not args.queue:
+        try:
+            with open(ID_LIST_FILE, 'r', encoding='utf-8') as f:
+                content = f.read().replace(',', ' ').replace('\n', ' ')
+                video_ids = [vid.strip() for vid in content.split() if vid.strip()]
+        except FileNotFoundError:
+            print(f"Error: {ID_LIST_FILE} not found.")
+            return
+        print(f"Target Videos: {len(video_ids)} (workers: {args.workers}, rps: {args.rps})")
+
+    conn = get_db_connection(args.dsn)
     conn.autocommit = True
     cursor = conn.cursor()
     
@@ -231,51 +470,191 @@ def main():
         content JSONB,
         language TEXT
     );
+    ALTER TABLE optimized_transcripts
+        ADD COLUMN IF NOT EXISTS content_hash TEXT,
+        ADD COLUMN IF NOT EXISTS source_kind TEXT,
+        ADD COLUMN IF NOT EXISTS source_lang TEXT,
+        ADD COLUMN IF NOT EXISTS parser_version INTEGER,
+        ADD COLUMN IF NOT EXISTS fetched_at TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS sentence_confidence REAL,
+        ADD COLUMN IF NOT EXISTS sentence_needs_llm BOOLEAN;
     """)
+    cursor.execute(CONTENT_HASH_TRIGGER_SQL)
     print("Table check passed.")
 
-    success_count = 0
+    recorder = MetricsRecorder(args.metrics)
+    journal = RunJournal(args.journal)
+    queue = None
+    if args.queue:
+        # 複数マシンで分担する場合は、ID の一覧の代わりにキューから少しずつ取り出す
+        queue = ClaimQueue(conn, lease_sec=args.lease_sec)
+        queue.ensure_schema()
+        journal = QueueJournal(queue, journal)
+        print(f"Queue worker {queue.owner} (workers: {args.workers}, rps: {args.rps})")
+
     skip_count = 0
+    # 文の復元の confidence が低く、LLM での整形が必要な動画
+    low_confidence = []
+    writer = TranscriptBatchWriter(cursor, args.batch_size, journal, recorder, args.content_format)
+
+    # 取得はワーカースレッドで並列に行い、DB書き込みはメインスレッドでまとめて行う
+    # (psycopg2 のカーソルはスレッド間で共有しない)
+    limiter = AdaptiveRateLimiter(args.rps, min_rate=args.min_rps, max_rate=max(args.rps, args.max_rps))
+
+    fetch = fetch_subtitle_data_in_memory if args.in_memory else fetch_subtitle_data
+    # ワーカースレッドごとに YoutubeDL を1つ開いたままにして、Cookie や keep-alive の接続を使い回す
+    ydl_opts = YDL_BASE_OPTS if args.in_memory else YDL_FILE_OPTS
+    sessions = YdlSessions(lambda: new_session(yt_dlp.YoutubeDL, ydl_opts))
+    cache = None if args.no_cache else CaptionCache(
+        args.cache_dir, max_bytes=int(args.cache_max_mb * 1024 * 1024), ttl_sec=int(args.cache_ttl_days * 86400)
+    )
+
+    def fetch_with_limit(vid, expected_lang, metrics, min_fetched_at=0):
+        metrics.started = time.perf_counter()
+        # キャッシュにあればレート制限なしでパースし直すだけ
+        if cache is not None:
+            cached = fetch_subtitle_data_from_cache(vid, cache, metrics, expected_lang, min_fetched_at)
+            if cached is not None:
+                return cached
+        with metrics.stage('rate_wait'):
+            limiter.acquire()
+        fetched_at = time.time()
+        try:
+            subtitles, track = fetch(vid, expected_lang, cache, metrics, sessions.get())
+        except Exception as e:
+            limiter.report(e)
+            raise
+        limiter.report()
+        if track:
+            track['fetched_at'] = fetched_at
+        return subtitles, track
+
+    def process(video_ids, executor):
+        nonlocal skip_count
 
-    for i, vid in enumerate(video_ids):
-        print(f"[{i+1}/{len(video_ids)}] Processing {vid}...", end=" ", flush=True)
-        
         # ★重要★ 言語コード(language)がNULLの行、またはデータがない行だけ再取得するロジックにする
-        # もし全件強制上書きしたい場合は、ここのチェックをコメントアウトしてください
-        cursor.execute("SELECT 1 FROM optimized_transcripts WHERE video_id = %s AND language IS NOT NULL", (vid,))
-        if cursor.fetchone():
-             print("Already exists with language. Skipped.")
-             continue
-
-        subtitles, lang_code = fetch_subtitle_data(vid)
-        
-        if subtitles and len(subtitles) > 0:
+        # 保存済みの行も見直す場合は --refresh (古い行・パーサーが古い行だけ処理する)
+        states = {}
+        plan = {}
+        if args.refresh:
+            with recorder.stage('db_read', query='row_states'):
+                states = load_row_states(cursor, video_ids)
+            plan = plan_refresh(video_ids, states, args.max_age_days * 24 * 3600)
+            done_ids = {vid for vid in video_ids if vid not in plan}
+            print(f"Up to date: {len(done_ids)} (skipped)")
+        else:
+            with recorder.stage('db_read', query='done_ids'):
+                done_ids = load_done_ids(cursor, video_ids)
+            print(f"Already exists with language: {len(done_ids)} (skipped)")
+        pending_ids = [vid for vid in video_ids if vid not in done_ids]
+        if queue is not None:
+            for vid in done_ids:
+                queue.record(vid, SUCCESS)
+
+        # キューを使うときは再試行の間隔もキュー側で管理する
+        if args.resume and queue is None:
+            resumed_ids = [vid for vid in pending_ids if not journal.should_skip(vid)]
+            print(f"Resume: skipped {len(pending_ids) - len(resumed_ids)} finished or backing-off videos")
+            pending_ids = resumed_ids
+
+        with recorder.stage('db_read', query='expected_langs'):
+            expected_langs = load_expected_langs(cursor, pending_ids)
+
+        video_metrics = {vid: VideoMetrics(vid) for vid in pending_ids}
+        futures = {
+            executor.submit(fetch_with_limit, vid, expected_langs.get(vid), video_metrics[vid], plan.get(vid, 0)): vid
+            for vid in pending_ids
+        }
+
+        for i, future in enumerate(as_completed(futures)):
+            vid = futures[future]
+            print(f"[{i+1}/{len(pending_ids)}] {vid}:", end=" ", flush=True)
             try:
-                # languageカラムにもデータを保存
-                sql = """
-                INSERT INTO optimized_transcripts (video_id, content, language)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (video_id) 
-                DO UPDATE SET 
-                    content = EXCLUDED.content,
-                    language = EXCLUDED.language;
-                """
-                cursor.execute(sql, (vid, Json(subtitles), lang_code))
-                print(f"Done. ({len(subtitles)} blocks, Lang: {lang_code})")
-                success_count += 1
+                subtitles, track = future.result()
             except Exception as e:
-                print(f"DB Error: {e}")
+                print(f"Error: {str(e)[:100]}")
+                journal.record(vid, ERROR, type(e).__name__)
+                recorder.record_video(video_metrics.pop(vid), ERROR)
+                skip_count += 1
+                continue
+            lang_code = track['lang'] if track else None
+
+            if subtitles and len(subtitles) > 0:
+                confidence = track['sentence_confidence']
+                if track['sentence_needs_llm']:
+                    low_confidence.append(vid)
+                digest = content_hash(subtitles)
+                state = states.get(vid)
+                if state and state['content_hash'] == digest and state['language'] == lang_code:
+                    # 内容が同じなら content は書き直さない
+                    writer.touch(vid, track)
+                    print(f"Unchanged. ({len(subtitles)} blocks, Lang: {lang_code}, Confidence: {confidence})")
+                else:
+                    # languageカラムにもデータを保存 (batch-size 件たまったら書き込む)
+                    writer.add(vid, subtitles, track, digest)
+                    print(f"Done. ({len(subtitles)} blocks, Lang: {lang_code}, Track: {track['kind']}, Confidence: {confidence})")
+                recorder.record_video(video_metrics.pop(vid), SUCCESS)
+            else:
+                print("No valid subtitles found.")
+                journal.record(vid, NO_CAPTIONS)
+                recorder.record_video(video_metrics.pop(vid), NO_CAPTIONS)
+                skip_count += 1
+
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    try:
+        if queue is None:
+            process(video_ids, executor)
         else:
-            print("No valid subtitles found.")
-            skip_count += 1
-        
-        time.sleep(random.uniform(2, 4))
+            queue.start_renewer()
+            while True:
+                claimed = queue.claim(args.claim_size)
+                if not claimed:
+                    # 再試行の待ち時間中の動画が残っていれば、すぐ取り出せるものは待ち、遠いものは報告して終える
+                    waiting, leased, next_sec = queue.backlog()
+                    if not waiting:
+                        print("Queue drained." + (f" ({leased} videos still leased by other workers)" if leased else ""))
+                        break
+                    if next_sec > args.queue_wait_sec:
+                        print(f"Queue idle: {waiting} videos are backing off (next retry in {next_sec:.0f}s). Exiting.")
+                        break
+                    print(f"  [Queue] {waiting} videos are backing off. Waiting {max(next_sec, 0):.0f}s for the next retry...")
+                    time.sleep(max(next_sec, 1.0))
+                    continue
+                process(claimed, executor)
+                # 書き込んでから結果を報告するので、次を取り出す前にリースを手放しておく
+                writer.flush()
+        executor.shutdown(wait=True)
+    except BaseException:
+        # Ctrl+C や例外のときは、まだ始まっていない取得を取り消して、待たずに書き込み・終了処理へ進む
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        # 途中で中断しても、取得済みの分は書き込んでから終了する
+        writer.flush()
+        sessions.close_all()
+        if queue is not None:
+            queue.stop_renewer()
+            queue.release_all()
+        journal.close()
+        recorder.close()
+        if args.prom:
+            recorder.write_prometheus(args.prom)
+        if cache is not None:
+            cache.close()
 
     print("\n==============================")
     print(f"Completed!")
-    print(f"Success: {success_count}")
+    print(f"Success: {writer.written}")
+    if args.refresh:
+        print(f"Unchanged: {writer.unchanged}")
+    if writer.failed:
+        print(f"DB Errors: {len(writer.failed)}")
     print(f"Skipped/Failed: {skip_count}")
+    print(f"YoutubeDL sessions: {sessions.created}")
+    if low_confidence:
+        print(f"Low sentence confidence (< {LLM_THRESHOLD}, needs LLM pass): {len(low_confidence)}")
     print("==============================")
+    recorder.print_summary()
     
     cursor.close()
     conn.close()
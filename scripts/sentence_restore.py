@@ -0,0 +1,182 @@
+import re
+from itertools import chain, islice
+
+from vtt_parser import SENTENCE_ENDINGS
+
+# ==========================================
+# キューの並びから文を復元する (merge_cues の代わりに使う結合ステージ)
+#
+# 句読点付きのトラック (手動字幕など) は句読点で区切り、キューの途中の文末でも分割する。
+# 句読点のない自動字幕は、次の手がかりを組み合わせて文の境界を推定し、文末記号を補う。
+#   - キュー間の無音の長さ
+#   - 次のキューが大文字で始まるか (大文字のある言語のみ)
+#   - 日本語・中国語・韓国語の文末表現 (です / ます / 了 / 吗 / 요 / 다 など)
+#   - 言語ごとの文の長さの目安 (長すぎる場合は強制的に区切る)
+#
+# 境界の判定ごとの確からしさを平均したものを confidence (0〜1) として返すので、
+# 低いものだけを LLM での整形に回せばよい。
+# ==========================================
+
+# 先頭のこのキュー数を見て、句読点付きのトラックかどうかを決める
+SAMPLE_CUES = 50
+PUNCTUATED_RATIO = 0.2
+
+# 無音の長さ (ms) と、それぞれが文の境界である確からしさ
+PAUSE_WEIGHTS = ((1000, 0.75), (500, 0.45), (250, 0.2))
+CASING_WEIGHT = 0.35
+PARTICLE_WEIGHT = 0.6
+# 手がかりがなくても境界である可能性 (句読点のないトラックでは見落としがありうる)
+PRIOR_UNPUNCTUATED = 0.15
+PRIOR_PUNCTUATED = 0.02
+BOUNDARY_THRESHOLD = 0.5
+# 文が目安の長さを超えたら、弱い手がかりでも区切る
+SOFT_THRESHOLD = 0.3
+
+# (目安の長さ, 上限) 文字数
+LENGTH_LIMITS = {'ja': (40, 80), 'zh': (40, 80), 'ko': (60, 120)}
+DEFAULT_LENGTH_LIMITS = (120, 200)
+
+# 大文字・小文字で文頭がわかる言語 (ドイツ語は名詞も大文字なので弱める)
+CASED_LANGS = {'en', 'fr', 'es', 'it', 'pt', 'ru', 'de'}
+CASING_WEIGHT_DE = 0.15
+
+PARTICLE_RE = {
+    'ja': re.compile(r'(です|ます|ました|でした|ません|ましょう|ください|でしょう|ですね|ますね|ですよ|ますよ|だよ|よね|ね|よ|か)$'),
+    'zh': re.compile(r'(了|吗|呢|吧|啊|呀)$'),
+    'ko': re.compile(r'(니다|세요|어요|아요|에요|예요|죠|요|다|까)$'),
+}
+
+# 復元した文の末尾に補う記号
+CJK_FULL_STOP = {'ja': '。', 'zh': '。'}
+
+# キューの途中にある文末 ("right. So today" など)
+INNER_BOUNDARY_RE = re.compile(r'(?<=[.?!])\s+(?=[A-Z¿¡"“])|(?<=[。！？])')
+
+# confidence がこれ未満の動画だけを LLM で整形し直す
+LLM_THRESHOLD = 0.6
+
+
+def base_lang(lang):
+    return (lang or '').split('-')[0].lower()
+
+
+def _split_inner(cue):
+    """ キューの途中の文末で分割し、時間は文字数で按分する """
+    parts = [p for p in INNER_BOUNDARY_RE.split(cue['text']) if p and p.strip()]
+    if len(parts) <= 1:
+        return [cue]
+    total = sum(len(p) for p in parts)
+    pieces = []
+    offset = cue['offset']
+    for i, part in enumerate(parts):
+        if i == len(parts) - 1:
+            duration = cue['offset'] + cue['duration'] - offset
+        else:
+            duration = cue['duration'] * len(part) // total
+        pieces.append({'text': part.strip(), 'offset': offset, 'duration': duration})
+        offset += duration
+    return pieces
+
+
+class SentenceRestorer:
+    """
+    restore(cues) はキューのイテラブルを受け取り、文単位のブロックを順に返すジェネレーター。
+    読み終えた後の confidence に境界判定の確からしさの平均が入る。
+    """
+
+    def __init__(self, lang=None):
+        self.lang = base_lang(lang)
+        self.soft_limit, self.hard_limit = LENGTH_LIMITS.get(self.lang, DEFAULT_LENGTH_LIMITS)
+        self.particle_re = PARTICLE_RE.get(self.lang)
+        self.casing_weight = CASING_WEIGHT_DE if self.lang == 'de' else (
+            CASING_WEIGHT if self.lang in CASED_LANGS else 0.0
+        )
+        self.joiner = '' if self.lang in ('ja', 'zh') else ' '
+        self.punctuated = None
+        self.decisions = 0
+        self.certainty = 0.0
+        self.forced = 0
+
+    @property
+    def confidence(self):
+        if not self.decisions:
+            return 1.0
+        return round(self.certainty / self.decisions, 3)
+
+    def _boundary_probability(self, prev, nxt):
+        """ prev の直後で文が切れる確率 """
+        text = prev['text']
+        if text.endswith(SENTENCE_ENDINGS):
+            return 1.0
+        if self.punctuated:
+            return PRIOR_PUNCTUATED
+
+        keep = 1 - PRIOR_UNPUNCTUATED
+        gap = nxt['offset'] - (prev['offset'] + prev['duration'])
+        for threshold, weight in PAUSE_WEIGHTS:
+            if gap >= threshold:
+                keep *= 1 - weight
+                break
+        if self.casing_weight and nxt['text'][:1].isupper() and not nxt['text'].startswith(('I ', "I'")):
+            keep *= 1 - self.casing_weight
+        if self.particle_re is not None and self.particle_re.search(text):
+            keep *= 1 - PARTICLE_WEIGHT
+        return 1 - keep
+
+    def _finish(self, parts, start, end):
+        text = self.joiner.join(parts)
+        if not self.punctuated and not text.endswith(SENTENCE_ENDINGS):
+            # 句読点のないトラックでは、文頭を大文字にして文末記号を補う
+            if self.casing_weight:
+                text = text[:1].upper() + text[1:]
+            text += CJK_FULL_STOP.get(self.lang, '.')
+        return {'text': text, 'offset': start, 'duration': max(0, end - start)}
+
+    def restore(self, cues):
+        cues = iter(cues)
+        head = list(islice(cues, SAMPLE_CUES))
+        if head:
+            ended = sum(1 for cue in head if cue['text'].endswith(SENTENCE_ENDINGS) or INNER_BOUNDARY_RE.search(cue['text']))
+            self.punctuated = ended / len(head) >= PUNCTUATED_RATIO
+        stream = chain(head, cues)
+        if self.punctuated:
+            stream = (piece for cue in stream for piece in _split_inner(cue))
+
+        parts = []
+        length = 0
+        start = end = 0
+        prev = None
+        for cue in stream:
+            if prev is not None:
+                p = self._boundary_probability(prev, cue)
+                threshold = SOFT_THRESHOLD if length >= self.soft_limit else BOUNDARY_THRESHOLD
+                self.decisions += 1
+                if length + len(cue['text']) > self.hard_limit and p < threshold:
+                    # 手がかりのないまま上限を超える: 区切るが、確からしさは 0 として数える
+                    self.forced += 1
+                    p = 1.0
+                else:
+                    # 0.5 から離れているほど確か (境界だと言い切れる / 境界でないと言い切れる)
+                    self.certainty += abs(2 * p - 1)
+                if p >= threshold:
+                    yield self._finish(parts, start, end)
+                    parts = []
+                    length = 0
+
+            if not parts:
+                start = cue['offset']
+                end = cue['offset'] + cue['duration']
+            parts.append(cue['text'])
+            length += len(cue['text']) + len(self.joiner)
+            end = max(end, cue['offset'] + cue['duration'])
+            prev = cue
+
+        if parts:
+            yield self._finish(parts, start, end)
+
+
+def restore_sentences(cues, lang=None):
+    """ Returns: (ブロックのリスト, confidence) """
+    restorer = SentenceRestorer(lang)
+    blocks = list(restorer.restore(cues))
+    return blocks, restorer.confidence
@@ -0,0 +1,228 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from vtt_parser import iter_cues, merge_cues, NotWebVTTError
+
+# ==========================================
+# 取り込み処理のステージ別計測
+#
+# 動画ごとに各ステージの所要時間 (rate_wait / metadata / download / parse / merge / db_read / db_write)、
+# 取得したバイト数、生成したブロック数を記録し、JSON Lines で書き出す。
+# 実行終了時にはステージごとのパーセンタイルを表示し、
+# Prometheus の textfile collector 形式でも書き出せる。
+# ==========================================
+
+STAGES = ('rate_wait', 'metadata', 'download', 'cache_read', 'parse', 'merge', 'db_read', 'db_write')
+QUANTILES = (0.5, 0.9, 0.99)
+PROM_PREFIX = 'subtitle_ingest'
+
+
+class VideoMetrics:
+    """ 1動画分の計測値。ワーカースレッド内でだけ更新する """
+
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.stages = {}
+        self.bytes_fetched = 0
+        self.blocks = 0
+        self.started = time.perf_counter()
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+class TimedReader:
+    """ read() にかかった時間と読んだバイト数を metrics に積むラッパー """
+
+    def __init__(self, source, metrics, stage='download'):
+        self.source = source
+        self.metrics = metrics
+        self.stage_name = stage
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        chunk = self.source.read(size)
+        elapsed = time.perf_counter() - start
+        self.seconds += elapsed
+        self.metrics.add(self.stage_name, elapsed)
+        if chunk:
+            self.metrics.bytes_fetched += len(chunk)
+        return chunk
+
+
+def timed_parse_and_merge(stream, metrics, read_stage='download', merge=merge_cues):
+    """
+    parse_and_merge_vtt と同じ処理を、ステージ別に時間を測りながら行う。
+    パースと結合はジェネレーターで交互に進むので、
+    キューを取り出すのにかかった時間から読み込み時間を引いたものを parse、残りを merge とする。
+    merge にはキューのイテラブルを受け取る結合ステージ (sentence_restore.SentenceRestorer.restore など) を渡せる。
+    WebVTT でなければ None。
+    """
+    reader = TimedReader(stream, metrics, read_stage)
+    cue_seconds = 0.0
+
+    def timed_cues():
+        nonlocal cue_seconds
+        cues = iter_cues(reader)
+        while True:
+            start = time.perf_counter()
+            try:
+                cue = next(cues)
+            except StopIteration:
+                return
+            finally:
+                cue_seconds += time.perf_counter() - start
+            yield cue
+
+    start = time.perf_counter()
+    try:
+        merged = list(merge(timed_cues()))
+    except NotWebVTTError:
+        merged = None
+    total = time.perf_counter() - start
+
+    metrics.add('parse', max(0.0, cue_seconds - reader.seconds))
+    metrics.add('merge', max(0.0, total - cue_seconds))
+    metrics.blocks = len(merged) if merged else 0
+    return merged
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class MetricsRecorder:
+    """
+    動画ごとの計測値を集めて JSON Lines に書き出し、終了時に集計する。
+    jsonl_path が None ならファイルには書かず、集計だけ行う。
+    """
+
+    def __init__(self, jsonl_path=None):
+        self._lock = threading.Lock()
+        self._file = open(jsonl_path, 'a', encoding='utf-8') if jsonl_path else None
+        self.samples = {stage: [] for stage in STAGES}
+        self.totals = []
+        self.status_counts = {}
+        self.bytes_fetched = 0
+        self.blocks = 0
+        self.started = time.time()
+
+    def _write(self, record):
+        if self._file is not None:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def record_video(self, metrics, status):
+        total = time.perf_counter() - metrics.started
+        with self._lock:
+            for stage, seconds in metrics.stages.items():
+                self.samples.setdefault(stage, []).append(seconds)
+            self.totals.append(total)
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.bytes_fetched += metrics.bytes_fetched
+            self.blocks += metrics.blocks
+            self._write({
+                'event': 'video',
+                'video_id': metrics.video_id,
+                'status': status,
+                'stages': {k: round(v, 6) for k, v in metrics.stages.items()},
+                'total_sec': round(total, 6),
+                'bytes_fetched': metrics.bytes_fetched,
+                'blocks': metrics.blocks,
+                'ts': time.time(),
+            })
+
+    def record_stage(self, stage, seconds, **fields):
+        """ 動画単位ではない処理 (起動時の一括 SELECT、バッチ書き込みなど) """
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+            self._write({'event': stage, 'seconds': round(seconds, 6), **fields, 'ts': time.time()})
+
+    @contextmanager
+    def stage(self, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start, **fields)
+
+    def summary(self):
+        """ ステージごとの件数・合計・パーセンタイル """
+        result = {}
+        for stage, values in list(self.samples.items()) + [('total', self.totals)]:
+            if not values:
+                continue
+            ordered = sorted(values)
+            result[stage] = {
+                'count': len(ordered),
+                'sum': sum(ordered),
+                **{f"p{round(q * 100)}": percentile(ordered, q) for q in QUANTILES},
+            }
+        return result
+
+    def print_summary(self):
+        summary = self.summary()
+        if not summary:
+            return
+        elapsed = time.time() - self.started
+        print(f"{'stage':12} {'count':>7} {'total s':>10} {'p50 s':>9} {'p90 s':>9} {'p99 s':>9}")
+        for stage, s in summary.items():
+            print(f"{stage:12} {s['count']:>7} {s['sum']:>10.2f} {s['p50']:>9.3f} {s['p90']:>9.3f} {s['p99']:>9.3f}")
+        videos = sum(self.status_counts.values())
+        print(f"Videos: {videos} in {elapsed:.1f}s ({videos / elapsed * 60 if elapsed else 0:.1f}/min), "
+              f"fetched {self.bytes_fetched / (1024 * 1024):.1f} MB, {self.blocks} blocks")
+
+    def write_prometheus(self, path):
+        """ node_exporter の textfile collector 用。途中の状態を読まれないよう rename で置き換える """
+        lines = [
+            f"# HELP {PROM_PREFIX}_stage_seconds Time spent per ingestion stage.",
+            f"# TYPE {PROM_PREFIX}_stage_seconds summary",
+        ]
+        for stage, s in self.summary().items():
+            for q in QUANTILES:
+                lines.append(f'{PROM_PREFIX}_stage_seconds{{stage="{stage}",quantile="{q}"}} {s[f"p{round(q * 100)}"]:.6f}')
+            lines.append(f'{PROM_PREFIX}_stage_seconds_sum{{stage="{stage}"}} {s["sum"]:.6f}')
+            lines.append(f'{PROM_PREFIX}_stage_seconds_count{{stage="{stage}"}} {s["count"]}')
+
+        lines += [
+            f"# HELP {PROM_PREFIX}_videos_total Videos processed by outcome.",
+            f"# TYPE {PROM_PREFIX}_videos_total counter",
+        ]
+        for status, count in sorted(self.status_counts.items()):
+            lines.append(f'{PROM_PREFIX}_videos_total{{status="{status}"}} {count}')
+
+        lines += [
+            f"# HELP {PROM_PREFIX}_bytes_fetched_total Caption bytes read.",
+            f"# TYPE {PROM_PREFIX}_bytes_fetched_total counter",
+            f"{PROM_PREFIX}_bytes_fetched_total {self.bytes_fetched}",
+            f"# HELP {PROM_PREFIX}_blocks_total Merged blocks produced.",
+            f"# TYPE {PROM_PREFIX}_blocks_total counter",
+            f"{PROM_PREFIX}_blocks_total {self.blocks}",
+            f"# HELP {PROM_PREFIX}_last_run_timestamp_seconds End time of the last run.",
+            f"# TYPE {PROM_PREFIX}_last_run_timestamp_seconds gauge",
+            f"{PROM_PREFIX}_last_run_timestamp_seconds {time.time():.0f}",
+        ]
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import json
+import zlib
+
+# ==========================================
+# optimized_transcripts.content のコンパクトな列指向エンコーディング
+#
+# 従来の形式 (ブロックごとの dict の配列):
+#   [{"text": "...", "offset": 1000, "duration": 2000}, ...]
+#
+# 列指向形式 (バージョン付きの1つのオブジェクト):
+#   {"fmt": "columnar", "v": 1, "n": ブロック数,
+#    "o": offset の差分 (先頭は絶対値), "d": duration,
+#    "t": 全ブロックのテキストを連結した文字列, "b": 各ブロックのテキストの終了位置}
+#
+# 長い動画では "o" "d" "t" "b" を JSON にして zlib 圧縮し、base64 で "z" に入れる。
+#   {"fmt": "columnar", "v": 1, "z": "..."}
+#
+# "b" の位置は UTF-16 のコード単位で数える (TS 側の String.slice とそのまま対応させるため)。
+# 読み込み側 (decode_transcript / lib/transcript-codec.ts) は従来の配列もそのまま受け付ける。
+# ==========================================
+
+FORMAT = 'columnar'
+VERSION = 1
+
+# 連結テキストがこの長さ (文字数) 以上なら圧縮する
+COMPRESS_MIN_CHARS = 8 * 1024
+
+
+class TranscriptFormatError(ValueError):
+    pass
+
+
+def is_columnar(content):
+    return isinstance(content, dict) and content.get('fmt') == FORMAT
+
+
+def _utf16_len(text):
+    if text.isascii():
+        return len(text)
+    # BMP 外の文字 (絵文字など) は UTF-16 では2単位になる
+    return len(text.encode('utf-16-le')) // 2
+
+
+def encode_transcript(blocks, compress=None):
+    """
+    ブロックのリストを列指向形式の dict にする。
+    compress=None ならテキストの長さで自動判定、True / False で強制。
+    """
+    offsets = []
+    durations = []
+    texts = []
+    boundaries = []
+    prev_offset = 0
+    end = 0
+    for block in blocks:
+        offset = int(block['offset'])
+        offsets.append(offset - prev_offset)
+        prev_offset = offset
+        durations.append(int(block['duration']))
+        text = block['text']
+        texts.append(text)
+        end += _utf16_len(text)
+        boundaries.append(end)
+
+    columns = {'n': len(texts), 'o': offsets, 'd': durations, 't': ''.join(texts), 'b': boundaries}
+    if compress is None:
+        compress = len(columns['t']) >= COMPRESS_MIN_CHARS
+
+    if compress:
+        raw = json.dumps(columns, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        packed = base64.b64encode(zlib.compress(raw, 9)).decode('ascii')
+        return {'fmt': FORMAT, 'v': VERSION, 'z': packed}
+    return {'fmt': FORMAT, 'v': VERSION, **columns}
+
+
+def _split_text(text, boundaries):
+    starts = [0] + boundaries[:-1]
+    if not boundaries or boundaries[-1] == len(text):
+        # BMP 内の文字だけなら UTF-16 の位置と文字の位置が一致する
+        return [text[s:e] for s, e in zip(starts, boundaries)]
+    encoded = text.encode('utf-16-le')
+    return [encoded[s * 2:e * 2].decode('utf-16-le') for s, e in zip(starts, boundaries)]
+
+
+def decode_transcript(content):
+    """
+    content カラムの値をブロックのリストに戻す。
+    従来の配列形式ならそのまま返す。
+    """
+    if content is None or isinstance(content, list):
+        return content
+    if not is_columnar(content):
+        raise TranscriptFormatError(f"Unknown transcript content: {type(content).__name__}")
+    if content.get('v') != VERSION:
+        raise TranscriptFormatError(f"Unsupported transcript format version: {content.get('v')}")
+
+    columns = content
+    if 'z' in content:
+        columns = json.loads(zlib.decompress(base64.b64decode(content['z'])).decode('utf-8'))
+
+    n = columns['n']
+    offsets, durations, boundaries = columns['o'], columns['d'], columns['b']
+    if not (len(offsets) == len(durations) == len(boundaries) == n):
+        raise TranscriptFormatError("Column lengths do not match block count")
+
+    blocks = []
+    offset = 0
+    for delta, duration, text in zip(offsets, durations, _split_text(columns['t'], boundaries)):
+        offset += delta
+        blocks.append({'text': text, 'offset': offset, 'duration': duration})
+    return blocks
+
+
+def content_to_text(content):
+    """ content カラムの値 (配列 / 列指向形式 / 1つの文字列) から本文のテキストだけを取り出す """
+    if content is None:
+        return ''
+    if isinstance(content, str):
+        return content
+    if is_columnar(content):
+        content = decode_transcript(content)
+    return ' '.join(block.get('text', '') for block in content if isinstance(block, dict))
+
+
+def content_hash(blocks):
+    """ 保存形式 (配列 / 列指向 / 圧縮の有無) によらない、ブロックの内容のハッシュ """
+    canonical = json.dumps(
+        [[block['text'], int(block['offset']), int(block['duration'])] for block in blocks],
+        ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def content_digest(content):
+    """
+    content カラムの値から content_hash を計算する (content_hash カラムが空の古い行用)。
+    ブロックの配列として読めない値は、本文のテキストのハッシュにする。
+    """
+    blocks = decode_transcript(content) if not isinstance(content, str) else None
+    if isinstance(blocks, list) and all(isinstance(b, dict) and 'text' in b for b in blocks):
+        return content_hash([
+            {'text': b['text'], 'offset': b.get('offset') or 0, 'duration': b.get('duration') or 0} for b in blocks
+        ])
+    return hashlib.sha256(content_to_text(content).encode('utf-8')).hexdigest()
+
+
+# content を書き換えても content_hash を更新しない書き込み (アプリの API ルートや手作業の修正など) で
+# 古いハッシュが残らないよう、DB 側で空にするトリガー (save_subtitles.py がテーブルと一緒に作る)。
+# 空のハッシュは読む側が content_digest で計算し直す。
+CONTENT_HASH_TRIGGER = 'optimized_transcripts_clear_stale_hash'
+CONTENT_HASH_TRIGGER_SQL = f"""
+CREATE OR REPLACE FUNCTION {CONTENT_HASH_TRIGGER}() RETURNS trigger AS $$
+BEGIN
+    IF NEW.content IS DISTINCT FROM OLD.content AND NEW.content_hash IS NOT DISTINCT FROM OLD.content_hash THEN
+        NEW.content_hash := NULL;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger
+                   WHERE tgname = '{CONTENT_HASH_TRIGGER}' AND tgrelid = 'optimized_transcripts'::regclass) THEN
+        CREATE TRIGGER {CONTENT_HASH_TRIGGER} BEFORE UPDATE ON optimized_transcripts
+            FOR EACH ROW EXECUTE FUNCTION {CONTENT_HASH_TRIGGER}();
+    END IF;
+END
+$$;
+"""
+
+
+def stored_hash_trusted(cursor):
+    """
+    optimized_transcripts.content_hash をそのまま信用してよいか (上のトリガーがあるか)。
+    ないときは、保存されたハッシュが今の content と合っている保証がない。
+    """
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = %s AND tgrelid = 'optimized_transcripts'::regclass)",
+        (CONTENT_HASH_TRIGGER,)
+    )
+    return cursor.fetchone()[0]
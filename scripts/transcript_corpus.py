@@ -0,0 +1,363 @@
+import os
+import sys
+import mmap
+import time
+import struct
+import shutil
+import argparse
+from transcript_codec import decode_transcript, content_digest, stored_hash_trusted, TranscriptFormatError
+
+# ==========================================
+# 字幕コーパス全体のバイナリ書き出し (オフラインのバッチ処理用)
+#
+# optimized_transcripts を1つのファイルにまとめ、mmap で読めるようにする。
+# 言語判定・結合のやり直し・語彙の集計などを、Supabase から1行ずつ取り直さずに手元で回せる。
+#
+# ファイルの構成 (すべてリトルエンディアン):
+#   ヘッダー    HEADER_FORMAT  マジック, バージョン, 動画数
+#   索引        ENTRY_FORMAT × 動画数 (video_id のバイト順。二分探索で引く)
+#                 video_id, 言語, content_hash, ブロック数, データの位置, テキストのバイト数
+#   データ      動画ごとに 4バイト境界にそろえて
+#                 offset (uint32 × n) / duration (uint32 × n) / テキストの終了位置 (uint32 × n) / UTF-8 テキスト
+#
+# 読み込み側 (TranscriptCorpus) は offset / duration を mmap 上の memoryview のまま返すので、
+# 文字列にするまではコピーが発生しない。
+#
+#   DATABASE_URL=postgresql://... python transcript_corpus.py export corpus.bin
+#   python transcript_corpus.py info corpus.bin
+#   python transcript_corpus.py show corpus.bin VIDEO_ID
+# ==========================================
+
+MAGIC = b'TCORPUS\0'
+VERSION = 1
+
+HEADER_FORMAT = '<8sII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# video_id, language, content_hash (sha256), block_count, data_pos, text_len
+ENTRY_FORMAT = '<16s16s32sIQI'
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+ALIGN = 4
+DEFAULT_PAGE_SIZE = 500
+
+EXPORT_SQL = """
+SELECT video_id, language, content_hash, content FROM optimized_transcripts
+WHERE content IS NOT NULL AND video_id > %s
+ORDER BY video_id
+LIMIT %s
+"""
+
+# memoryview.cast はネイティブのバイト順なので、ビッグエンディアンでは struct で読む
+_NATIVE_LE = sys.byteorder == 'little'
+
+
+class CorpusFormatError(ValueError):
+    pass
+
+
+def _fixed(value, size, name):
+    data = (value or '').encode('utf-8')
+    if len(data) > size:
+        raise CorpusFormatError(f"{name} is longer than {size} bytes: {value!r}")
+    return data
+
+
+def _pad(length):
+    return (-length) % ALIGN
+
+
+def _pack_blocks(blocks):
+    """ ブロックのリスト → (ブロック数, データ部のバイト列, テキストのバイト数) """
+    texts = [(block.get('text') or '').encode('utf-8') for block in blocks]
+    ends = []
+    end = 0
+    for text in texts:
+        end += len(text)
+        ends.append(end)
+    n = len(blocks)
+    arrays = struct.pack(
+        f'<{n * 3}I',
+        *(max(0, int(block.get('offset') or 0)) for block in blocks),
+        *(max(0, int(block.get('duration') or 0)) for block in blocks),
+        *ends,
+    )
+    text = b''.join(texts)
+    return n, arrays + text + b'\0' * _pad(len(text)), len(text)
+
+
+def write_corpus(path, videos):
+    """
+    videos: (video_id, language, content_hash の16進文字列, ブロックのリスト) のイテラブル。
+    データ部を一時ファイルに書いてから索引を前に付けて、最後に path へ置き換える。
+    Returns: 書き出した動画数
+    """
+    data_path = f"{path}.data.tmp"
+    out_path = f"{path}.tmp"
+    entries = []
+    try:
+        with open(data_path, 'wb') as data_file:
+            pos = 0
+            for video_id, language, digest, blocks in videos:
+                n, data, text_len = _pack_blocks(blocks)
+                entries.append((
+                    _fixed(video_id, 16, 'video_id'), _fixed(language, 16, 'language'),
+                    bytes.fromhex(digest) if digest else b'\0' * 32, n, pos, text_len,
+                ))
+                data_file.write(data)
+                pos += len(data)
+
+        entries.sort(key=lambda entry: entry[0])
+        base = HEADER_SIZE + ENTRY_SIZE * len(entries)
+        base += _pad(base)
+        with open(out_path, 'wb') as out:
+            out.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(entries)))
+            for video_id, language, digest, n, pos, text_len in entries:
+                out.write(struct.pack(ENTRY_FORMAT, video_id, language, digest, n, base + pos, text_len))
+            out.write(b'\0' * (base - out.tell()))
+            with open(data_path, 'rb') as data_file:
+                shutil.copyfileobj(data_file, out, 1024 * 1024)
+        os.replace(out_path, path)
+    finally:
+        for tmp in (data_path, out_path):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return len(entries)
+
+
+class VideoTranscript:
+    """
+    1動画分のブロック。offsets / durations / ends は mmap 上の uint32 の memoryview。
+    text_bytes(i) も mmap 上の memoryview で、text(i) / block(i) で初めて文字列になる。
+    """
+
+    __slots__ = ('video_id', 'language', 'content_hash', 'offsets', 'durations', 'ends', '_text')
+
+    def __init__(self, video_id, language, content_hash, offsets, durations, ends, text):
+        self.video_id = video_id
+        self.language = language
+        self.content_hash = content_hash
+        self.offsets = offsets
+        self.durations = durations
+        self.ends = ends
+        self._text = text
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def text_bytes(self, i):
+        start = self.ends[i - 1] if i > 0 else 0
+        return self._text[start:self.ends[i]]
+
+    def text(self, i):
+        return str(self.text_bytes(i), 'utf-8')
+
+    def full_text_bytes(self):
+        """ 全ブロックのテキストを区切りなしで連結した UTF-8 (ブロックの境界は ends) """
+        return self._text
+
+    def block(self, i):
+        return {'text': self.text(i), 'offset': self.offsets[i], 'duration': self.durations[i]}
+
+    def blocks(self):
+        """ decode_transcript と同じ形のリスト """
+        return [self.block(i) for i in range(len(self))]
+
+
+class TranscriptCorpus:
+    """ write_corpus で書き出したファイルを mmap で読む。with 文で使える """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # 空のファイルは mmap できない
+            self._file.close()
+            raise CorpusFormatError(f"Empty corpus file: {path}")
+        self._view = memoryview(self._mmap)
+        if len(self._mmap) < HEADER_SIZE:
+            self.close()
+            raise CorpusFormatError(f"Truncated corpus file: {path}")
+        magic, version, count = struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise CorpusFormatError(f"Not a transcript corpus: {path}")
+        if version != VERSION:
+            self.close()
+            raise CorpusFormatError(f"Unsupported corpus version: {version}")
+        self.count = count
+
+    def close(self):
+        """ 返した VideoTranscript はこの後は使えない (まだ参照が残っていれば、解放は GC に任せる) """
+        try:
+            if self._view is not None:
+                self._view.release()
+                self._view = None
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, index):
+        return struct.unpack_from(ENTRY_FORMAT, self._mmap, HEADER_SIZE + ENTRY_SIZE * index)
+
+    def _key(self, index):
+        start = HEADER_SIZE + ENTRY_SIZE * index
+        return self._mmap[start:start + 16]
+
+    def _uint32s(self, pos, n):
+        if _NATIVE_LE:
+            return self._view[pos:pos + 4 * n].cast('I')
+        return struct.unpack_from(f'<{n}I', self._mmap, pos)
+
+    def _video(self, index):
+        video_id, language, digest, n, pos, text_len = self._entry(index)
+        text_pos = pos + 12 * n
+        return VideoTranscript(
+            video_id.rstrip(b'\0').decode('utf-8'),
+            language.rstrip(b'\0').decode('utf-8') or None,
+            digest.hex() if digest.strip(b'\0') else None,
+            self._uint32s(pos, n),
+            self._uint32s(pos + 4 * n, n),
+            self._uint32s(pos + 8 * n, n),
+            self._view[text_pos:text_pos + text_len],
+        )
+
+    def _find(self, video_id):
+        key = _fixed(video_id, 16, 'video_id').ljust(16, b'\0')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self._key(lo) == key else None
+
+    def get(self, video_id):
+        """ Returns: VideoTranscript / なければ None """
+        index = self._find(video_id)
+        return self._video(index) if index is not None else None
+
+    def __contains__(self, video_id):
+        return self._find(video_id) is not None
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self._video(index)
+
+    def video_ids(self):
+        return [self._key(i).rstrip(b'\0').decode('utf-8') for i in range(self.count)]
+
+
+def iter_db_videos(dsn, page_size=DEFAULT_PAGE_SIZE):
+    """ optimized_transcripts を video_id 順にキーセットで読み、write_corpus に渡す形で返す """
+    # 読み込み側だけを使うジョブでは psycopg2 は不要なので、ここで読み込む
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    # 名前付きカーソルにしなくても、ページごとに読むのでメモリは page_size 行分で済む
+    cursor = conn.cursor()
+    last_video_id = ''
+    skipped = 0
+    try:
+        # トリガーで保たれていないハッシュは古いかもしれないので、content から計算し直す
+        trusted = stored_hash_trusted(cursor)
+        while True:
+            cursor.execute(EXPORT_SQL, (last_video_id, page_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_video_id = rows[-1][0]
+            for video_id, language, digest, content in rows:
+                try:
+                    blocks = decode_transcript(content)
+                except TranscriptFormatError:
+                    # 1つの文字列 (fix_transcript_languages.py が書き直した行) などはブロックがない
+                    blocks = None
+                if not isinstance(blocks, list):
+                    skipped += 1
+                    continue
+                yield video_id, language, (trusted and digest) or content_digest(content), blocks
+            print(f"  [Export] up to {last_video_id}")
+    finally:
+        cursor.close()
+        conn.close()
+        if skipped:
+            print(f"  [Export] Skipped {skipped} rows whose content is not a block list")
+
+
+def scan(corpus):
+    """ 全動画の offset / duration / テキストを一通り読む (読み込み速度の目安) """
+    blocks = text_bytes = 0
+    total_ms = 0
+    for video in corpus:
+        blocks += len(video)
+        total_ms += sum(video.durations)
+        text_bytes += len(video.full_text_bytes())
+    return blocks, text_bytes, total_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="字幕コーパスのバイナリ書き出し・確認")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    export = sub.add_parser('export', help="optimized_transcripts を1つのファイルに書き出す")
+    export.add_argument('path')
+    export.add_argument('--dsn', default=os.getenv('DATABASE_URL'),
+                        help="接続文字列 (デフォルト: 環境変数 DATABASE_URL)")
+    export.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help="1回に読み込む件数 (デフォルト: %(default)s)")
+
+    info = sub.add_parser('info', help="件数を表示し、全体を読み通す時間を測る")
+    info.add_argument('path')
+
+    show = sub.add_parser('show', help="1動画分のブロックを表示する")
+    show.add_argument('path')
+    show.add_argument('video_id')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        if not args.dsn:
+            print("Error: set DATABASE_URL or pass --dsn")
+            return 1
+        start = time.perf_counter()
+        count = write_corpus(args.path, iter_db_videos(args.dsn, args.page_size))
+        print(f"Exported {count} videos to {args.path} "
+              f"({os.path.getsize(args.path) / (1024 * 1024):.1f} MB, {time.perf_counter() - start:.1f}s)")
+        return 0
+
+    with TranscriptCorpus(args.path) as corpus:
+        if args.command == 'info':
+            start = time.perf_counter()
+            blocks, text_bytes, total_ms = scan(corpus)
+            elapsed = time.perf_counter() - start
+            size_mb = os.path.getsize(args.path) / (1024 * 1024)
+            print(f"Videos: {len(corpus)}")
+            print(f"Blocks: {blocks}")
+            print(f"Text: {text_bytes / (1024 * 1024):.1f} MB, {total_ms / 3600000:.1f} hours")
+            print(f"Scanned {size_mb:.1f} MB in {elapsed * 1000:.1f} ms")
+        elif args.command == 'show':
+            video = corpus.get(args.video_id)
+            if video is None:
+                print(f"{args.video_id} is not in the corpus")
+                return 1
+            print(f"{video.video_id} (lang: {video.language}, blocks: {len(video)}, hash: {video.content_hash})")
+            for i in range(len(video)):
+                seconds = video.offsets[i] // 1000
+                print(f"  {seconds // 60:>4}:{seconds % 60:02d}  {video.text(i)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
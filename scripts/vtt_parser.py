@@ -0,0 +1,283 @@
+import codecs
+import io
+import re
+from collections import deque
+
+# ==========================================
+# WebVTT 字幕パーサー (fetch_subtitles.py / save_subtitles.py 共通)
+#
+# ファイル全体を読み込まずに 1行ずつ処理する。
+# キューの解析 → テキスト整形 → 重複除去 (自動字幕のロールアップ表示を含む) → 文単位の結合 までを
+# ジェネレーターの連鎖で 1パスで行うので、長時間の講義でもメモリ使用量は一定。
+# ==========================================
+
+TAG_RE = re.compile(r'<[^>]+>')
+# 自動字幕の単語ごとの時刻タグ: <00:00:01.234>
+WORD_TIMING_RE = re.compile(r'<\d{2}:\d{2}[:.]')
+
+# ヘッダーや埋め込みスクリプトなど、字幕本文ではない行
+NOISE_PREFIXES = ('#EXT', 'http', 'Kind:', 'Language:')
+NOISE_RE = re.compile(r'-->|window\.|function\(|captions language', re.IGNORECASE)
+
+SENTENCE_ENDINGS = ('.', '?', '!', '。', '！', '？')
+
+# 文の結合ルール
+MERGE_MAX_CHARS = 80
+MERGE_MAX_GAP_MS = 1000
+
+READ_CHUNK_SIZE = 64 * 1024
+
+# WEBVTT がこの文字数以内に出てくれば WebVTT とみなす (一括読み込みのパーサーと同じ判定。
+# 前に Kind: / Language: などのメタデータ行が付いた字幕もある)
+HEADER_SEARCH_CHARS = 100
+
+# パース結果が変わる修正をしたら上げる (optimized_transcripts.parser_version と比べて
+# save_subtitles.py --refresh がキャッシュからパースし直す)
+#   1: 一括読み込みのパーサー  2: ストリーミング化  3: 自動字幕のロールアップ重複除去
+#   4: 文の復元 (sentence_restore.py) で結合
+PARSER_VERSION = 4
+
+# 自動字幕のロールアップ表示の重複除去 (単語ごとの時刻タグが出てきたトラックだけに適用)
+#   直近 OVERLAP_RECENT_LINES 行と同じ行は捨て、
+#   直近に出力したテキストの末尾と先頭が OVERLAP_MIN_CHARS 文字以上重なる行はその部分を削る
+OVERLAP_RECENT_LINES = 3
+OVERLAP_MIN_CHARS = 6
+OVERLAP_TAIL_CHARS = 512
+
+
+class NotWebVTTError(ValueError):
+    """ 入力が WebVTT 形式ではない """
+
+
+def time_to_ms(t_str):
+    """ '00:00:01.234' 形式の文字列をミリ秒に変換 """
+    try:
+        if '.' in t_str:
+            hms, ms = t_str.split('.')
+        else:
+            hms, ms = t_str, 0
+        parts = hms.split(':')
+        h, m, s = 0, 0, 0
+        if len(parts) == 3:
+            h, m, s = map(int, parts)
+        elif len(parts) == 2:
+            m, s = map(int, parts)
+        return (h * 3600 + m * 60 + s) * 1000 + int(ms)
+    except:
+        return 0
+
+
+def clean_text(text):
+    """ タグを除去し、空白を1つにまとめる """
+    if '<' in text:
+        text = TAG_RE.sub('', text)
+    return ' '.join(text.split())
+
+
+def is_noise(text):
+    if text.startswith(NOISE_PREFIXES):
+        return True
+    if '{' in text and '}' in text:
+        return True
+    return NOISE_RE.search(text) is not None
+
+
+def iter_lines(source):
+    """
+    str / bytes / テキストファイル / バイナリストリーム (ydl.urlopen のレスポンス等) から
+    1行ずつ取り出す。バイト列は少しずつ UTF-8 デコードする。
+    """
+    if isinstance(source, str):
+        yield from io.StringIO(source)
+        return
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    if isinstance(source, io.TextIOBase):
+        yield from source
+        return
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = source.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        yield from lines
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
+
+
+def _is_boundary(text, index):
+    """ text[index] の直前で単語が切れているか (CJK は文字単位で切れてよい) """
+    if index <= 0 or index >= len(text):
+        return True
+    return text[index] == ' ' or text[index - 1] == ' ' or (
+        text[index - 1] >= '\u3000' and text[index] >= '\u3000'
+    )
+
+
+class OverlapDeduper:
+    """
+    YouTube の自動字幕は、前の行を次のキューにもう一度表示しながら1行ずつ流れていく。
+    その繰り返し部分を取り除き、重ならないテキストの流れにする。
+
+    直近に出力したテキストの末尾 (tail) と新しい行の先頭の最長の重なりを求める。
+    重なりの候補は tail の中で行の先頭の文字が出てくる位置だけなので、
+    str.find / str.startswith で長いものから順に試す (Python で1文字ずつ回すより速い)。
+    """
+
+    def __init__(self, recent_lines=OVERLAP_RECENT_LINES, min_overlap=OVERLAP_MIN_CHARS):
+        self.recent = deque(maxlen=recent_lines)
+        self.min_overlap = min_overlap
+        self.tail = ''
+
+    def _overlap(self, text):
+        """ tail の末尾と一致する text の先頭の長さ (単語の途中で切れるものは除く) """
+        tail = self.tail[-len(text):]
+        if len(tail) < self.min_overlap:
+            return 0
+        first = text[0]
+        last_start = len(tail) - self.min_overlap + 1
+        start = tail.find(first, 0, last_start)
+        while start != -1:
+            length = len(tail) - start
+            if text.startswith(tail[start:]) and _is_boundary(text, length) \
+                    and _is_boundary(self.tail, len(self.tail) - length):
+                return length
+            start = tail.find(first, start + 1, last_start)
+        return 0
+
+    def strip(self, text):
+        """ 新しく出力すべき部分を返す。全部が繰り返しなら None """
+        # 短い相づち ("Yes." など) は本当に繰り返されることがあるので、行の一致では捨てない
+        if len(text) >= self.min_overlap and text in self.recent:
+            return None
+        self.recent.append(text)
+
+        overlap = self._overlap(text)
+        rest = text[overlap:].lstrip()
+        if not rest:
+            return None
+        # 次の行と比べるのは直近の分だけでよい
+        self.tail = (self.tail + ' ' + rest if self.tail else rest)[-OVERLAP_TAIL_CHARS:]
+        return rest
+
+
+def iter_cues(source, require_header=True, collapse_overlaps=True):
+    """
+    WebVTT をパースして {'text', 'offset', 'duration'} を順に返す。
+    ノイズ行と、直前と同じテキストの行は除外する。
+    collapse_overlaps=True なら、自動字幕のロールアップ表示による繰り返しも取り除く。
+    手動字幕を誤って削らないよう、単語ごとの時刻タグを含む行が出てきてから有効にする。
+    require_header=True の場合、先頭 HEADER_SEARCH_CHARS 文字以内に WEBVTT がなければ NotWebVTTError
+    (WEBVTT より前の行はメタデータとして読み飛ばす)。
+    """
+    current_start = 0
+    current_end = 0
+    last_text = None
+    deduper = None
+    header_checked = not require_header
+    header_search = 0
+
+    for line in iter_lines(source):
+        if not header_checked:
+            if 'WEBVTT' not in line:
+                header_search += len(line.rstrip('\r\n')) + 1
+                if header_search >= HEADER_SEARCH_CHARS:
+                    raise NotWebVTTError("not a WebVTT document")
+                continue
+            if header_search + line.index('WEBVTT') + len('WEBVTT') > HEADER_SEARCH_CHARS:
+                raise NotWebVTTError("not a WebVTT document")
+            header_checked = True
+        line = line.strip()
+
+        if '-->' in line:
+            # タイムスタンプ行: "00:00:01.000 --> 00:00:03.000 align:start ..."
+            times = line.split(' --> ')
+            if len(times) >= 2:
+                current_start = time_to_ms(times[0].strip())
+                # 終了時間の後ろに設定情報がつくことがあるのでスペースで切る
+                current_end = time_to_ms(times[1].strip().split(' ')[0])
+            continue
+
+        if not line or line.isdigit() or line.lstrip('\ufeff') == 'WEBVTT':
+            continue
+
+        if collapse_overlaps and deduper is None and '<' in line and WORD_TIMING_RE.search(line):
+            deduper = OverlapDeduper()
+
+        text = clean_text(line)
+        if not text or text == last_text or is_noise(text):
+            continue
+
+        last_text = text
+        if deduper is not None:
+            text = deduper.strip(text)
+            if text is None:
+                continue
+        yield {
+            'text': text,
+            'offset': current_start,
+            'duration': max(0, current_end - current_start)
+        }
+
+    if not header_checked:
+        raise NotWebVTTError("empty document")
+
+
+def merge_cues(cues):
+    """
+    キューを文単位に結合する。
+    文末記号・80文字超・1秒超の間隔 のいずれかで区切る。
+    次のキューの開始時刻だけを先読みするので、入力はストリームのままでよい。
+    """
+    buffer_text = ""
+    buffer_start = 0
+    buffer_duration = 0
+    prev = None
+
+    for item in cues:
+        if prev is not None:
+            # 直前のキューの区切り判定には次のキューとの間隔が必要
+            gap = item['offset'] - (prev['offset'] + prev['duration'])
+            if buffer_text and (
+                prev['text'].endswith(SENTENCE_ENDINGS) or
+                len(buffer_text) > MERGE_MAX_CHARS or
+                gap > MERGE_MAX_GAP_MS
+            ):
+                yield {'text': buffer_text, 'offset': buffer_start, 'duration': buffer_duration}
+                buffer_text = ""
+                buffer_duration = 0
+
+        if buffer_text:
+            buffer_text += " " + item['text']
+        else:
+            buffer_text = item['text']
+            buffer_start = item['offset']
+        buffer_duration += item['duration']
+        prev = item
+
+    if buffer_text:
+        yield {'text': buffer_text, 'offset': buffer_start, 'duration': buffer_duration}
+
+
+def iter_merged(source):
+    """ パースから文の結合までを 1パスで行う """
+    return merge_cues(iter_cues(source))
+
+
+def parse_vtt(content):
+    """ WebVTT形式の字幕をパースして辞書リストにする (結合なし) """
+    return list(iter_cues(content, require_header=False))
+
+
+def parse_and_merge_vtt(content):
+    """ WebVTT形式の字幕をパースして文単位に結合する。WebVTTでなければ None """
+    try:
+        return list(iter_merged(content))
+    except NotWebVTTError:
+        return None
@@ -0,0 +1,75 @@
+import copy
+import threading
+
+# ==========================================
+# YoutubeDL のセッションの使い回し (fetch_subtitles.py / save_subtitles.py 共通)
+#
+# 動画ごとに YoutubeDL を作り直すと、Cookie・extractor の初期化・keep-alive の接続が毎回捨てられ、
+# TLS のハンドシェイクからやり直しになる。
+# ワーカースレッドごとに1つの YoutubeDL を開いたままにして、同じスレッドの動画はそれで処理する。
+# (YoutubeDL はスレッドセーフではないので、スレッド間では共有しない)
+# ==========================================
+
+# この本数を処理したら作り直す (extractor のキャッシュなどが際限なく増えないように)
+DEFAULT_MAX_USES = 500
+
+
+def new_session(ydl_class, opts):
+    """
+    opts を複製して ydl_class (yt_dlp.YoutubeDL など) を作る。
+    YoutubeDL は渡された dict をそのまま params にして書き換える (outtmpl を足す、字幕の設定を差し替える) ので、
+    モジュールの設定 dict を直接渡すと、スレッドごとのセッション同士で出力先や字幕の言語が混ざる。
+    """
+    return ydl_class(copy.deepcopy(opts))
+
+
+class YdlSessions:
+    """
+    factory() で作った YoutubeDL をスレッドごとに1つ持つ。
+    get() はそのスレッドのセッションを返す (なければ作って開く)。終了時に close_all() で閉じる。
+    """
+
+    def __init__(self, factory, max_uses=DEFAULT_MAX_USES):
+        self.factory = factory
+        self.max_uses = max_uses
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._open = set()
+        self.created = 0
+
+    def get(self):
+        local = self._local
+        ydl = getattr(local, 'ydl', None)
+        if ydl is not None and self.max_uses and local.uses >= self.max_uses:
+            self.discard()
+            ydl = None
+        if ydl is None:
+            ydl = self.factory()
+            ydl.__enter__()
+            local.ydl = ydl
+            local.uses = 0
+            with self._lock:
+                self._open.add(ydl)
+                self.created += 1
+        local.uses += 1
+        return ydl
+
+    def discard(self):
+        """ このスレッドのセッションを閉じる (次の get() で作り直す) """
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None:
+            return
+        self._local.ydl = None
+        with self._lock:
+            self._open.discard(ydl)
+        ydl.__exit__(None, None, None)
+
+    def close_all(self):
+        """ 全スレッドのセッションを閉じる。ワーカーがすべて終わってから呼ぶ """
+        with self._lock:
+            sessions, self._open = list(self._open), set()
+        for ydl in sessions:
+            try:
+                ydl.__exit__(None, None, None)
+            except Exception:
+                pass